@@ -1,19 +1,142 @@
 from PyQt5.QtWidgets import QWidget, QLabel, QApplication
-from PyQt5.QtCore import Qt, pyqtSlot, QTimer, pyqtSignal
+from PyQt5.QtCore import Qt, pyqtSlot, QTimer, pyqtSignal, QObject
 from PyQt5.QtGui import QColor, QPixmap
 from numpy.typing import NDArray
 import numpy as np
+import time
+import hashlib
+import weakref
+from collections import OrderedDict
+from typing import Optional, Tuple, Dict, Hashable, Sequence
 from qt_widgets import NDarray_to_QPixmap
 from image_tools import im2rgb, im2uint8
+from Latency import latency_probe
+
+# order in which DLP projectors show the 24 bit-planes of a video frame 
+# in pattern mode (e.g. TI DLPC350: G0-G7, R0-R7, B0-B7)
+BITPLANE_ORDER = 'GRB'
+
+def pack_bitplanes(masks: NDArray, threshold: float = 0.5, channel_order: str = BITPLANE_ORDER) -> NDArray:
+    '''
+    Pack a stack of N binary masks (N, H, W) into ceil(N/24) RGB frames 
+    (F, H, W, 3) uint8. Mask k is bit k%8 of channel channel_order[k//8%3] 
+    of frame k//24. Masks are binarized with mask > threshold, missing 
+    masks in the last frame are black.
+    '''
+
+    masks = np.asarray(masks)
+    num_masks, height, width = masks.shape
+    num_frames = -(-num_masks // 24)
+
+    bits = np.zeros((num_frames*24, height, width), bool)
+    np.greater(masks, threshold, out=bits[:num_masks])
+    bits = bits.reshape(num_frames, 3, 8, height, width)
+    packed = np.packbits(bits, axis=2, bitorder='little')[:,:,0]
+    
+    frames = np.empty((num_frames, height, width, 3), np.uint8)
+    for c, name in enumerate(channel_order):
+        frames[..., 'RGB'.index(name)] = packed[:,c]
+    return frames
+
+class PixmapCache:
+    '''
+    LRU cache of ready-to-display pixmaps, bounded in memory.
+
+    By default images are keyed by identity: an entry is only valid for 
+    the array object it was created from and is discarded when that array 
+    is garbage collected. Masks are not modified in place in this repo, 
+    so identity is enough and costs nothing. With content_hash, images 
+    are keyed by a hash of their content instead, which also catches 
+    identical masks in different arrays, at the cost of hashing each image.
+    '''
+
+    def __init__(self, max_bytes: int = 512*2**20, content_hash: bool = False) -> None:
+
+        self.max_bytes = max_bytes
+        self.content_hash = content_hash
+        self.entries = OrderedDict() # key -> (pixmap, nbytes, weakref or None)
+        self.num_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def key(self, image: NDArray) -> Hashable:
+
+        if self.content_hash:
+            digest = hashlib.blake2b(np.ascontiguousarray(image).data, digest_size=16).digest()
+            return (digest, image.shape, image.dtype.str)
+        
+        return (id(image), image.__array_interface__['data'][0], image.shape, image.dtype.str)
+
+    def get(self, key: Hashable, image: NDArray) -> Optional[QPixmap]:
+
+        entry = self.entries.get(key)
+        if entry is None or (entry[2] is not None and entry[2]() is not image):
+            self.misses += 1
+            return None
+        
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry[0]
+
+    def put(self, key: Hashable, image: NDArray, pixmap: QPixmap) -> None:
+
+        nbytes = pixmap.width() * pixmap.height() * pixmap.depth() // 8
+        if nbytes > self.max_bytes:
+            return
+        
+        self.remove(key)
+
+        ref = None
+        if not self.content_hash:
+            ref = weakref.ref(image, lambda r: self.discard(key, r))
+        self.entries[key] = (pixmap, nbytes, ref)
+        self.num_bytes += nbytes
+
+        while self.num_bytes > self.max_bytes:
+            self.remove(next(iter(self.entries)))
+            self.evictions += 1
+
+    def remove(self, key: Hashable) -> None:
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.num_bytes -= entry[1]
+
+    def discard(self, key: Hashable, ref: weakref.ref) -> None:
+        # source array was garbage collected
+        entry = self.entries.get(key)
+        if entry is not None and entry[2] is ref:
+            self.remove(key)
+
+    def clear(self) -> None:
+        self.entries.clear()
+        self.num_bytes = 0
+
+    def get_statistics(self) -> Dict:
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'entries': len(self.entries),
+            'bytes': self.num_bytes
+        }
 
 class DMD(QWidget):
 
-    def __init__ (self, screen_num: int = 0, *args, **kwargs):
+    def __init__ (
+            self, 
+            screen_num: int = 0, 
+            cache_size_mb: int = 512, 
+            content_hash: bool = False, 
+            *args, **kwargs
+        ):
 
         super().__init__(*args, **kwargs)
         self.screen_num = screen_num
+        self.cache = PixmapCache(cache_size_mb*2**20, content_hash)
         self.configure_screen()
         self.create_components()
+        self.player = PatternSequencePlayer(self)
 
     def configure_screen(self):
         
@@ -38,32 +161,188 @@ class DMD(QWidget):
         self.img_label.setGeometry(0, 0, self.screen_width, self.screen_height)           
         self.img_label.show()
 
+    def convert(self, image: NDArray) -> QPixmap:
+        image = im2rgb(im2uint8(image))
+        return NDarray_to_QPixmap(image)
+
+    def get_pixmap(self, image: NDArray) -> QPixmap:
+        '''convert image, or reuse the pixmap if it was already converted'''
+
+        key = self.cache.key(image)
+        pixmap = self.cache.get(key, image)
+        if pixmap is None:
+            pixmap = self.convert(image)
+            self.cache.put(key, image, pixmap)
+        return pixmap
+
     @pyqtSlot(np.ndarray)
     def update_image(self, image: NDArray=None):
-        image = im2rgb(im2uint8(image))
-        self.img_label.setPixmap(NDarray_to_QPixmap(image))     
+        pixmap = self.get_pixmap(image)
+        latency_probe.mark('convert')
+        self.img_label.setPixmap(pixmap)     
+        if latency_probe.enabled:
+            # paint now rather than on the next event loop iteration 
+            latency_probe.mark('set_pixmap')
+            self.img_label.repaint()
+            latency_probe.end('painted')
+
+    @pyqtSlot(np.ndarray)
+    def play_sequence(self, frames: NDArray, interval_ms: Optional[float] = None, repeat: int = 1):
+        '''play a stack of frames, by default one frame per refresh period'''
+
+        if interval_ms is None:
+            period = self.player.vsync_period()
+            interval_ms = 1000*period if period is not None else self.player.FALLBACK_INTERVAL_MS
+        self.player.stop()
+        self.player.load(frames)
+        self.player.play(interval_ms, repeat)
+
+class PatternSequencePlayer(QObject):
+    '''
+    Play a sequence of patterns on the DMD at a fixed interval. 
+
+    Patterns are converted to pixmaps once in load() if the pixmaps fit 
+    in max_pixmap_bytes, playing only swaps pixmaps. Longer sequences are 
+    kept as uint8 frames, each frame is converted right after the previous 
+    flip, while waiting for its deadline. Flips are scheduled on absolute 
+    deadlines from a monotonic clock: a precise timer wakes up shortly 
+    before each deadline, then the last SPIN_MS are busy-waited. 
+
+    sync_to_vsync only rounds the interval to a whole number of refresh 
+    periods of the DMD screen, flips are not synchronized to the screen 
+    buffer swaps. When the refresh rate is unknown (0, e.g. offscreen or 
+    on some virtual outputs) the interval is not rounded.
 
-class ImageSender(QWidget):
+    For each frame the scheduled and actual flip times are logged (the 
+    actual time is when the repaint returned). Frames flipped more than 
+    half an interval late are counted as missed.
+    '''
 
-    send_image = pyqtSignal(np.ndarray)
+    frame_shown = pyqtSignal(int)
+    sequence_done = pyqtSignal()
 
-    def __init__ (self, dmd_widget: DMD , *args, **kwargs):
+    SPIN_MS = 2
+    # default interval when the refresh rate is unknown
+    FALLBACK_INTERVAL_MS = 1000/60
+
+    def __init__(self, dmd_widget: DMD, max_pixmap_bytes: int = 256*2**20, *args, **kwargs):
 
         super().__init__(*args, **kwargs)
         self.dmd_widget = dmd_widget
+        self.max_pixmap_bytes = max_pixmap_bytes
+        self.patterns = []
+        self.pixmaps = []
+        self.next_pixmap = None
+        self.interval = 0
+        self.start_time = 0
+        self.frame_num = 0
+        self.num_frames = 0
+        self.scheduled = np.zeros((0,))
+        self.actual = np.zeros((0,))
+        self.playing = False
 
-        self.send_image.connect(self.dmd_widget.update_image)
+        self.timer = QTimer(self)
+        self.timer.setTimerType(Qt.PreciseTimer)
+        self.timer.setSingleShot(True)
+        self.timer.timeout.connect(self.on_timer)
 
-        self.timer = QTimer()
-        self.timer.timeout.connect(self.loop)
-        self.timer.setInterval(33)
-        self.timer.start()
-    
-    def loop(self):
-        image = np.random.randint(
-            0, 255,
-            [self.dmd_widget.screen_height, self.dmd_widget.screen_width], 
-            np.uint8
-        )
-
-        self.send_image.emit(image)
+    def load(self, patterns: Sequence[NDArray]) -> None:
+        '''convert all patterns ahead of time, if their 32-bit pixmaps fit'''
+
+        self.patterns = patterns
+        self.pixmaps = []
+        self.next_pixmap = None
+        num_bytes = sum(4 * p.shape[0] * p.shape[1] for p in patterns)
+        if num_bytes <= self.max_pixmap_bytes:
+            self.pixmaps = [self.dmd_widget.convert(p) for p in patterns]
+
+    def get_pixmap(self, frame_num: int) -> QPixmap:
+        index = frame_num % len(self.patterns)
+        if self.pixmaps:
+            return self.pixmaps[index]
+        return self.dmd_widget.convert(self.patterns[index])
+
+    def vsync_period(self) -> Optional[float]:
+        '''refresh period (s) of the DMD screen, None if unknown'''
+
+        refresh_rate = self.dmd_widget.screen.refreshRate()
+        if refresh_rate <= 0:
+            return None
+        return 1/refresh_rate
+
+    def play(self, interval_ms: float, repeat: int = 1, sync_to_vsync: bool = True) -> None:
+
+        if len(self.patterns) == 0:
+            raise RuntimeError('no patterns loaded')
+        if repeat < 1:
+            raise ValueError(f'repeat must be at least 1, got {repeat}')
+        
+        interval = interval_ms/1000
+        period = self.vsync_period() if sync_to_vsync else None
+        if sync_to_vsync and period is None:
+            print(f'refresh rate unknown, interval {interval_ms} ms not rounded')
+        if period is not None:
+            num_periods = max(1, round(interval/period))
+            if not np.isclose(num_periods*period, interval):
+                print(f'interval {interval_ms} ms rounded to {1000*num_periods*period:.3f} ms ({num_periods} refresh periods)')
+            interval = num_periods*period
+
+        self.interval = interval
+        self.frame_num = 0
+        self.num_frames = len(self.patterns) * repeat
+        self.scheduled = np.full((self.num_frames,), np.nan)
+        self.actual = np.full((self.num_frames,), np.nan)
+        self.next_pixmap = self.get_pixmap(0)
+        self.playing = True
+        self.start_time = time.perf_counter()
+        self.on_timer()
+
+    def stop(self) -> None:
+        self.timer.stop()
+        self.playing = False
+
+    def on_timer(self) -> None:
+
+        if not self.playing:
+            return
+
+        # spin until the deadline
+        deadline = self.start_time + self.frame_num * self.interval
+        while time.perf_counter() < deadline:
+            pass
+
+        label = self.dmd_widget.img_label
+        label.setPixmap(self.next_pixmap)
+        label.repaint()
+        self.scheduled[self.frame_num] = deadline
+        self.actual[self.frame_num] = time.perf_counter()
+        self.frame_shown.emit(self.frame_num)
+
+        self.frame_num += 1
+        if self.frame_num == self.num_frames:
+            self.playing = False
+            self.sequence_done.emit()
+            return
+        self.next_pixmap = self.get_pixmap(self.frame_num)
+        
+        # wake up a little before the next deadline
+        next_deadline = self.start_time + self.frame_num * self.interval
+        wait_ms = 1000*(next_deadline - time.perf_counter()) - self.SPIN_MS
+        self.timer.start(max(0, int(wait_ms)))
+
+    def get_log(self) -> Tuple[NDArray, NDArray]:
+        '''scheduled and actual flip times (s), relative to the start'''
+        return self.scheduled - self.start_time, self.actual - self.start_time
+
+    def get_statistics(self) -> Dict:
+        '''jitter (s) of actual vs scheduled flips, and missed frames'''
+
+        delay = (self.actual - self.scheduled)[:self.frame_num]
+        return {
+            'frames': self.frame_num,
+            'interval': self.interval,
+            'jitter_mean': np.mean(delay) if delay.size else np.nan,
+            'jitter_std': np.std(delay) if delay.size else np.nan,
+            'jitter_max': np.max(delay) if delay.size else np.nan,
+            'missed': int(np.sum(delay > self.interval/2))
+        }
@@ -0,0 +1,102 @@
+'''
+Convert graded masks (float in [0,1]) into binary DMD patterns, ahead of 
+time. Temporal dithering spreads the gray level over a short sequence of 
+binary frames, spatial halftoning (ordered dither, error diffusion) 
+spreads it over neighbouring mirrors.
+'''
+
+import numpy as np
+from numpy.typing import NDArray
+
+def van_der_corput(n: int) -> NDArray:
+    '''permutation of range(n) in bit-reversed order, spreads consecutive values apart'''
+
+    bits = max(1, int(np.ceil(np.log2(n))))
+    values = np.arange(2**bits)
+    reversed_values = np.zeros_like(values)
+    for b in range(bits):
+        reversed_values |= ((values >> b) & 1) << (bits - 1 - b)
+    order = np.argsort(reversed_values, kind='stable')
+    return order[order < n]
+
+def temporal_dither(mask: NDArray, num_frames: int = 8) -> NDArray:
+    '''
+    Binary frames (num_frames, H, W) such that each pixel is on in 
+    round(mask*num_frames) frames. On-frames of a pixel are spread out in 
+    time rather than grouped at the start, to reduce flicker.
+    '''
+
+    levels = np.rint(np.clip(mask, 0, 1) * num_frames).astype(np.int32)
+    # frame k is on for pixels whose level is above its rank in the sequence
+    rank = np.empty(num_frames, np.int32)
+    rank[van_der_corput(num_frames)] = np.arange(num_frames)
+    return levels[None,:,:] > rank[:,None,None]
+
+def bayer_matrix(order: int) -> NDArray:
+    '''normalized Bayer threshold matrix of size 2**order'''
+
+    matrix = np.zeros((1,1), np.int32)
+    for i in range(order):
+        matrix = np.block([[4*matrix, 4*matrix+2], [4*matrix+3, 4*matrix+1]])
+    return (matrix + 0.5) / matrix.size
+
+def ordered_dither(mask: NDArray, order: int = 3) -> NDArray:
+    '''spatial halftone with a tiled Bayer matrix of size 2**order'''
+
+    thresholds = bayer_matrix(order)
+    n = thresholds.shape[0]
+    height, width = mask.shape
+
+    # compare blocks against the matrix by broadcasting, without tiling it 
+    padded = np.zeros((-(-height//n)*n, -(-width//n)*n), np.float32)
+    padded[:height,:width] = mask
+    blocks = padded.reshape(padded.shape[0]//n, n, padded.shape[1]//n, n)
+    halftone = blocks > thresholds[None,:,None,:]
+    return halftone.reshape(padded.shape)[:height,:width]
+
+def error_diffusion(mask: NDArray, threshold: float = 0.5) -> NDArray:
+    '''
+    Floyd-Steinberg halftone. Pixel (y,x) only depends on pixels with a 
+    smaller x + 2y, so all pixels on a line x + 2y = t are processed at 
+    once: W + 2H vectorized steps instead of W*H scalar ones.
+    '''
+
+    height, width = mask.shape
+    # one column of padding on each side, one row at the bottom
+    work = np.zeros((height+1, width+2), np.float32)
+    work[:height,1:width+1] = np.clip(mask, 0, 1)
+    halftone = np.zeros((height, width), bool)
+
+    for t in range(width + 2*(height-1)):
+        y = np.arange(max(0, -(-(t-width+1)//2)), min(height-1, t//2) + 1)
+        x = t - 2*y
+        col = x + 1
+
+        old = work[y, col]
+        new = old >= threshold
+        error = old - new
+        halftone[y, x] = new
+
+        work[y, col+1] += error * 7/16
+        work[y+1, col-1] += error * 3/16
+        work[y+1, col] += error * 5/16
+        work[y+1, col+1] += error * 1/16
+
+    return halftone
+
+DITHERING_METHODS = ['temporal', 'ordered', 'error diffusion']
+
+def compile_pattern(mask: NDArray, method: str = 'temporal', num_frames: int = 8) -> NDArray:
+    '''
+    Binary frames (N, H, W) for a graded mask: num_frames frames for 
+    temporal dithering, a single frame for spatial halftoning
+    '''
+
+    if method == 'temporal':
+        return temporal_dither(mask, num_frames)
+    elif method == 'ordered':
+        return ordered_dither(mask)[None]
+    elif method == 'error diffusion':
+        return error_diffusion(mask)[None]
+    else:
+        raise ValueError(f'unknown dithering method {method}, should be one of {DITHERING_METHODS}')
@@ -1,26 +1,44 @@
 import cv2
-from PyQt5.QtCore import pyqtSignal, Qt
-from PyQt5.QtWidgets import QWidget, QVBoxLayout, QHBoxLayout, QTabWidget, QScrollArea, QPushButton, QFrame, QLineEdit, QCheckBox
+from PyQt5.QtCore import pyqtSignal, Qt, QAbstractListModel, QModelIndex, QRect, QSize, QEvent
+from PyQt5.QtGui import QPainter
+from PyQt5.QtWidgets import (
+    QWidget, QVBoxLayout, QHBoxLayout, QTabWidget, QPushButton, QComboBox, QApplication, QLabel,
+    QListView, QAbstractItemView, QFileDialog, QDoubleSpinBox, QStyledItemDelegate, QStyleOptionViewItem, QStyleOptionButton, QStyle
+)
 import numpy as np
 from numpy.typing import NDArray
-from typing import Optional, List
+from typing import Optional, List, Tuple
 from image_tools import im2uint8, im2rgb, DrawPolyMask
 from qt_widgets import LabeledSpinBox
+from Dithering import compile_pattern, DITHERING_METHODS
+from DMD import pack_bitplanes
+from MaskStorage import MaskStore
+from MaskEngine import MaskEngine
+from Segmentation import detect_rois
+from Patterns import pattern_bank, SEQUENCES
+from Latency import latency_probe
 
 class DrawPolyMaskOpto(QWidget):
     """
-    Derived class implementing slots to receive, delete, clear, flatten,
-    or hide masks
+    View on the masks of one coordinate space. 
+    
+    Masks are kept in a compact MaskStore, shared with the MaskEngine 
+    which adds, deletes, hides and transfers them and allocates their 
+    keys. The drawer only displays the composite of visible masks and 
+    emits the masks drawn on it, with its ID (the index of its space).
     """
 
-    mask_drawn = pyqtSignal(int, int, np.ndarray)
+    mask_drawn = pyqtSignal(int, np.ndarray)
+    masks_drawn = pyqtSignal(int, list)
 
     def __init__(self, drawer: DrawPolyMask, *args, **kwargs):
     
         super().__init__(*args, **kwargs)
 
         self.drawer = drawer
-        self.drawer.mask_drawn.connect(self.mask_drawn)
+        self.drawer.mask_drawn.connect(self.on_mask_drawn)
+        self.store = MaskStore(self.get_image_size())
+        self.engine = None # set by the MaskManager
         self.create_components()
         self.layout_components()
 
@@ -30,24 +48,38 @@ class DrawPolyMaskOpto(QWidget):
     def set_ID(self, ID: int):
         self.drawer.set_ID(ID)
 
-    def get_masks(self):
-        return self.drawer.get_masks()
-    
-    def set_masks(self, masks: dict):
-        return self.drawer.set_masks(masks)
+    def get_masks(self) -> MaskStore:
+        return self.store
+
+    def set_engine(self, engine: MaskEngine):
+        self.engine = engine
 
     def get_image(self):
         return self.drawer.get_image()
 
     def set_image(self, image: np.ndarray):
         self.drawer.set_image(image)
+        if tuple(self.get_image_size()) != self.store.shape:
+            self.store.set_shape(self.get_image_size())
+            self.update_pixmap()
 
     def update_pixmap(self):
+        
+        # the drawer only holds the composite of visible masks, under the 
+        # largest key so that its own key for the next mask is new
+        display = {}
+        if len(self.store):
+            display[self.store.max_key()] = (True, self.store.composite())
+        self.drawer.set_masks(display)
         self.drawer.update_pixmap()
 
     def get_image_size(self):
         return self.drawer.get_image_size()
 
+    def on_mask_drawn(self, ID: int, key: int, mask: NDArray):
+        # the key is chosen by the MaskEngine, the drawer's is ignored
+        self.mask_drawn.emit(self.get_ID(), mask)
+
     def create_components(self):
 
         # special masks
@@ -59,196 +91,447 @@ class DrawPolyMaskOpto(QWidget):
         self.whole_field.setText('whole field')
         self.whole_field.clicked.connect(self.create_whole_field)
 
+        # automatic ROI detection
+        self.detect = QPushButton(self)
+        self.detect.setText('detect ROIs')
+        self.detect.clicked.connect(self.detect_rois)
+
+        self.cell_diameter = LabeledSpinBox(self)
+        self.cell_diameter.setText('cell diameter (px)')
+        self.cell_diameter.setRange(3, 200)
+        self.cell_diameter.setValue(12)
+
     def layout_components(self):
 
-        draw_buttons_layout = QHBoxLayout()
-        draw_buttons_layout.addWidget(self.checkerboard)
-        draw_buttons_layout.addWidget(self.whole_field)
-        draw_buttons_layout.addStretch()
+        self.draw_buttons_layout = QHBoxLayout()
+        self.draw_buttons_layout.addWidget(self.checkerboard)
+        self.draw_buttons_layout.addWidget(self.whole_field)
+        self.draw_buttons_layout.addWidget(self.detect)
+        self.draw_buttons_layout.addWidget(self.cell_diameter)
+        self.draw_buttons_layout.addStretch()
 
         layout = QVBoxLayout(self)
-        layout.addLayout(draw_buttons_layout)
+        layout.addLayout(self.draw_buttons_layout)
         layout.addWidget(self.drawer)
 
-    def on_mask_receive(self, recipient: int, key: int, mask: NDArray):
-         
-        if recipient == self.get_ID():
-
-            # store mask
-            show_mask = True
-            masks = self.get_masks()
-            masks[key] = (show_mask, mask)
-            self.set_masks(masks)
-
-        self.update_pixmap()
-
-    def on_mask_delete(self, key: int):
-
-        # remove mask from storage
-        masks = self.get_masks()
-        masks.pop(key)
-        self.set_masks(masks)
-        self.update_pixmap()
-
-    def on_mask_clear(self):
-
-        # remove mask from storage
-        self.set_masks({})
-        self.update_pixmap()
-
-    def on_mask_flatten(self):
-        
-        # flatten masks
-        flat = np.zeros(self.get_image_size(), dtype=np.float32)
-        masks = self.get_masks()
-        for key, mask_tuple in masks.items():
-            mask = mask_tuple[1]
-            flat += mask
-        flat = np.clip(flat,0,1)
-
-        # store flat mask
-        masks = {}
-        masks[1] = (True, flat)
-        self.set_masks(masks)
-
-        # update display
-        self.update_pixmap()
-
-    def on_mask_visibility(self, key: int, visibility: bool):
-
-        masks = self.get_masks()
-        _, mask = masks[key]
-        masks[key] = (visibility, mask)
-        self.set_masks(masks)
-        self.update_pixmap()
+    def on_masks_changed(self, recipient: int):
+        # masks are changed by the MaskEngine, -1 for all drawers
+        if recipient in (-1, self.get_ID()):
+            self.update_pixmap()
 
     def create_checkerboard(self):
         
-        # create key
-        masks = self.get_masks()
-        mask_keys = masks.keys() or [0]
-        key = max(mask_keys) + 1
-
         # create checkerboard (8 cells in smallest dimension)
         h, w = self.get_image_size()
         num_pixels = min(w,h) // 8
-        xv, yv = np.meshgrid(range(w), range(h), indexing='xy')
-        checkerboard = ((xv // num_pixels) + (yv // num_pixels)) % 2
-        checkerboard = checkerboard.astype(np.float32)
-
-        # update masks
-        masks[key] = (True, checkerboard)
-        self.set_masks(masks)
-
-        self.update_pixmap()
+        checkerboard = pattern_bank.pattern('checkerboard', (h, w), num_pixels)
 
         # send signal
-        self.mask_drawn.emit(self.get_ID(), key, checkerboard)
+        self.mask_drawn.emit(self.get_ID(), checkerboard)
     
-    def create_whole_field(self):
+    def detect_rois(self):
 
-        # create key
-        masks = self.get_masks()
-        mask_keys = masks.keys() or [0]
-        key = max(mask_keys) + 1
+        rois = detect_rois(self.get_image(), self.cell_diameter.value())
+        if not rois:
+            return
         
-        # create whole field
-        whole_field = np.ones(self.get_image_size(), dtype=np.float32)
+        # send as a single batch
+        self.masks_drawn.emit(self.get_ID(), rois)
 
-        # update masks
-        masks[key] = (True, whole_field)
-        self.set_masks(masks)
+    def create_whole_field(self):
 
-        self.update_pixmap()
+        # create whole field
+        whole_field = pattern_bank.pattern('whole field', self.get_image_size())
 
         # send signal
-        self.mask_drawn.emit(self.get_ID(), key, whole_field)
+        self.mask_drawn.emit(self.get_ID(), whole_field)
 
 class DrawPolyMaskOptoDMD(DrawPolyMaskOpto):
     '''
-    Derived class that emits the collection of visible masks 
+    Derived class that emits the collection of visible masks. 
+    Graded masks can be converted to binary patterns before exposure, 
+    by temporal dithering (packed in the bit-planes of the video frame) 
+    or by spatial halftoning.
     '''
 
     DMD_update = pyqtSignal(np.ndarray)
+    DMD_sequence = pyqtSignal(np.ndarray)
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.black = None
+        self.compiled = {}
+
+    def create_components(self):
+
+        super().create_components()
+
+        self.dithering = QComboBox(self)
+        self.dithering.addItems(['no dithering'] + DITHERING_METHODS)
+
+        self.dithering_frames = LabeledSpinBox(self)
+        self.dithering_frames.setText('dithering frames')
+        self.dithering_frames.setRange(1, 24)
+        self.dithering_frames.setValue(8)
+
+        # stimulus sequences
+        self.sequence = QComboBox(self)
+        self.sequence.addItems(list(SEQUENCES.keys()))
+
+        self.pattern_size = LabeledSpinBox(self)
+        self.pattern_size.setText('pattern size (px)')
+        self.pattern_size.setRange(2, 1024)
+        self.pattern_size.setValue(64)
+
+        self.play_button = QPushButton(self)
+        self.play_button.setText('play sequence')
+        self.play_button.clicked.connect(self.play_pattern_sequence)
+
+        # why the last sequence was not played
+        self.sequence_status = QLabel(self)
+        self.sequence_status.setStyleSheet('color: red')
+
+    def layout_components(self):
+
+        super().layout_components()
+        self.draw_buttons_layout.insertWidget(2, self.dithering)
+        self.draw_buttons_layout.insertWidget(3, self.dithering_frames)
+
+        sequence_layout = QHBoxLayout()
+        sequence_layout.addWidget(self.sequence)
+        sequence_layout.addWidget(self.pattern_size)
+        sequence_layout.addWidget(self.play_button)
+        sequence_layout.addWidget(self.sequence_status)
+        sequence_layout.addStretch()
+        self.layout().insertLayout(1, sequence_layout)
 
     def update_pixmap(self):
         super().update_pixmap()
         #self.DMD_update.emit(im2uint8(self.im_display))
 
+    def compile(self, key: int, mask: NDArray, method: str, num_frames: int) -> Tuple[NDArray, NDArray]:
+        '''
+        Binary pattern for a graded mask, computed once per mask and settings.
+        Returns the stacked frames and the first frame. The first frame is a 
+        view kept with the stack, so the same array is emitted on every 
+        expose and hits the DMD pixmap cache.
+        '''
+
+        # forget patterns of masks that were removed or replaced
+        masks = self.store.masks
+        self.compiled = {
+            k: v for k, v in self.compiled.items() 
+            if k[0] in masks and v[0] is masks[k[0]]
+        }
+        
+        cache_key = (key, method, num_frames)
+        if cache_key not in self.compiled:
+            frames = compile_pattern(mask, method, num_frames)
+            if method == 'temporal':
+                frames = pack_bitplanes(frames)
+            else:
+                frames = 255 * frames.astype(np.uint8)
+            self.compiled[cache_key] = (masks[key], frames, frames[0])
+        return self.compiled[cache_key][1:]
+
     def expose(self, key: int):
-        masks = self.get_masks()
-        visible, mask = masks[key]
+        mask = self.store.dense(key)
+        
+        method = self.dithering.currentText()
+        if method in DITHERING_METHODS:
+            frames, first = self.compile(key, mask, method, self.dithering_frames.value())
+            latency_probe.mark('mask')
+            if len(frames) == 1:
+                self.DMD_update.emit(first)
+            else:
+                self.DMD_sequence.emit(frames)
+            return
+
+        latency_probe.mark('mask')
         self.DMD_update.emit(mask)
         
+    def expose_bitplanes(self, keys: List[int]):
+        '''
+        Pack binary masks into the bit-planes of RGB frames, 24 masks per 
+        frame, and send them as a single frame or as a sequence
+        '''
+
+        if not keys:
+            return
+
+        frames = pack_bitplanes(np.stack([self.store.dense(key) for key in keys]))
+        if len(frames) == 1:
+            self.DMD_update.emit(frames[0])
+        else:
+            self.DMD_sequence.emit(frames)
+
+    def pattern_sequence(self, name: str, size: int) -> NDArray:
+        '''stacked frames of a stimulus sequence, size sets the spatial scale'''
+        
+        shape = tuple(self.get_image_size())
+        if name == 'checkerboard':
+            return pattern_bank.sequence(name, shape, size)
+        if name == 'drifting grating':
+            return pattern_bank.sequence(name, shape, size)
+        if name == 'sparse spots':
+            return pattern_bank.sequence(name, shape, size, size / 4)
+        if name == 'tiles':
+            return pattern_bank.sequence(name, shape, (max(shape[0] // size, 1), max(shape[1] // size, 1)))
+        raise ValueError(f'unknown sequence {name}')
+
+    def play_pattern_sequence(self):
+        try:
+            frames = self.pattern_sequence(self.sequence.currentText(), self.pattern_size.value())
+        except ValueError as error:
+            # e.g. too many tiles for a small pattern size
+            self.sequence_status.setText(f'sequence not played: {error}')
+            return
+        self.sequence_status.clear()
+        self.DMD_sequence.emit(frames)
+
+    def expose_masks(self, keys: List[int]):
+        '''expose several masks together as a single frame'''
+        self.expose_weighted(keys, [1.0] * len(keys))
+
+    def expose_weighted(self, keys: List[int], weights: List[float]):
+        '''
+        Expose several masks as a single frame, each scaled by its weight.
+        Each frame is a new array, never modified once sent.
+        '''
+
+        frame = self.engine.expose(self.get_ID(), keys, weights)
+        latency_probe.mark('mask')
+        self.DMD_update.emit(frame)
+
+    def expose_visible(self):
+        '''expose the composite of visible masks as a single frame'''
+        latency_probe.mark('mask')
+        self.DMD_update.emit(self.store.snapshot())
+
+    def expose_visible_bitplanes(self):
+        self.expose_bitplanes(sorted(key for key, visible in self.store.visible.items() if visible))
+
     def clear(self):
-        black = np.zeros(self.get_image_size(), np.uint8)
-        self.DMD_update.emit(black)
+        # reuse the same array so that the DMD can cache its pixmap
+        shape = tuple(self.get_image_size())
+        if self.black is None or self.black.shape != shape:
+            self.black = np.zeros(shape, np.uint8)
+        self.DMD_update.emit(self.black)
 
-class MaskItem(QWidget):
+class MaskListModel(QAbstractListModel):
+    '''
+    Keys, names and visibility of all masks. Bulk changes are applied as
+    a single model update, the view only renders the rows on screen.
+    '''
 
-    showClicked = pyqtSignal(int,int)
-    deletePressed = pyqtSignal(int)
-    maskExpose = pyqtSignal(int)
+    KeyRole = Qt.UserRole
+    MAX_REMOVE_RANGES = 64
 
-    def __init__(self, mask_index: int, name: Optional[str] = "name", *args, **kwargs):
+    visibility_changed = pyqtSignal(list, int)
 
+    def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self.mask_index = mask_index
-        self.name = name 
-        self.create_components()
-        self.layout_components()
+        self.keys = []
+        self.names = {}
+        self.visible = {}
+        self.weights = {} # intensity used when masks are exposed together
 
-    def create_components(self):
-        
-        self.show = QCheckBox(self)
-        self.show.setCheckState(Qt.Checked)
-        self.show.stateChanged.connect(self.show_clicked)
+    def rowCount(self, parent: QModelIndex = QModelIndex()) -> int:
+        return 0 if parent.isValid() else len(self.keys)
 
-        self.name_label = QLineEdit(self)
-        self.name_label.setText(self.name)
-        self.name_label.editingFinished.connect(self.change_name)
+    def data(self, index: QModelIndex, role: int = Qt.DisplayRole):
 
-        self.delete = QPushButton(self)
-        self.delete.setText('X')
-        self.delete.setMaximumWidth(25)
-        self.delete.pressed.connect(self.delete_clicked)
+        if not index.isValid():
+            return None
 
-        self.expose = QPushButton(self)
-        self.expose.setText('Expose')
-        self.expose.setMaximumWidth(75)
-        self.expose.pressed.connect(self.expose_clicked)
+        key = self.keys[index.row()]
+        if role == Qt.DisplayRole and self.weights[key] != 1:
+            return f'{self.names[key]} (x{self.weights[key]:.2f})'
+        if role in (Qt.DisplayRole, Qt.EditRole):
+            return self.names[key]
+        if role == Qt.CheckStateRole:
+            return Qt.Checked if self.visible[key] else Qt.Unchecked
+        if role == self.KeyRole:
+            return key
+        return None
 
-    def layout_components(self):
+    def setData(self, index: QModelIndex, value, role: int = Qt.EditRole) -> bool:
+
+        if not index.isValid():
+            return False
+
+        key = self.keys[index.row()]
+        if role == Qt.EditRole:
+            self.names[key] = str(value)
+        elif role == Qt.CheckStateRole:
+            visible = (value == Qt.Checked)
+            self.visible[key] = visible
+            self.visibility_changed.emit([key], visible)
+        else:
+            return False
+
+        self.dataChanged.emit(index, index, [role])
+        return True
+
+    def flags(self, index: QModelIndex):
+        return Qt.ItemIsEnabled | Qt.ItemIsSelectable | Qt.ItemIsEditable | Qt.ItemIsUserCheckable
+
+    def __contains__(self, key: int) -> bool:
+        return key in self.names
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    def key(self, row: int) -> int:
+        return self.keys[row]
+
+    def add_masks(self, keys: List[int], names: Optional[List[str]] = None):
+
+        keys = [key for key in keys if key not in self.names]
+        if not keys:
+            return
         
-        layout = QHBoxLayout(self)
-        layout.addWidget(self.show)
-        layout.addWidget(self.name_label)
-        layout.addWidget(self.delete)
-        layout.addWidget(self.expose)
-        layout.setContentsMargins(0,0,0,0)
-        layout.setSpacing(0)
-    
-    def change_name(self):
-        self.name = self.name_label.text()
+        if names is None:
+            names = [str(key) for key in keys]
+
+        first = len(self.keys)
+        self.beginInsertRows(QModelIndex(), first, first + len(keys) - 1)
+        self.keys.extend(keys)
+        self.names.update(zip(keys, names))
+        self.visible.update((key, True) for key in keys)
+        self.weights.update((key, 1.0) for key in keys)
+        self.endInsertRows()
+
+    def remove_masks(self, keys: List[int]):
+        '''
+        Rows are removed one contiguous range at a time, so that the view 
+        keeps its selection and scroll position. Scattered bulk deletions 
+        reset the model instead.
+        '''
+        
+        removed = set(keys) & set(self.names)
+        if not removed:
+            return
+
+        rows = [row for row, key in enumerate(self.keys) if key in removed]
+        ranges = []
+        for row in rows:
+            if ranges and ranges[-1][1] == row - 1:
+                ranges[-1][1] = row
+            else:
+                ranges.append([row, row])
+
+        if len(ranges) > self.MAX_REMOVE_RANGES:
+            self.beginResetModel()
+            self.keys = [key for key in self.keys if key not in removed]
+            self.endResetModel()
+        else:
+            # last range first, rows of the other ranges do not move
+            for first, last in reversed(ranges):
+                self.beginRemoveRows(QModelIndex(), first, last)
+                del self.keys[first:last+1]
+                self.endRemoveRows()
+
+        for key in removed:
+            self.names.pop(key)
+            self.visible.pop(key)
+            self.weights.pop(key)
 
-    def show_clicked(self):
-        visible = (self.show.checkState() == Qt.Checked)
-        self.showClicked.emit(self.mask_index, visible)
+    def clear(self):
+        self.beginResetModel()
+        self.keys = []
+        self.names = {}
+        self.visible = {}
+        self.weights = {}
+        self.endResetModel()
+
+    def set_weights(self, keys: List[int], weight: float):
+        
+        if not keys:
+            return
+        
+        for key in keys:
+            self.weights[key] = weight
+        self.dataChanged.emit(self.index(0), self.index(len(self.keys)-1), [Qt.DisplayRole])
 
-    def delete_clicked(self):
-        self.deletePressed.emit(self.mask_index)
+    def set_visible(self, keys: List[int], visible: bool):
+        '''change visibility of several masks and notify once'''
 
-    def expose_clicked(self):
-        self.maskExpose.emit(self.mask_index)
+        if not keys:
+            return
+        
+        for key in keys:
+            self.visible[key] = visible
+        self.visibility_changed.emit(list(keys), visible)
+        self.dataChanged.emit(self.index(0), self.index(len(self.keys)-1), [Qt.CheckStateRole])
+
+class MaskItemDelegate(QStyledItemDelegate):
+    '''
+    Paints the checkbox and name of a row, followed by delete and expose
+    buttons. The buttons are only painted, clicks are caught in 
+    editorEvent, so no widget is created per row.
+    '''
+
+    deletePressed = pyqtSignal(int)
+    maskExpose = pyqtSignal(int)
+
+    DELETE_WIDTH = 25
+    EXPOSE_WIDTH = 60
+
+    def button_rects(self, rect: QRect) -> Tuple[QRect, QRect]:
+        expose = QRect(rect.right() - self.EXPOSE_WIDTH + 1, rect.top(), self.EXPOSE_WIDTH, rect.height())
+        delete = QRect(expose.left() - self.DELETE_WIDTH, rect.top(), self.DELETE_WIDTH, rect.height())
+        return delete, expose
+
+    def paint(self, painter: QPainter, option: QStyleOptionViewItem, index: QModelIndex):
+
+        delete, expose = self.button_rects(option.rect)
+        
+        item = QStyleOptionViewItem(option)
+        item.rect = QRect(option.rect.left(), option.rect.top(), delete.left() - option.rect.left(), option.rect.height())
+        super().paint(painter, item, index)
+
+        style = option.widget.style() if option.widget else QApplication.style()
+        for rect, text in ((delete, 'X'), (expose, 'Expose')):
+            button = QStyleOptionButton()
+            button.rect = rect
+            button.text = text
+            button.state = QStyle.State_Enabled
+            style.drawControl(QStyle.CE_PushButton, button, painter)
+
+    def sizeHint(self, option: QStyleOptionViewItem, index: QModelIndex) -> QSize:
+        size = super().sizeHint(option, index)
+        return QSize(size.width() + self.DELETE_WIDTH + self.EXPOSE_WIDTH, max(size.height(), 22))
+
+    def updateEditorGeometry(self, editor: QWidget, option: QStyleOptionViewItem, index: QModelIndex):
+        # keep the name editor clear of the buttons
+        super().updateEditorGeometry(editor, option, index)
+        delete, expose = self.button_rects(option.rect)
+        geometry = editor.geometry()
+        geometry.setRight(delete.left() - 1)
+        editor.setGeometry(geometry)
+
+    def editorEvent(self, event, model, option: QStyleOptionViewItem, index: QModelIndex) -> bool:
+        
+        if event.type() == QEvent.MouseButtonRelease:
+            delete, expose = self.button_rects(option.rect)
+            key = index.data(MaskListModel.KeyRole)
+            if delete.contains(event.pos()):
+                self.deletePressed.emit(key)
+                return True
+            if expose.contains(event.pos()):
+                self.maskExpose.emit(key)
+                return True
+            
+        return super().editorEvent(event, model, option, index)
 
 class MaskManager(QWidget):
     
-    send_mask = pyqtSignal(int, int, np.ndarray)
-    delete_mask = pyqtSignal(int) 
-    flatten_mask = pyqtSignal()
-    clear_mask = pyqtSignal()
-    mask_visibility = pyqtSignal(int, int)
+    masks_changed = pyqtSignal(int)
     mask_expose = pyqtSignal(int)
+    masks_expose = pyqtSignal(list, list)
+    bitplane_expose = pyqtSignal()
+    visible_expose = pyqtSignal()
     clear_dmd = pyqtSignal()
 
     def __init__(
@@ -260,26 +543,29 @@ class MaskManager(QWidget):
     ):
         super().__init__(*args, **kwargs)
 
-        N = len(mask_drawers)
-        if not np.all(transformations.shape == np.array([N,N,3,3])):
-            raise ValueError(f"transformations should be a {[N,N,3,3]} array")
-
-        self.mask_widgets = {} 
         self.mask_drawers = mask_drawers
         self.mask_drawer_names = mask_drawer_names
-        self.transformations = transformations 
+        self.engine = MaskEngine(
+            [drawer.get_masks() for drawer in mask_drawers], 
+            mask_drawer_names, 
+            transformations
+        )
         self.create_components()
         self.layout_components()
 
         for idx, drawer in enumerate(self.mask_drawers):
             drawer.set_ID(idx)
+            drawer.set_engine(self.engine)
             drawer.mask_drawn.connect(self.on_mask_receive)
+            drawer.masks_drawn.connect(self.on_masks_receive)
+            self.masks_changed.connect(drawer.on_masks_changed)
+
+    @property
+    def transformations(self) -> NDArray:
+        return self.engine.transformations
 
-            self.send_mask.connect(drawer.on_mask_receive)
-            self.delete_mask.connect(drawer.on_mask_delete)
-            self.mask_visibility.connect(drawer.on_mask_visibility)
-            self.flatten_mask.connect(drawer.on_mask_flatten)
-            self.clear_mask.connect(drawer.on_mask_clear)
+    def set_transformations(self, transformations: NDArray):
+        self.engine.set_transformations(transformations)
 
     def create_components(self):
 
@@ -293,32 +579,106 @@ class MaskManager(QWidget):
         self.clear.setText('clear')
         self.clear.clicked.connect(self.on_clear_masks)
 
-        self.mask_frame = QFrame(self)
-        self.scroll_area = QScrollArea()
-        self.scroll_area.setWidget(self.mask_frame)
-        self.scroll_area.setWidgetResizable(True)
-        self.scroll_area.setVerticalScrollBarPolicy(Qt.ScrollBarAlwaysOn)
+        # mask library
+        self.save_button = QPushButton(self)
+        self.save_button.setText('save')
+        self.save_button.clicked.connect(self.on_save_masks)
+
+        self.load_button = QPushButton(self)
+        self.load_button.setText('load')
+        self.load_button.clicked.connect(self.on_load_masks)
+
+        # mask list, only rows on screen are painted
+        self.mask_model = MaskListModel(self)
+        self.mask_model.visibility_changed.connect(self.on_masks_visibility)
+
+        self.mask_delegate = MaskItemDelegate(self)
+        self.mask_delegate.deletePressed.connect(self.on_delete_mask)
+        self.mask_delegate.maskExpose.connect(self.on_mask_expose)
+
+        self.mask_view = QListView(self)
+        self.mask_view.setModel(self.mask_model)
+        self.mask_view.setItemDelegate(self.mask_delegate)
+        self.mask_view.setUniformItemSizes(True)
+        self.mask_view.setSelectionMode(QAbstractItemView.ExtendedSelection)
+        self.mask_view.setEditTriggers(QAbstractItemView.DoubleClicked | QAbstractItemView.EditKeyPressed)
+        self.mask_view.setVerticalScrollBarPolicy(Qt.ScrollBarAlwaysOn)
+
+        # bulk operations on the selection
+        self.select_all = QPushButton(self)
+        self.select_all.setText('select all')
+        self.select_all.clicked.connect(self.mask_view.selectAll)
+
+        self.show_selected = QPushButton(self)
+        self.show_selected.setText('show')
+        self.show_selected.clicked.connect(lambda: self.on_selection_visibility(True))
+
+        self.hide_selected = QPushButton(self)
+        self.hide_selected.setText('hide')
+        self.hide_selected.clicked.connect(lambda: self.on_selection_visibility(False))
+
+        self.expose_selected = QPushButton(self)
+        self.expose_selected.setText('expose selection')
+        self.expose_selected.clicked.connect(self.on_selection_expose)
+
+        self.delete_selected = QPushButton(self)
+        self.delete_selected.setText('delete selection')
+        self.delete_selected.clicked.connect(self.on_selection_delete)
+
+        # per-mask intensity when exposing a selection
+        self.intensity = QDoubleSpinBox(self)
+        self.intensity.setRange(0, 1)
+        self.intensity.setSingleStep(0.05)
+        self.intensity.setValue(1)
+
+        self.intensity_button = QPushButton(self)
+        self.intensity_button.setText('set intensity')
+        self.intensity_button.clicked.connect(self.on_selection_intensity)
 
         # clear dmd 
         self.clear_dmd_button = QPushButton(self)
         self.clear_dmd_button.setText('clear DMD')
         self.clear_dmd_button.clicked.connect(self.clear_dmd)
 
+        # expose visible masks together
+        self.visible_button = QPushButton(self)
+        self.visible_button.setText('expose visible')
+        self.visible_button.clicked.connect(self.visible_expose)
+
+        # expose visible masks as bit-planes 
+        self.bitplane_button = QPushButton(self)
+        self.bitplane_button.setText('expose bit-planes')
+        self.bitplane_button.clicked.connect(self.bitplane_expose)
 
     def layout_components(self):
 
         mask_buttons_layout = QHBoxLayout()
         mask_buttons_layout.addWidget(self.clear)
         mask_buttons_layout.addWidget(self.flatten)
+        mask_buttons_layout.addWidget(self.save_button)
+        mask_buttons_layout.addWidget(self.load_button)
+
+        selection_layout = QHBoxLayout()
+        selection_layout.addWidget(self.select_all)
+        selection_layout.addWidget(self.show_selected)
+        selection_layout.addWidget(self.hide_selected)
 
-        self.frame_layout = QVBoxLayout(self.mask_frame)
-        self.frame_layout.addStretch()
-        self.frame_layout.setContentsMargins(0,0,0,0)
-        self.frame_layout.setSpacing(0)
+        intensity_layout = QHBoxLayout()
+        intensity_layout.addWidget(self.intensity)
+        intensity_layout.addWidget(self.intensity_button)
+
+        selection_actions_layout = QHBoxLayout()
+        selection_actions_layout.addWidget(self.expose_selected)
+        selection_actions_layout.addWidget(self.delete_selected)
 
         mask_controls = QVBoxLayout()
         mask_controls.addLayout(mask_buttons_layout)
-        mask_controls.addWidget(self.scroll_area)
+        mask_controls.addWidget(self.mask_view)
+        mask_controls.addLayout(selection_layout)
+        mask_controls.addLayout(intensity_layout)
+        mask_controls.addLayout(selection_actions_layout)
+        mask_controls.addWidget(self.visible_button)
+        mask_controls.addWidget(self.bitplane_button)
         mask_controls.addWidget(self.clear_dmd_button)
 
         tabs = QTabWidget()
@@ -329,74 +689,102 @@ class MaskManager(QWidget):
         layout.addWidget(tabs)
         layout.addLayout(mask_controls)
 
-    def on_mask_receive(self, drawer_ID: int, key: int, mask: NDArray):
+    def on_mask_receive(self, drawer_ID: int, mask: NDArray):
+        self.on_masks_receive(drawer_ID, [mask])
 
-        # transform and send to other drawers
-        for idx, drawer in enumerate(self.mask_drawers):
+    def on_masks_receive(self, drawer_ID: int, masks: list):
 
-            # don't send to yourself
-            if not idx == drawer_ID:
-
-                T = self.transformations[drawer_ID, idx, :2, :]
-                shape = drawer.get_image_size()
-                dsize = shape[::-1] # opencv expects (col, rows)
-                mask_transformed = cv2.warpAffine(mask, T, dsize)
-                self.send_mask.emit(idx, key, mask_transformed)
-                
-        # add widget 
-        widget = MaskItem(key, str(key))
-        widget.showClicked.connect(self.on_mask_visibility)
-        widget.deletePressed.connect(self.on_delete_mask)
-        widget.maskExpose.connect(self.on_mask_expose)
-        self.mask_widgets[key] = widget
-        self.frame_layout.insertWidget(self.frame_layout.count()-1, widget)
+        # new keys, stored in the drawer's space and transferred to the others
+        keys = self.engine.create(drawer_ID, masks)
+        self.mask_model.add_masks(keys)
+        self.masks_changed.emit(-1)
 
-    def on_delete_mask(self, key: int):
+    def save_masks(self, filename: str) -> int:
+        return self.engine.save(filename, self.mask_model.names)
 
-        # delete widget
-        widget = self.mask_widgets.pop(key)
-        self.frame_layout.removeWidget(widget)
-        widget.deleteLater()
+    def load_masks(self, filename: str) -> List[int]:
 
-        # propagate to connected widgets
-        self.delete_mask.emit(key)
+        loaded = self.engine.load(filename)
+        keys = [key for key, entry in loaded]
+        self.mask_model.add_masks(keys, [entry.name for key, entry in loaded])
 
-    def on_mask_expose(self, key: int):
-        self.mask_expose.emit(key)
+        # the engine already hid them, only the model needs updating
+        self.mask_model.blockSignals(True)
+        self.mask_model.set_visible([key for key, entry in loaded if not entry.visible], False)
+        self.mask_model.blockSignals(False)
 
-    def on_mask_visibility(self, key: int, visibility: bool):
+        self.masks_changed.emit(-1)
+        return keys
 
-        # propagate to connected widgets
-        self.mask_visibility.emit(key, visibility)
+    def on_save_masks(self):
+        filename, _ = QFileDialog.getSaveFileName(self, 'Save masks', '', 'Mask library (*.masks)')
+        if filename:
+            self.save_masks(filename)
 
-    def on_clear_masks(self):
+    def on_load_masks(self):
+        filename, _ = QFileDialog.getOpenFileName(self, 'Load masks', '', 'Mask library (*.masks)')
+        if filename:
+            self.load_masks(filename)
 
-        self.clear_mask.emit()
+    def selected_keys(self) -> List[int]:
+        rows = sorted(index.row() for index in self.mask_view.selectionModel().selectedRows())
+        return [self.mask_model.key(row) for row in rows]
 
-        for key, widget in self.mask_widgets.items():
-            # delete widget
-            self.frame_layout.removeWidget(widget)
-            widget.deleteLater()
+    def on_delete_mask(self, key: int):
+        self.delete_keys([key])
 
-        self.mask_widgets = {}
+    def on_selection_delete(self):
+        self.delete_keys(self.selected_keys())
 
-    def on_flatten_mask(self):
+    def delete_keys(self, keys: List[int]):
+        
+        if keys:
+            self.mask_model.remove_masks(keys)
+            self.engine.delete(keys)
+            self.masks_changed.emit(-1)
 
-        if self.mask_widgets:
+    def on_selection_visibility(self, visibility: bool):
+        # propagated through the model's visibility_changed signal
+        self.mask_model.set_visible(self.selected_keys(), visibility)
 
-            self.flatten_mask.emit()
+    def on_masks_visibility(self, keys: list, visibility: bool):
+        self.engine.set_visible(keys, visibility)
+        self.masks_changed.emit(-1)
 
-            # remove widgets
-            for key, widget in self.mask_widgets.items():
-                self.frame_layout.removeWidget(widget)
-                widget.deleteLater()
-            self.mask_widgets = {}
+    def on_selection_intensity(self):
+        self.mask_model.set_weights(self.selected_keys(), self.intensity.value())
+
+    def on_selection_expose(self):
+
+        keys = self.selected_keys()
+        if not keys:
+            return
+        
+        weights = [self.mask_model.weights[key] for key in keys]
+        latency_probe.start('expose')
+        if len(keys) == 1 and weights[0] == 1:
+            self.mask_expose.emit(keys[0])
+        else:
+            self.masks_expose.emit(keys, weights)
+
+    def on_mask_expose(self, key: int):
+        latency_probe.start('expose')
+        self.mask_expose.emit(key)
+
+    def on_mask_visibility(self, key: int, visibility: bool):
+        self.on_masks_visibility([key], visibility)
+
+    def on_clear_masks(self):
+
+        self.engine.clear()
+        self.mask_model.clear()
+        self.masks_changed.emit(-1)
+
+    def on_flatten_mask(self):
 
-            # update widget
-            widget = MaskItem(1, "flat")
-            widget.showClicked.connect(self.on_mask_visibility)
-            widget.deletePressed.connect(self.on_delete_mask)
-            widget.maskExpose.connect(self.on_mask_expose)
-            self.frame_layout.insertWidget(self.frame_layout.count()-1, widget)
-            self.mask_widgets[1] = widget
+        if len(self.mask_model):
 
+            self.engine.flatten(key=1)
+            self.mask_model.clear()
+            self.mask_model.add_masks([1], ["flat"])
+            self.masks_changed.emit(-1)
\ No newline at end of file
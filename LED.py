@@ -1,9 +1,9 @@
 from daq import DigitalAnalogIO
-import time
+from Waveform import DeadlineClock, WaveformPlayer, schedule
 from PyQt5.QtCore import QRunnable, QThreadPool
 from PyQt5.QtWidgets import QPushButton, QLabel, QVBoxLayout, QHBoxLayout, QWidget
 from qt_widgets import LabeledSliderSpinBox, LabeledSpinBox
-from typing import Protocol, List
+from typing import Protocol, List, Iterable, Tuple
 
 class LEDDriver(Protocol):
     
@@ -19,6 +19,9 @@ class LEDDriver(Protocol):
     def pulse(self, duration_ms: int) -> None:
         ...
 
+    def train(self, frequency: float, pulse_ms: float, duration_s: float) -> bool:
+        ...
+
 class PulseSender(QRunnable):
 
     def __init__(
@@ -39,8 +42,12 @@ class PulseSender(QRunnable):
         self.pwm_frequency = pwm_frequency
 
     def run(self):
+        # the pulse ends on a deadline taken before the first call, so the
+        # DAIO latency does not lengthen it
+        clock = DeadlineClock()
+        start = clock.now()
         self.DAIO.pwm(channel=self.pwm_channel, duty_cycle=self.duty_cycle, frequency=self.pwm_frequency)
-        time.sleep(self.pulse_duration_ms/1000.0)
+        clock.wait_until(start + self.pulse_duration_ms/1000.0)
         self.DAIO.pwm(channel=self.pwm_channel, duty_cycle=0, frequency=self.pwm_frequency)
 
 
@@ -53,6 +60,10 @@ class LEDD1B:
     - LEDD1B switched to TRIG: LED brightness controlled via the knob on the device,
         can use PWM frequency to flash the light at set brightness at a given frequency. 
         Intensity controls the duty cycle
+
+    While a train or schedule plays, the waveform player owns the output:
+    intensity and frequency changes apply to the next train, on() stops
+    the train and pulse() is refused.
     '''
 
     def __init__(
@@ -70,6 +81,7 @@ class LEDD1B:
         self.intensity = 1
         self.started = False
         self.thread_pool = QThreadPool()
+        self.waveform = WaveformPlayer(DAIO, pwm_channel, pwm_frequency)
 
     def set_intensity(self, intensity: float) -> None:
 
@@ -86,16 +98,22 @@ class LEDD1B:
             self.DAIO.pwm(channel=self.pwm_channel, duty_cycle=self.intensity, frequency=self.pwm_frequency)
     
     def on(self):
+        if self.waveform.is_running():
+            self.waveform.stop()
         self.started = True
         self.DAIO.pwm(channel=self.pwm_channel, duty_cycle=self.intensity, frequency=self.pwm_frequency)
 
     def off(self):
+        if self.waveform.is_running():
+            self.waveform.stop()
         self.DAIO.pwm(channel=self.pwm_channel, duty_cycle=0, frequency=self.pwm_frequency)
         self.started = False
 
     def pulse(self, duration_ms: int = 1000):
         if self.started:
             raise RuntimeError('Already ON')
+        if self.waveform.is_running():
+            raise RuntimeError('a train is playing')
 
         pulse_sender = PulseSender(
             self.DAIO, 
@@ -106,6 +124,25 @@ class LEDD1B:
         )
         self.thread_pool.start(pulse_sender)
 
+    def train(self, frequency: float, pulse_ms: float, duration_s: float) -> bool:
+        '''
+        Pulse train at the current intensity. Returns True if the train
+        runs on the DAIO hardware timer.
+        '''
+        if self.started:
+            raise RuntimeError('Already ON')
+
+        self.waveform.pwm_frequency = self.pwm_frequency
+        return self.waveform.play_train(frequency, pulse_ms, duration_s, self.intensity)
+
+    def play_schedule(self, events: Iterable[Tuple[float, float]]) -> None:
+        '''arbitrary (time_s, intensity) schedule'''
+        if self.started:
+            raise RuntimeError('Already ON')
+
+        self.waveform.pwm_frequency = self.pwm_frequency
+        self.waveform.play(schedule(events))
+
 
 
 class DriverWidget(QWidget):
@@ -152,6 +189,26 @@ class DriverWidget(QWidget):
         self.pulse_button.setText('pulse')
         self.pulse_button.clicked.connect(self.pulse)
 
+        self.train_freq_spinbox = LabeledSpinBox(self)
+        self.train_freq_spinbox.setText('train frequency (Hz)')
+        self.train_freq_spinbox.setRange(1, 500)
+        self.train_freq_spinbox.setValue(20)
+        self.train_freq_spinbox.valueChanged.connect(self.set_train_frequency)
+
+        self.train_pulse_spinbox = LabeledSpinBox(self)
+        self.train_pulse_spinbox.setText('train pulse width (ms)')
+        self.train_pulse_spinbox.setRange(1, 49)
+        self.train_pulse_spinbox.setValue(5)
+
+        self.train_duration_spinbox = LabeledSpinBox(self)
+        self.train_duration_spinbox.setText('train duration (s)')
+        self.train_duration_spinbox.setRange(1, 3600)
+        self.train_duration_spinbox.setValue(1)
+
+        self.train_button = QPushButton(self)
+        self.train_button.setText('train')
+        self.train_button.clicked.connect(self.train)
+
     def layout_components(self):
          
         main_layout = QHBoxLayout(self)
@@ -163,6 +220,10 @@ class DriverWidget(QWidget):
         main_layout.addWidget(self.pulse_spinbox)
         main_layout.addWidget(self.freq_spinbox)
         main_layout.addWidget(self.pulse_button)
+        main_layout.addWidget(self.train_freq_spinbox)
+        main_layout.addWidget(self.train_pulse_spinbox)
+        main_layout.addWidget(self.train_duration_spinbox)
+        main_layout.addWidget(self.train_button)
         main_layout.addStretch()
 
     def set_frequency(self, val: int):
@@ -178,7 +239,25 @@ class DriverWidget(QWidget):
         self.driver.off()
 
     def pulse(self):
-        self.driver.pulse(duration_ms=self.pulse_spinbox.value())
+        try:
+            self.driver.pulse(duration_ms=self.pulse_spinbox.value())
+        except RuntimeError as error:
+            print(f'{self.driver.name}: pulse not sent: {error}')
+
+    def set_train_frequency(self, val: int):
+        # pulses must be shorter than the period
+        self.train_pulse_spinbox.setRange(1, max(1, -(-1000 // val) - 1))
+
+    def train(self):
+        try:
+            self.driver.train(
+                frequency=self.train_freq_spinbox.value(),
+                pulse_ms=self.train_pulse_spinbox.value(),
+                duration_s=self.train_duration_spinbox.value()
+            )
+        except (ValueError, RuntimeError) as error:
+            # e.g. already playing, LED on, pulses too short for the DAIO
+            print(f'{self.driver.name}: train not played: {error}')
 
 
 class LEDWidget(QWidget):
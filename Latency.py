@@ -0,0 +1,234 @@
+import time
+import queue
+import threading
+import numpy as np
+from numpy.typing import NDArray
+from collections import OrderedDict
+from typing import Optional, Dict, List, Tuple, TYPE_CHECKING
+
+# daq needs the device drivers (u3, pyfirmata), only for annotations here:
+# DMD imports this module and must work without a DAQ
+if TYPE_CHECKING:
+    from daq import DigitalAnalogIO
+
+class Photodiode:
+    '''
+    Photodiode read through an analog input. Note that analogRead on the 
+    LabJack disables the timers: the photodiode needs its own device, not
+    the one driving the LED PWM. Reads go through the device lock, the 
+    photodiode is polled from a background thread.
+    '''
+
+    def __init__(self, DAIO: 'DigitalAnalogIO', channel: int = 0, threshold: float = 0.5, timeout: float = 1.0) -> None:
+        self.DAIO = DAIO
+        self.channel = channel
+        self.threshold = threshold
+        self.timeout = timeout
+        self.lock = getattr(DAIO, 'lock', None) or threading.RLock()
+
+    def read(self) -> float:
+        with self.lock:
+            return self.DAIO.analogRead(self.channel)
+
+    def wait(self, light: bool = True) -> Optional[float]:
+        '''
+        Poll until the signal crosses the threshold (going up if light, 
+        down otherwise), return the time of the crossing or None on timeout
+        '''
+
+        start = time.perf_counter()
+        while time.perf_counter() - start < self.timeout:
+            if (self.read() > self.threshold) == light:
+                return time.perf_counter()
+        return None
+
+class LatencyProbe:
+    '''
+    Timestamp the stages of the expose path with a monotonic clock 
+    (perf_counter). 
+
+    start() opens a trace, mark() adds a stage to the current trace and 
+    end() adds the last stage and closes it. The expose path 
+    (MaskManager -> DrawPolyMaskOptoDMD -> DMD) runs synchronously in the
+    GUI thread, so marks belong to the last trace started. Marks made 
+    once the trace is closed (e.g. clearing the DMD) are ignored.
+
+    With a photodiode, a background thread waits for the light to go off
+    then on after each start() and adds a 'light' stage to the trace. 
+    Traces are shared with that thread under a lock.
+
+    Marks cost nothing when the probe is disabled.
+    '''
+
+    def __init__(self, max_traces: int = 10_000) -> None:
+        self.enabled = False
+        self.max_traces = max_traces
+        self.traces = OrderedDict() # trace id -> list of (stage, time)
+        self.lock = threading.Lock()
+        self.current = None
+        self.num_traces = 0
+        self.photodiode = None
+        self.photodiode_queue = queue.Queue()
+        self.photodiode_thread = None
+
+    def set_photodiode(self, photodiode: Optional[Photodiode]) -> None:
+        self.photodiode = photodiode
+        if photodiode is not None and self.photodiode_thread is None:
+            self.photodiode_thread = threading.Thread(target=self.watch_photodiode, daemon=True)
+            self.photodiode_thread.start()
+
+    def start(self, stage: str = 'start') -> Optional[int]:
+        
+        if not self.enabled:
+            return None
+        
+        with self.lock:
+            trace = self.num_traces
+            self.num_traces += 1
+            self.current = trace
+            self.traces[trace] = [(stage, time.perf_counter())]
+            if len(self.traces) > self.max_traces:
+                self.traces.popitem(last=False)
+
+        if self.photodiode is not None:
+            self.photodiode_queue.put(trace)
+
+        return trace
+
+    def mark(self, stage: str, trace: Optional[int] = None, timestamp: Optional[float] = None) -> None:
+
+        if not self.enabled:
+            return
+        
+        if timestamp is None:
+            timestamp = time.perf_counter()
+        
+        with self.lock:
+            if trace is None:
+                trace = self.current
+            if trace in self.traces:
+                self.traces[trace].append((stage, timestamp))
+
+    def end(self, stage: str) -> None:
+        '''add the last stage of the current trace and close it'''
+
+        if not self.enabled:
+            return
+
+        self.mark(stage)
+        with self.lock:
+            self.current = None
+
+    def watch_photodiode(self) -> None:
+        while True:
+            trace = self.photodiode_queue.get()
+            photodiode = self.photodiode
+            if photodiode is None:
+                continue
+            # time the dark to light edge: if the DMD stays lit, there is 
+            # no edge and the trace gets no light stage
+            if photodiode.wait(light=False) is None:
+                continue
+            light_time = photodiode.wait(light=True)
+            if light_time is not None:
+                self.mark('light', trace, light_time)
+
+    def clear(self) -> None:
+        with self.lock:
+            self.traces.clear()
+            self.current = None
+
+    def get_latencies(self) -> Dict[str, NDArray]:
+        '''
+        Latencies (s) between consecutive stages, named 'stage0 -> stage1', 
+        and from the first to the last stage of complete traces ('total')
+        '''
+
+        with self.lock:
+            traces = [list(t) for t in self.traces.values() if len(t) > 1]
+        if not traces:
+            return {}
+        
+        # only use traces with the most common sequence of stages
+        stages, counts = np.unique([' '.join(s for s, _ in t) for t in traces], return_counts=True)
+        sequence = stages[np.argmax(counts)].split(' ')
+        times = np.array([[ts for _, ts in t] for t in traces if [s for s, _ in t] == sequence])
+        
+        latencies = {}
+        for i in range(len(sequence)-1):
+            latencies[f'{sequence[i]} -> {sequence[i+1]}'] = times[:,i+1] - times[:,i]
+        latencies['total'] = times[:,-1] - times[:,0]
+        return latencies
+
+    def get_histograms(self, bin_ms: float = 0.5) -> Dict[str, Tuple[NDArray, NDArray]]:
+        '''histograms (counts, bin edges in ms) of get_latencies'''
+
+        histograms = {}
+        for name, latency in self.get_latencies().items():
+            latency_ms = 1000*latency
+            edges = np.arange(0, latency_ms.max() + bin_ms, bin_ms)
+            if edges.size < 2:
+                edges = np.array([0, bin_ms])
+            histograms[name] = np.histogram(latency_ms, bins=edges)
+        return histograms
+
+    def report(self) -> str:
+
+        lines = []
+        for name, latency in self.get_latencies().items():
+            latency_ms = 1000*latency
+            p50, p95, p99 = np.percentile(latency_ms, [50, 95, 99])
+            lines.append(
+                f'{name:<30} n={latency_ms.size:<6} median {p50:7.3f} ms, '
+                f'95% {p95:7.3f} ms, 99% {p99:7.3f} ms, max {latency_ms.max():7.3f} ms'
+            )
+        return '\n'.join(lines)
+
+# shared by the modules on the expose path
+latency_probe = LatencyProbe()
+
+def measure_dmd_latency(
+        dmd_widget, 
+        photodiode: Photodiode, 
+        num_trials: int = 100, 
+        patch_size: int = 64
+    ) -> LatencyProbe:
+    '''
+    Flash a white sync patch in the top left corner of the DMD and read it
+    back with a photodiode placed in the light path of that patch. Each 
+    trial is a new array, so conversion is included (no cache hit).
+    Blocks the GUI thread while running.
+    '''
+
+    probe = LatencyProbe()
+    probe.enabled = True
+    height, width = dmd_widget.screen_height, dmd_widget.screen_width
+    black = np.zeros((height, width), np.uint8)
+
+    previous = latency_probe.enabled
+    latency_probe.enabled = False
+
+    for trial in range(num_trials):
+
+        # back to dark
+        dmd_widget.update_image(black)
+        dmd_widget.img_label.repaint()
+        photodiode.wait(light=False)
+
+        patch = np.zeros((height, width), np.uint8)
+        patch[:patch_size,:patch_size] = 255
+
+        probe.start('start')
+        pixmap = dmd_widget.get_pixmap(patch)
+        probe.mark('convert')
+        dmd_widget.img_label.setPixmap(pixmap)
+        probe.mark('set_pixmap')
+        dmd_widget.img_label.repaint()
+        probe.mark('painted')
+        light_time = photodiode.wait(light=True)
+        if light_time is not None:
+            probe.mark('light', timestamp=light_time)
+
+    dmd_widget.update_image(black)
+    latency_probe.enabled = previous
+    return probe
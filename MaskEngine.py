@@ -0,0 +1,257 @@
+import os
+import numpy as np
+from numpy.typing import NDArray
+from typing import List, Dict, Optional, Tuple, Iterable, Union
+from MaskStorage import MaskStore, CompactMask, DeferredMask
+from MaskTransform import MaskTransformer, transfer_masks
+from MaskLibrary import MaskLibrary, LibraryEntry, LazyMask, save_library, calibration_version
+
+class MaskEngine:
+    '''
+    Masks of all coordinate spaces (camera, DMD, two-photon, ...) without
+    any Qt dependency. A mask is added in the space it was drawn in and
+    transferred to the other spaces with the calibration. Each space has
+    its own MaskStore, which the drawer widgets display.
+
+    All operations take lists of keys so that bulk operations are done in
+    one call, from the GUI or from scripts.
+
+    Loaded libraries stay open: their masks are read from the file and 
+    transferred to the other spaces only when they are exposed or 
+    displayed (see MaskStore).
+    '''
+
+    def __init__(
+            self,
+            stores: List[MaskStore],
+            space_names: List[str],
+            transformations: NDArray
+        ) -> None:
+
+        N = len(stores)
+        if transformations.shape != (N, N, 3, 3):
+            raise ValueError(f"transformations should be a {[N,N,3,3]} array")
+
+        self.stores = stores
+        self.space_names = space_names
+        self.transformations = transformations
+        self.transformer = MaskTransformer(transformations)
+        self.sources = {} # key -> index of the space the mask was drawn in
+        self.libraries = {} # path -> open MaskLibrary
+
+    @classmethod
+    def from_shapes(
+            cls,
+            shapes: List[Tuple[int, int]],
+            space_names: List[str],
+            transformations: NDArray
+        ) -> 'MaskEngine':
+        return cls([MaskStore(shape) for shape in shapes], space_names, transformations)
+
+    def __len__(self) -> int:
+        return len(self.sources)
+
+    def keys(self) -> List[int]:
+        return list(self.sources.keys())
+
+    def next_key(self) -> int:
+        return max([store.max_key() for store in self.stores] + [0]) + 1
+
+    def set_transformations(self, transformations: NDArray) -> None:
+        self.transformations = transformations
+        self.transformer.set_transformations(transformations)
+
+    def create(self, space: int, masks: List[Union[NDArray, CompactMask]]) -> List[int]:
+        '''add new masks drawn in one space under new keys, returns the keys'''
+
+        first = self.next_key()
+        keys = list(range(first, first + len(masks)))
+        self.add(space, keys, masks)
+        return keys
+
+    def add(
+            self, 
+            space: int, 
+            keys: List[int], 
+            masks: List[Union[NDArray, CompactMask]], 
+            defer: bool = False
+        ) -> None:
+        '''add masks drawn in one space, and transfer them to the others'''
+
+        store = self.stores[space]
+        masks = [store.add(key, mask) for key, mask in zip(keys, masks)]
+        self.transfer(space, keys, masks, defer)
+
+    def transfer(
+            self, 
+            space: int, 
+            keys: List[int], 
+            masks: List[CompactMask], 
+            defer: bool = False
+        ) -> None:
+        '''
+        Transfer masks that are already in the store of their source space
+        to the other spaces. With defer, masks are transferred when they 
+        are first needed, all the pending masks of a space at once.
+        '''
+
+        for idx, store in enumerate(self.stores):
+            if idx == space:
+                continue
+            if defer:
+                resolver = self.deferred_transfer(space, idx, store.shape)
+                transformed = [DeferredMask(mask, resolver) for mask in masks]
+            else:
+                transformed = transfer_masks(masks, space, idx, store.shape, self.transformer)
+            for key, mask in zip(keys, transformed):
+                store.add(key, mask)
+
+        self.sources.update((key, space) for key in keys)
+
+    def deferred_transfer(self, src: int, dst: int, shape: Tuple[int, int]):
+        '''resolver of DeferredMask transferring a batch from src to dst'''
+
+        def resolve(masks: List[DeferredMask]) -> None:
+            transferred = transfer_masks([mask.source for mask in masks], src, dst, shape, self.transformer)
+            for mask, result in zip(masks, transferred):
+                mask.set(result)
+
+        return resolve
+
+    def delete(self, keys: Iterable[int]) -> None:
+        for key in keys:
+            for store in self.stores:
+                if key in store:
+                    store.delete(key)
+            self.sources.pop(key, None)
+
+    def set_visible(self, keys: Iterable[int], visible: bool) -> None:
+        for key in keys:
+            for store in self.stores:
+                if key in store:
+                    store.set_visible(key, visible)
+
+    def clear(self) -> None:
+        for store in self.stores:
+            store.clear()
+        self.sources = {}
+        self.close()
+
+    def flatten(self, key: int = 1) -> None:
+        '''replace all masks by their sum, in each space'''
+
+        if not self.sources:
+            return
+
+        for store in self.stores:
+            store.flatten(key)
+        self.sources = {key: 0}
+
+    def composite(self, space: int) -> NDArray:
+        return self.stores[space].composite()
+
+    def expose(
+            self,
+            space: int,
+            keys: List[int],
+            weights: Optional[List[float]] = None,
+            out: Optional[NDArray] = None
+        ) -> NDArray:
+        '''weighted sum of masks in one space, clipped to [0, 1]'''
+
+        if weights is None:
+            weights = [1.0] * len(keys)
+        frame = self.stores[space].weighted_sum(keys, weights, out)
+        return np.clip(frame, 0, 1, out=frame)
+
+    def save(self, filename: str, names: Optional[Dict[int, str]] = None) -> int:
+        '''save masks in the space they were drawn in, with their name and visibility'''
+
+        # the file of an open library cannot be replaced (Windows)
+        self.close_library(filename)
+
+        names = names or {}
+        entries = []
+        for key, source in self.sources.items():
+            store = self.stores[source]
+            entries.append((
+                key,
+                names.get(key, str(key)),
+                self.space_names[source],
+                store.visible[key],
+                store.masks[key]
+            ))
+        return save_library(filename, entries, calibration_version(self.transformations))
+
+    def load(self, filename: str) -> List[Tuple[int, LibraryEntry]]:
+        '''
+        Add the masks of a library to the current ones. Masks are placed in
+        their source space and transferred to the others with the current
+        calibration. Keys are shifted past the keys in use.
+        Returns the new key of each loaded entry.
+        Only the index is read: the library stays open and masks are read
+        and transferred when needed. Saving over the file closes it.
+        '''
+
+        self.close_library(filename)
+        library = MaskLibrary(filename)
+        self.libraries[os.path.abspath(filename)] = library
+
+        calibrations = library.calibrations()
+        if calibrations and calibrations != [calibration_version(self.transformations)]:
+            print(f'{filename}: masks were saved with a different calibration, they are transferred with the current one')
+
+        next_key = self.next_key()
+        loaded = []
+        for space, name in enumerate(self.space_names):
+
+            group = library.masks(name)
+            if not group:
+                continue
+
+            keys = list(range(next_key, next_key + len(group)))
+            next_key += len(group)
+            self.add(space, keys, [mask for entry, mask in group], defer=True)
+            self.set_visible([key for key, (entry, mask) in zip(keys, group) if not entry.visible], False)
+            loaded.extend((key, entry) for key, (entry, mask) in zip(keys, group))
+
+        return loaded
+
+    def close_library(self, filename: str) -> None:
+        '''read the remaining masks of a library into memory and close it'''
+
+        library = self.libraries.pop(os.path.abspath(filename), None)
+        if library is None:
+            return
+
+        for store in self.stores:
+            for mask in store.masks.values():
+                if isinstance(mask, DeferredMask) and not mask.ready:
+                    mask = mask.source
+                if isinstance(mask, LazyMask) and mask.library is library:
+                    mask.load()
+        library.close()
+
+    def close(self) -> None:
+        '''close the loaded libraries, their masks are read into memory'''
+        for filename in list(self.libraries):
+            self.close_library(filename)
+
+    def check_consistency(self) -> bool:
+        '''every mask is in every space and the running composites are right'''
+
+        keys = set(self.sources)
+        for store in self.stores:
+            if set(store.keys()) != keys or not store.check_consistency():
+                return False
+        return True
+
+    def get_statistics(self) -> Dict:
+        return {
+            'masks': len(self.sources),
+            'spaces': {
+                name: store.get_statistics()
+                for name, store in zip(self.space_names, self.stores)
+            },
+            'open_libraries': len(self.libraries)
+        }
\ No newline at end of file
@@ -0,0 +1,200 @@
+import os
+import zlib
+import mmap
+import json
+import struct
+import hashlib
+import numpy as np
+from numpy.typing import NDArray
+from typing import List, Dict, Iterable, NamedTuple, Optional, Tuple
+from MaskStorage import CompactMask
+
+# file layout:
+#   header: magic, version, index offset, index size
+#   zlib-compressed mask data, one blob per mask
+#   index: utf-8 JSON list, one entry per mask
+MAGIC = b'OMLB'
+VERSION = 1
+HEADER = '<4sIQQ'
+HEADER_SIZE = struct.calcsize(HEADER)
+
+def calibration_version(transformations: NDArray) -> str:
+    '''short hash identifying a set of transformations'''
+    data = np.ascontiguousarray(transformations, dtype=np.float64).data
+    return hashlib.blake2b(data, digest_size=8).hexdigest()
+
+class LibraryEntry(NamedTuple):
+    key: int
+    name: str
+    space: str
+    shape: Tuple[int, int]
+    bbox: Tuple[int, int, int, int]
+    binary: bool
+    visible: bool
+    calibration: str
+    offset: int
+    size: int
+
+class LazyMask(CompactMask):
+    '''
+    CompactMask whose data stays in the library file until the crop is
+    needed (exposure, composite, transformation).
+    '''
+
+    __slots__ = ('library', 'entry')
+
+    def __init__(self, library: 'MaskLibrary', entry: LibraryEntry) -> None:
+        super().__init__(entry.shape, entry.bbox, entry.binary, None)
+        self.library = library
+        self.entry = entry
+
+    @property
+    def loaded(self) -> bool:
+        return self.data is not None
+
+    @property
+    def ready(self) -> bool:
+        return self.loaded
+
+    def load(self) -> None:
+        if self.data is None:
+            self.data = self.library.read_data(self.entry)
+
+    @property
+    def nbytes(self) -> int:
+        return 0 if self.data is None else self.data.nbytes
+
+    def bits(self) -> NDArray:
+        self.load()
+        return super().bits()
+
+    def crop(self) -> NDArray:
+        self.load()
+        return super().crop()
+
+def save_library(
+        path: str,
+        masks: Iterable[Tuple[int, str, str, bool, CompactMask]],
+        calibration: str = ''
+    ) -> int:
+    '''
+    Write (key, name, space, visible, mask) tuples to a library file.
+    The file is written next to the target and renamed, so an existing
+    library is never left half written. Returns the number of masks.
+    '''
+
+    index = []
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+
+        f.write(b'\0' * HEADER_SIZE)
+        for key, name, space, visible, mask in masks:
+
+            if isinstance(mask, LazyMask):
+                mask.load()
+            blob = zlib.compress(np.ascontiguousarray(mask.data).tobytes(), 1)
+            index.append({
+                'key': int(key),
+                'name': name,
+                'space': space,
+                'shape': [int(x) for x in mask.shape],
+                'bbox': [int(x) for x in mask.bbox],
+                'binary': bool(mask.binary),
+                'visible': bool(visible),
+                'calibration': calibration,
+                'offset': f.tell(),
+                'size': len(blob)
+            })
+            f.write(blob)
+
+        index_offset = f.tell()
+        index_bytes = json.dumps(index).encode('utf-8')
+        f.write(index_bytes)
+        f.seek(0)
+        f.write(struct.pack(HEADER, MAGIC, VERSION, index_offset, len(index_bytes)))
+
+    os.replace(tmp_path, path)
+    return len(index)
+
+class MaskLibrary:
+    '''
+    Read access to a library file. Opening only reads the index, mask data
+    is memory-mapped and decompressed one mask at a time.
+    '''
+
+    def __init__(self, path: str) -> None:
+
+        self.path = path
+        self.file = open(path, 'rb')
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version, index_offset, index_size = struct.unpack_from(HEADER, self.map, 0)
+        if magic != MAGIC:
+            self.close()
+            raise ValueError(f'{path} is not a mask library')
+        if version != VERSION:
+            self.close()
+            raise ValueError(f'unsupported mask library version {version}')
+
+        index = json.loads(self.map[index_offset:index_offset+index_size].decode('utf-8'))
+        self.entries = [
+            LibraryEntry(
+                key=e['key'],
+                name=e['name'],
+                space=e['space'],
+                shape=tuple(e['shape']),
+                bbox=tuple(e['bbox']),
+                binary=e['binary'],
+                visible=e['visible'],
+                calibration=e['calibration'],
+                offset=e['offset'],
+                size=e['size']
+            )
+            for e in index
+        ]
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def spaces(self) -> List[str]:
+        return sorted(set(entry.space for entry in self.entries))
+
+    def calibrations(self) -> List[str]:
+        return sorted(set(entry.calibration for entry in self.entries))
+
+    def read_data(self, entry: LibraryEntry) -> NDArray:
+
+        raw = zlib.decompress(self.map[entry.offset:entry.offset+entry.size])
+        if entry.binary:
+            return np.frombuffer(raw, np.uint8)
+        top, left, bottom, right = entry.bbox
+        return np.frombuffer(raw, np.float32).reshape(bottom - top, right - left)
+
+    def masks(self, space: Optional[str] = None, lazy: bool = True) -> List[Tuple[LibraryEntry, CompactMask]]:
+        '''
+        masks, optionally only those drawn in one space. Lazy masks read 
+        the file when needed and require the library to stay open
+        '''
+        return [
+            (entry, LazyMask(self, entry) if lazy else CompactMask(entry.shape, entry.bbox, entry.binary, self.read_data(entry)))
+            for entry in self.entries
+            if space is None or entry.space == space
+        ]
+
+    def get_statistics(self) -> Dict:
+        return {
+            'masks': len(self.entries),
+            'file_bytes': len(self.map),
+            'spaces': self.spaces(),
+            'calibrations': self.calibrations()
+        }
+
+    def close(self) -> None:
+        self.map.close()
+        self.file.close()
+
+    def __enter__(self) -> 'MaskLibrary':
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
\ No newline at end of file
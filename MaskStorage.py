@@ -0,0 +1,446 @@
+import numpy as np
+from numpy.typing import NDArray
+from collections import OrderedDict
+from typing import Tuple, Dict, Optional, Union, Iterable, List, Callable
+
+class CompactMask:
+    '''
+    Mask stored as the crop of its bounding box. Binary masks are 
+    bit-packed, graded masks keep a float32 crop. Memory scales with the
+    bounding box area, not the frame size. The dense frame is only built
+    on request (to_dense).
+    '''
+
+    __slots__ = ('shape', 'bbox', 'binary', 'data', 'outline')
+
+    def __init__(self, shape: Tuple[int, int], bbox: Tuple[int, int, int, int], binary: bool, data: NDArray) -> None:
+        self.shape = shape
+        self.bbox = bbox # top, left, bottom, right (exclusive)
+        self.binary = binary
+        self.data = data
+        # polygons of the mask, found once by MaskTransform.mask_outline 
+        # (False if the mask is not a polygon)
+        self.outline = None
+
+    @classmethod
+    def from_dense(cls, mask: NDArray) -> 'CompactMask':
+        return cls.from_crop(mask.shape[:2], 0, 0, mask)
+
+    @classmethod
+    def from_crop(cls, shape: Tuple[int, int], top: int, left: int, crop: NDArray) -> 'CompactMask':
+        '''mask given by the content of a region of the frame, starting at (top, left)'''
+
+        shape = tuple(shape)
+        rows = np.flatnonzero(crop.any(axis=1))
+        if rows.size == 0:
+            return cls(shape, (0, 0, 0, 0), True, np.zeros((0,), np.uint8))
+        cols = np.flatnonzero(crop.any(axis=0))
+        
+        crop = crop[rows[0]:rows[-1]+1, cols[0]:cols[-1]+1]
+        bbox = (top + int(rows[0]), left + int(cols[0]), top + int(rows[-1]) + 1, left + int(cols[-1]) + 1)
+        if crop.dtype == bool:
+            binary = True
+        elif crop.dtype.kind in 'ui':
+            # filled polygons: no need to compare every pixel to 0 and 1 
+            binary = 0 <= crop.min() and crop.max() <= 1
+        else:
+            binary = bool(np.all((crop == 0) | (crop == 1)))
+        if binary:
+            data = np.packbits(crop.astype(bool, copy=False), axis=None)
+        else:
+            data = crop.astype(np.float32)
+        return cls(shape, bbox, binary, data)
+
+    @property
+    def ready(self) -> bool:
+        '''whether the content is in memory (see LazyMask, DeferredMask)'''
+        return True
+
+    @property
+    def crop_shape(self) -> Tuple[int, int]:
+        top, left, bottom, right = self.bbox
+        return (bottom - top, right - left)
+
+    @property
+    def slices(self) -> Tuple[slice, slice]:
+        top, left, bottom, right = self.bbox
+        return (slice(top, bottom), slice(left, right))
+
+    @property
+    def area(self) -> int:
+        height, width = self.crop_shape
+        return height * width
+
+    @property
+    def nbytes(self) -> int:
+        return self.data.nbytes
+
+    def bits(self) -> NDArray:
+        '''uint8 content of the bounding box of a binary mask'''
+        return np.unpackbits(self.data, count=self.area).reshape(self.crop_shape)
+
+    def crop(self) -> NDArray:
+        '''float32 content of the bounding box'''
+
+        if self.binary:
+            return self.bits().astype(np.float32)
+        return self.data
+
+    def to_dense(self, shape: Optional[Tuple[int, int]] = None) -> NDArray:
+        dense = np.zeros(shape or self.shape, np.float32)
+        self.add_to(dense)
+        return dense
+
+    def add_to(self, out: NDArray, weight: float = 1) -> None:
+        '''
+        Add the weighted mask to a frame, only touching its bounding box.
+        The mask is cropped if the frame is smaller.
+        '''
+
+        top, left, bottom, right = self.bbox
+        bottom, right = min(bottom, out.shape[0]), min(right, out.shape[1])
+        if bottom <= top or right <= left:
+            return
+        
+        crop = self.crop()[:bottom-top, :right-left]
+        if weight == 1:
+            out[top:bottom, left:right] += crop
+        else:
+            out[top:bottom, left:right] += weight * crop
+
+class DeferredMask(CompactMask):
+    '''
+    CompactMask computed on first use from another mask, e.g. a mask 
+    transferred from another space. resolver takes a list of deferred 
+    masks and sets each of them (see set), so that resolve_masks computes
+    many masks in one call.
+    '''
+
+    __slots__ = ('source', 'resolver')
+
+    CONTENT = ('shape', 'bbox', 'binary', 'data')
+
+    def __init__(self, source: CompactMask, resolver: Callable[[List['DeferredMask']], None]) -> None:
+        self.source = source
+        self.resolver = resolver
+        self.outline = None
+
+    def __getattr__(self, name: str):
+        # only called for slots that are not set yet
+        if name not in self.CONTENT:
+            raise AttributeError(name)
+        self.resolver([self])
+        return object.__getattribute__(self, name)
+
+    @property
+    def ready(self) -> bool:
+        try:
+            object.__getattribute__(self, 'data')
+        except AttributeError:
+            return False
+        return True
+
+    @property
+    def nbytes(self) -> int:
+        return self.data.nbytes if self.ready else 0
+
+    def set(self, mask: CompactMask) -> None:
+        self.shape, self.bbox, self.binary, self.data = mask.shape, mask.bbox, mask.binary, mask.data
+        self.source = None
+
+def resolve_masks(masks: Iterable[CompactMask]) -> None:
+    '''compute the deferred masks that are not ready, one call per resolver'''
+
+    groups = {}
+    for mask in masks:
+        if isinstance(mask, DeferredMask) and not mask.ready:
+            groups.setdefault(id(mask.resolver), (mask.resolver, []))[1].append(mask)
+    for resolver, group in groups.values():
+        resolver(group)
+
+class RunningComposite:
+    '''
+    Sum of a set of masks with the number of masks covering each pixel,
+    and the sum clipped to [0, 1]. Adding or removing a mask only 
+    updates its bounding box. Pixels that are no longer covered are reset
+    to 0 so that rounding errors do not build up.
+    '''
+
+    def __init__(self, shape: Tuple[int, int]) -> None:
+        self.shape = tuple(shape)
+        self.sum = np.zeros(self.shape, np.float32)
+        self.coverage = np.zeros(self.shape, np.uint16)
+        self.clipped = np.zeros(self.shape, np.float32)
+
+    def update(self, mask: CompactMask, sign: int = 1, clip: bool = True) -> None:
+
+        top, left, bottom, right = mask.bbox
+        bottom, right = min(bottom, self.shape[0]), min(right, self.shape[1])
+        if bottom <= top or right <= left:
+            return
+
+        box = (slice(top, bottom), slice(left, right))
+        if mask.binary:
+            # the bits are both the values and the coverage
+            crop = covered = mask.bits()[:bottom-top, :right-left]
+        else:
+            crop = mask.crop()[:bottom-top, :right-left]
+            covered = (crop != 0).view(np.uint8)
+        if sign > 0:
+            self.sum[box] += crop
+            self.coverage[box] += covered
+        else:
+            self.sum[box] -= crop
+            self.coverage[box] -= covered
+            self.sum[box][self.coverage[box] == 0] = 0
+        if clip:
+            np.clip(self.sum[box], 0, 1, out=self.clipped[box])
+
+    def add(self, mask: CompactMask) -> None:
+        self.update(mask, 1)
+
+    def add_many(self, masks: List[CompactMask]) -> None:
+        '''add masks, then clip once over the box covering all of them'''
+
+        boxes = np.array([mask.bbox for mask in masks if mask.area]).reshape(-1, 4)
+        if boxes.size == 0:
+            return
+
+        for mask in masks:
+            self.update(mask, 1, clip=False)
+        top, left = boxes[:, :2].min(axis=0)
+        bottom, right = boxes[:, 2:].max(axis=0)
+        box = (slice(top, bottom), slice(left, right))
+        np.clip(self.sum[box], 0, 1, out=self.clipped[box])
+
+    def remove(self, mask: CompactMask) -> None:
+        self.update(mask, -1)
+
+class MaskStore:
+    '''
+    Compact masks of one drawer, with their visibility.
+
+    Dense frames are built on request. The last few requested dense masks 
+    are kept so that consumers that rely on array identity (e.g. the DMD 
+    pixmap cache) see the same array when the same mask is asked again.
+
+    Running composites of all masks and of visible masks are kept so that
+    composite and flatten do not loop over masks. Added and deleted masks
+    are queued and applied together the next time a composite is 
+    requested (settle), only over their bounding boxes, or by rebuilding
+    the composites when most masks changed (e.g. all masks transferred 
+    again after a calibration change). Masks that are not in memory yet 
+    (lazy library masks, deferred transfers) are resolved in one batch at
+    that point. The version counts changes.
+    '''
+
+    def __init__(self, shape: Tuple[int, int], dense_cache_size: int = 8) -> None:
+        self.shape = tuple(shape)
+        self.masks = {} # key -> CompactMask
+        self.visible = {} # key -> bool
+        self.pending = set() # keys of masks not in the running composites yet
+        self.removed = [] # (mask, visible) removed, still in the running composites
+        self.dense_cache_size = dense_cache_size
+        self.dense_cache = OrderedDict()
+        self.version = 0
+        self.snapshot_version = -1
+        self.snapshot_frame = None
+        self.reset_composites()
+
+    def __contains__(self, key: int) -> bool:
+        return key in self.masks
+
+    def __len__(self) -> int:
+        return len(self.masks)
+
+    def keys(self) -> Iterable[int]:
+        return self.masks.keys()
+
+    def max_key(self) -> int:
+        return max(self.masks.keys() or [0])
+
+    def next_key(self) -> int:
+        return self.max_key() + 1
+
+    def add(self, key: int, mask: Union[NDArray, CompactMask], visible: bool = True) -> CompactMask:
+
+        if not isinstance(mask, CompactMask):
+            mask = CompactMask.from_dense(mask)
+
+        if key in self.masks:
+            self.delete(key)
+        self.masks[key] = mask
+        self.visible[key] = visible
+        self.pending.add(key)
+        self.version += 1
+        return mask
+
+    def delete(self, key: int) -> None:
+        mask = self.masks.pop(key)
+        visible = self.visible.pop(key)
+        self.dense_cache.pop(key, None)
+        self.version += 1
+        if key in self.pending:
+            self.pending.discard(key)
+        else:
+            self.removed.append((mask, visible))
+
+    def clear(self) -> None:
+        self.masks = {}
+        self.visible = {}
+        self.pending = set()
+        self.removed = []
+        self.dense_cache.clear()
+        self.reset_composites()
+
+    def set_visible(self, key: int, visible: bool) -> None:
+        
+        visible = bool(visible)
+        if visible == self.visible[key]:
+            return
+        
+        self.visible[key] = visible
+        self.version += 1
+        if key in self.pending:
+            return
+        if visible:
+            self.shown.add(self.masks[key])
+        else:
+            self.shown.remove(self.masks[key])
+
+    def settle(self) -> None:
+        '''apply the queued additions and removals to the running composites'''
+
+        if not self.pending and not self.removed:
+            return
+
+        if len(self.pending) + len(self.removed) > len(self.masks):
+            # cheaper to start over than to remove masks one by one
+            self.reset_composites()
+            self.pending = set(self.masks.keys())
+        else:
+            for mask, visible in self.removed:
+                self.total.remove(mask)
+                if visible:
+                    self.shown.remove(mask)
+        self.removed = []
+
+        keys = list(self.pending)
+        masks = [self.masks[key] for key in keys]
+        resolve_masks(masks)
+        self.total.add_many(masks)
+        self.shown.add_many([mask for key, mask in zip(keys, masks) if self.visible[key]])
+        self.pending = set()
+
+    def set_shape(self, shape: Tuple[int, int]) -> None:
+        '''change the frame size, masks that do not fit are cropped'''
+        self.shape = tuple(shape)
+        self.dense_cache.clear()
+        self.reset_composites()
+        self.pending = set(self.masks.keys())
+        self.removed = []
+        self.settle()
+
+    def reset_composites(self) -> None:
+        self.version += 1
+        self.total = RunningComposite(self.shape)
+        self.shown = RunningComposite(self.shape)
+
+    def dense(self, key: int) -> NDArray:
+        '''full-frame float32 mask'''
+
+        if key in self.dense_cache:
+            self.dense_cache.move_to_end(key)
+            return self.dense_cache[key]
+
+        dense = self.masks[key].to_dense(self.shape)
+        self.dense_cache[key] = dense
+        if len(self.dense_cache) > self.dense_cache_size:
+            self.dense_cache.popitem(last=False)
+        return dense
+
+    def weighted_sum(self, keys: List[int], weights: Iterable[float], out: Optional[NDArray] = None) -> NDArray:
+        '''
+        Sum of masks scaled by their weight, only touching the bounding 
+        box of each mask. out is overwritten.
+        '''
+
+        resolve_masks(self.masks[key] for key in keys)
+        if out is None:
+            out = np.zeros(self.shape, np.float32)
+        else:
+            out.fill(0)
+        for key, weight in zip(keys, weights):
+            self.masks[key].add_to(out, weight)
+        return out
+
+    def accumulate(self, keys: Iterable[int], out: Optional[NDArray] = None) -> NDArray:
+        '''sum of masks, only touching the bounding box of each mask'''
+
+        keys = list(keys)
+        resolve_masks(self.masks[key] for key in keys)
+        if out is None:
+            out = np.zeros(self.shape, np.float32)
+        for key in keys:
+            self.masks[key].add_to(out)
+        return out
+
+    def composite(self) -> NDArray:
+        '''visible masks combined in a single frame (read-only view)'''
+
+        self.settle()
+        composite = self.shown.clipped.view()
+        composite.flags.writeable = False
+        return composite
+
+    def snapshot(self) -> NDArray:
+        '''
+        Copy of the composite that is never modified: the same array until 
+        the masks change, so that it can be cached by identity (DMD)
+        '''
+
+        self.settle()
+        if self.snapshot_version != self.version:
+            self.snapshot_frame = self.shown.clipped.copy()
+            self.snapshot_frame.flags.writeable = False
+            self.snapshot_version = self.version
+        return self.snapshot_frame
+
+    def flatten(self, key: int = 1) -> CompactMask:
+        '''replace all masks by their sum'''
+
+        self.settle()
+        flat = CompactMask.from_dense(self.total.clipped)
+        self.clear()
+        return self.add(key, flat)
+
+    def check_consistency(self, atol: float = 1e-5) -> bool:
+        '''compare the running composites with a full recompute'''
+
+        self.settle()
+        for running, keys in (
+            (self.total, list(self.masks.keys())),
+            (self.shown, [key for key, visible in self.visible.items() if visible])
+        ):
+            total = self.accumulate(keys)
+            coverage = np.zeros(self.shape, np.uint16)
+            for key in keys:
+                coverage += self.masks[key].to_dense(self.shape) != 0
+
+            if not np.array_equal(coverage, running.coverage):
+                return False
+            if not np.allclose(total, running.sum, atol=atol):
+                return False
+            if not np.allclose(np.clip(total, 0, 1), running.clipped, atol=atol):
+                return False
+        return True
+
+    def nbytes(self) -> int:
+        return sum(mask.nbytes for mask in self.masks.values())
+
+    def get_statistics(self) -> Dict:
+        return {
+            'masks': len(self.masks),
+            'bytes': self.nbytes(),
+            'dense_bytes': len(self.masks) * int(np.prod(self.shape)) * 4
+        }
@@ -0,0 +1,337 @@
+import cv2
+import numpy as np
+from numpy.typing import NDArray
+from typing import List, Optional, Tuple, Callable, Union
+from MaskStorage import CompactMask
+
+# sub-pixel bits used by cv2.fillPoly
+SHIFT = 4
+
+# polygons are exchanged along pixel edges: pixel (x, y) covers 
+# [x-0.5, x+0.5] x [y-0.5, y+0.5]. Contours and cv2.fillPoly work on 
+# pixel centers, half a pixel inside the edges
+HALF_PIXEL = 0.5
+
+def polygon_starts(polygons: List[NDArray]) -> NDArray:
+    '''index of the first vertex of each polygon in their concatenation'''
+    return np.cumsum([0] + [len(p) for p in polygons[:-1]])
+
+def offset_polygons(points: NDArray, starts: NDArray, distance: float) -> Tuple[NDArray, NDArray]:
+    '''
+    Move the edges of polygons outwards by distance (inwards if negative),
+    vertices are moved along the bisector of their edges (miter join).
+    The miter of sharp corners is limited to twice the distance, like the
+    tip of a rasterized corner. Polygons are given by their concatenated 
+    vertices, polygon i starting at starts[i], and are all moved at once.
+    Returns the vertices and which polygons were moved: polygons without 
+    area or with repeated vertices keep their vertices.
+    '''
+
+    p = points.astype(np.float64)
+    if len(p) == 0:
+        return p.astype(np.float32), np.zeros((len(starts),), bool)
+
+    # previous and next vertex of each vertex, within its polygon
+    counts = np.diff(np.append(starts, len(p)))
+    polygon = np.repeat(np.arange(len(starts)), counts)
+    first = starts[polygon]
+    last = first + counts[polygon] - 1
+    index = np.arange(len(p))
+    following = np.where(index == last, first, index + 1)
+    preceding = np.where(index == first, last, index - 1)
+
+    x, y = p[:, 0], p[:, 1]
+    orientation = np.sign(np.add.reduceat(x * y[following] - x[following] * y, starts))
+
+    # unit normals of the edges ending at (before) and starting at (after) each vertex
+    after = p[following] - p
+    length = np.linalg.norm(after, axis=1)
+    moved = (orientation != 0) & (np.add.reduceat((length == 0).astype(int), starts) == 0)
+    after /= np.where(length == 0, 1, length)[:, None]
+    before = after[preceding]
+    sign = orientation[polygon][:, None]
+    normal_after = sign * np.stack([after[:, 1], -after[:, 0]], axis=1)
+    normal_before = sign * np.stack([before[:, 1], -before[:, 0]], axis=1)
+
+    cos = np.sum(normal_before * normal_after, axis=1)
+    miter = (normal_before + normal_after) / np.maximum(1 + cos, 0.5)[:, None]
+    offset = distance * moved[polygon]
+    return (p + offset[:, None] * miter).astype(np.float32), moved
+
+def offset_polygon(polygon: NDArray, distance: float) -> Optional[NDArray]:
+    '''offset_polygons for a single polygon, None if it has no area'''
+
+    moved, valid = offset_polygons(polygon, np.zeros((1,), int), distance)
+    return moved if valid[0] else None
+
+def mask_to_polygons(mask: NDArray) -> Optional[List[NDArray]]:
+    '''
+    Recover the polygons of a binary mask, along pixel edges.
+    DrawPolyMask only hands out rasters: the outline of the mask is kept
+    vertex for vertex and checked by filling it again, so the polygons
+    cover exactly the pixels of the mask. Returns None for masks that are
+    not plain polygons (graded values, holes, lines, outlines that do not
+    fill back to the mask), these need to be warped as images.
+    '''
+
+    compact = mask if isinstance(mask, CompactMask) else CompactMask.from_dense(mask)
+    if not compact.binary:
+        return None
+    if compact.area == 0:
+        return []
+
+    crop = compact.crop().astype(np.uint8)
+    contours, hierarchy = cv2.findContours(crop, cv2.RETR_CCOMP, cv2.CHAIN_APPROX_SIMPLE)
+    if np.any(hierarchy[0, :, 3] >= 0):
+        return None
+
+    # contours go through the centers of the outer pixels
+    polygons = []
+    for contour in contours:
+        contour = contour.reshape(-1, 2)
+        if len(contour) < 3:
+            return None
+        polygon = offset_polygon(contour, HALF_PIXEL)
+        if polygon is None:
+            return None
+        polygons.append(polygon)
+
+    # the offset is not undone exactly at sharp corners
+    refilled = rasterize_polygons_compact(polygons, compact.crop_shape)
+    if refilled.bbox != (0, 0) + compact.crop_shape or not np.array_equal(refilled.data, compact.data):
+        return None
+
+    top, left = compact.bbox[:2]
+    return [polygon + np.float32((left, top)) for polygon in polygons]
+
+def mask_outline(mask: CompactMask) -> Optional[List[NDArray]]:
+    '''
+    mask_to_polygons, computed once per mask and kept with it: masks are
+    not modified in place
+    '''
+
+    if mask.outline is None:
+        polygons = mask_to_polygons(mask)
+        mask.outline = False if polygons is None else polygons
+    return mask.outline if mask.outline is not False else None
+
+def transform_points(points: NDArray, T: NDArray) -> NDArray:
+    '''apply a 3x3 transformation to vertices (x, y)'''
+
+    T = np.asarray(T, np.float64)
+    points = np.asarray(points, np.float64).reshape(-1, 1, 2)
+    if np.array_equal(T[2], [0, 0, 1]):
+        return cv2.transform(points, T[:2]).reshape(-1, 2)
+    return cv2.perspectiveTransform(points, T).reshape(-1, 2)
+
+def transform_polygons(polygons: List[NDArray], T: NDArray) -> List[NDArray]:
+    '''apply a 3x3 transformation to polygon vertices, all at once'''
+
+    if not polygons:
+        return []
+    points = transform_points(np.concatenate(polygons), T)
+    return np.split(points, polygon_starts(polygons)[1:])
+
+def to_pixel_centers(polygons: List[NDArray]) -> List[NDArray]:
+    '''
+    fillPoly fills the pixels from vertex to vertex included: move the 
+    edges onto the centers of the outer pixels. Polygons thinner than a
+    pixel keep their vertices
+    '''
+
+    if not polygons:
+        return []
+    starts = polygon_starts(polygons)
+    centers, _ = offset_polygons(np.concatenate(polygons), starts, -HALF_PIXEL)
+    return np.split(centers, starts[1:])
+
+def rasterize_polygons(polygons: List[NDArray], shape: Tuple[int, int]) -> NDArray:
+    '''fill polygons at the destination resolution, with sub-pixel vertices'''
+
+    mask = np.zeros(shape, np.uint8)
+    if polygons:
+        pts = [np.round(p * (1 << SHIFT)).astype(np.int32) for p in to_pixel_centers(polygons)]
+        cv2.fillPoly(mask, pts, 1, lineType=cv2.LINE_8, shift=SHIFT)
+    return mask.astype(np.float32)
+
+def rasterize_polygons_compact(polygons: List[NDArray], shape: Tuple[int, int]) -> CompactMask:
+    '''fill polygons over their bounding box only'''
+
+    if not polygons:
+        return CompactMask.from_crop(shape, 0, 0, np.zeros((0, 0), np.uint8))
+
+    starts = polygon_starts(polygons)
+    centers, _ = offset_polygons(np.concatenate(polygons), starts, -HALF_PIXEL)
+    return rasterize_centers_batch(centers, starts, [len(polygons)], shape)[0]
+
+def rasterize_centers_batch(
+        centers: NDArray, 
+        starts: NDArray, 
+        num_polygons: List[int], 
+        shape: Tuple[int, int]
+    ) -> List[CompactMask]:
+    '''
+    Fill the polygons of many masks, each over its bounding box. Vertices
+    are on pixel centers (see to_pixel_centers) and concatenated, polygon
+    i starts at starts[i]. Mask j is made of the next num_polygons[j] 
+    polygons.
+    '''
+
+    num_polygons = np.asarray(num_polygons, int)
+    ends = np.append(starts[1:], len(centers))
+    first = np.cumsum(num_polygons) - num_polygons
+    filled = np.flatnonzero(num_polygons)
+
+    # bounding box of each mask, from the vertices of all its polygons
+    corners = np.zeros((len(num_polygons), 4), int)
+    if filled.size:
+        vertex_starts = starts[first[filled]]
+        lows = np.floor(np.minimum.reduceat(centers, vertex_starts, axis=0)).astype(int)
+        highs = np.ceil(np.maximum.reduceat(centers, vertex_starts, axis=0)).astype(int) + 1
+        corners[filled, :2] = np.maximum(lows, 0)
+        corners[filled, 2:] = np.minimum(highs, shape[::-1])
+
+    # vertices in fixed point, relative to the box of their mask
+    origins = np.repeat(corners[:, :2], num_polygons, axis=0)
+    origins = np.repeat(origins, ends - starts, axis=0)
+    fixed = np.round((centers - origins) * (1 << SHIFT)).astype(np.int32)
+
+    masks = []
+    for idx, (left, top, right, bottom) in enumerate(corners.tolist()):
+        crop = np.zeros((max(bottom - top, 0), max(right - left, 0)), np.uint8)
+        if crop.size:
+            polygons = range(first[idx], first[idx] + num_polygons[idx])
+            cv2.fillPoly(crop, [fixed[starts[i]:ends[i]] for i in polygons], 1, lineType=cv2.LINE_8, shift=SHIFT)
+        masks.append(CompactMask.from_crop(shape, top, left, crop))
+
+    return masks
+
+class MaskTransformer:
+    '''
+    Warp rasters between drawers.
+
+    Masks are only warped over the destination bounding box of their own
+    bounding box, with the 3x3 transformation shifted to these boxes: no
+    full-frame map is built, so nothing needs to be rebuilt when the 
+    calibration changes. Transformations are read at each call, they may
+    be updated in place.
+    '''
+
+    def __init__(self, transformations: NDArray) -> None:
+        self.set_transformations(transformations)
+
+    def set_transformations(self, transformations: NDArray) -> None:
+        self.transformations = transformations
+
+    def destination_bbox(self, src: int, dst: int, bbox: Tuple[int, int, int, int], shape: Tuple[int, int]) -> Tuple[int, int, int, int]:
+        '''bounding box (top, left, bottom, right) of a source box in the destination'''
+
+        top, left, bottom, right = bbox
+        corners = np.array([[left-1, top-1], [right, top-1], [right, bottom], [left-1, bottom]], np.float64)
+        corners = cv2.perspectiveTransform(corners.reshape(-1, 1, 2), self.transformations[src, dst]).reshape(-1, 2)
+        x0, y0 = np.floor(corners.min(axis=0)).astype(int)
+        x1, y1 = np.ceil(corners.max(axis=0)).astype(int) + 1
+        return (max(y0, 0), max(x0, 0), min(y1, shape[0]), min(x1, shape[1]))
+
+    def warp(self, mask: NDArray, src: int, dst: int, shape: Tuple[int, int]) -> NDArray:
+        return self.warp_batch([mask], src, dst, shape)[0]
+
+    def warp_batch(self, masks: List[NDArray], src: int, dst: int, shape: Tuple[int, int]) -> List[NDArray]:
+        '''warp masks from one drawer to another, sharing the same maps'''
+        return [m.to_dense(shape) for m in self.warp_compact_batch(masks, src, dst, shape)]
+
+    def warp_compact_batch(
+            self, 
+            masks: List[Union[NDArray, CompactMask]], 
+            src: int, 
+            dst: int, 
+            shape: Tuple[int, int]
+        ) -> List[CompactMask]:
+        '''
+        Same as warp_batch without building full frames: only the crop of
+        each mask is read and only its destination box is written.
+        '''
+
+        T = np.asarray(self.transformations[src, dst], np.float64)
+        affine = np.array_equal(T[2], [0, 0, 1])
+        warped = []
+        for mask in masks:
+
+            if not isinstance(mask, CompactMask):
+                mask = CompactMask.from_dense(mask)
+            
+            top, left, bottom, right = self.destination_bbox(src, dst, mask.bbox, shape)
+            if mask.area == 0 or bottom <= top or right <= left:
+                warped.append(CompactMask.from_crop(shape, 0, 0, np.zeros((0, 0), np.float32)))
+                continue
+
+            # crop pixel -> source pixel -> destination pixel -> box pixel
+            src_top, src_left = mask.bbox[:2]
+            M = np.array([[1, 0, -left], [0, 1, -top], [0, 0, 1]]) @ T @ np.array([[1, 0, src_left], [0, 1, src_top], [0, 0, 1]])
+            dsize = (right - left, bottom - top)
+            if affine:
+                crop = cv2.warpAffine(mask.crop(), M[:2], dsize, flags=cv2.INTER_LINEAR)
+            else:
+                crop = cv2.warpPerspective(mask.crop(), M, dsize, flags=cv2.INTER_LINEAR)
+            warped.append(CompactMask.from_crop(shape, top, left, crop))
+
+        return warped
+
+def transfer_mask(
+        mask: NDArray,
+        T: NDArray,
+        shape: Tuple[int, int],
+        polygons: Optional[List[NDArray]] = None,
+        warp: Optional[Callable[[NDArray], NDArray]] = None
+    ) -> NDArray:
+    '''
+    Move a mask to another coordinate space. Polygons are transformed and
+    rasterized directly, other masks fall back to warping the raster 
+    (with warp if given, e.g. a cached MaskTransformer).
+    '''
+
+    if polygons is not None:
+        return rasterize_polygons(transform_polygons(polygons, T), shape)
+
+    if warp is not None:
+        return warp(mask)
+
+    dsize = tuple(shape[::-1]) # opencv expects (col, rows)
+    return cv2.warpAffine(mask, T[:2, :], dsize)
+
+def transfer_masks(
+        masks: List[Union[NDArray, CompactMask]],
+        src: int,
+        dst: int,
+        shape: Tuple[int, int],
+        transformer: MaskTransformer
+    ) -> List[CompactMask]:
+    '''
+    Move a batch of compact masks to another coordinate space without 
+    building full frames. The outlines of polygon masks are found once 
+    per mask, then the vertices of all the polygons are transformed and 
+    moved onto pixel centers together, and each mask is filled over its
+    bounding box. The other masks are warped.
+    '''
+
+    masks = [mask if isinstance(mask, CompactMask) else CompactMask.from_dense(mask) for mask in masks]
+    outlines = [mask_outline(mask) for mask in masks]
+    to_fill = [idx for idx, outline in enumerate(outlines) if outline is not None]
+    to_warp = [idx for idx, outline in enumerate(outlines) if outline is None]
+
+    transferred = [None] * len(masks)
+    polygons = [polygon for idx in to_fill for polygon in outlines[idx]]
+    if polygons:
+        starts = polygon_starts(polygons)
+        points = transform_points(np.concatenate(polygons), transformer.transformations[src, dst])
+        centers, _ = offset_polygons(points, starts, -HALF_PIXEL)
+        filled = rasterize_centers_batch(centers, starts, [len(outlines[idx]) for idx in to_fill], shape)
+    else:
+        filled = [CompactMask.from_crop(shape, 0, 0, np.zeros((0, 0), np.uint8)) for idx in to_fill]
+    for idx, mask in zip(to_fill, filled):
+        transferred[idx] = mask
+
+    warped = transformer.warp_compact_batch([masks[idx] for idx in to_warp], src, dst, shape)
+    for idx, mask in zip(to_warp, warped):
+        transferred[idx] = mask
+    return transferred
\ No newline at end of file
@@ -1,10 +1,56 @@
+import io
 import zmq
+import cv2
+import time
+import struct
+import threading
+from collections import deque
 import numpy as np
 from numpy.typing import NDArray
-from PyQt5.QtCore import pyqtSignal, pyqtSlot, QRunnable, QThreadPool, QObject
-from PyQt5.QtWidgets import QLabel,  QWidget
-from qt_widgets import NDarray_to_QPixmap
+from typing import NamedTuple, Tuple, List, Optional, Dict
+from PyQt5.QtCore import pyqtSignal, pyqtSlot, QRunnable, QThreadPool, QObject, QTimer, Qt
+from PyQt5.QtWidgets import QWidget
+from PyQt5.QtGui import QImage, QPainter
 from image_tools import im2uint8
+from RingBuffer import RingBuffer
+from Recorder import FrameRecorder
+
+# Binary frame protocol (see frameDoneIPC.m). A message is a batch of 
+# frames, each frame is a pair of parts: a fixed-size little-endian header 
+# followed by the raw pixel buffer. Frames are tagged with channel, plane 
+# and ROI. Messages that do not start with the magic bytes are parsed with
+# the legacy text format (see serialize.m)
+HEADER_MAGIC = b'SIFR'
+HEADER_VERSION = 2
+HEADERS = {
+    # magic, version, dtype code, channel, height, width, frame index, timestamp
+    1: struct.Struct('<4sBBHIIId'),
+    # magic, version, dtype code, channel, plane, roi, height, width, frame index, timestamp
+    2: struct.Struct('<4sBBHHHIIId')
+}
+HEADER = HEADERS[HEADER_VERSION]
+DTYPES = {
+    0: np.dtype('<f4'),
+    1: np.dtype('<i2')
+}
+
+class FrameHeader(NamedTuple):
+    frame_index: int
+    channel: int
+    timestamp: float
+    shape: Tuple[int, int]
+    dtype: np.dtype
+    plane: int = 0
+    roi: int = 0
+
+    @property
+    def stream(self) -> 'StreamKey':
+        return StreamKey(self.channel, self.plane, self.roi)
+
+class StreamKey(NamedTuple):
+    channel: int
+    plane: int = 0
+    roi: int = 0
 
 def deserialize(message: str) -> NDArray:
     '''deserialize string into numpy array'''
@@ -12,47 +58,410 @@ def deserialize(message: str) -> NDArray:
     data = [r.split(',') for r in message.split(';')]
     return np.array(data, dtype = np.float32)
 
+def deserialize_fast(message: bytes) -> NDArray:
+    '''
+    deserialize raw bytes into numpy array. Same output as deserialize, 
+    but parsed by numpy's C text reader (numpy >= 1.23) without decoding 
+    the message or building intermediate lists
+    '''
+
+    # rows are separated by ';', the reader expects line breaks
+    stream = io.BytesIO(message.replace(b';', b'\n'))
+    return np.loadtxt(stream, dtype = np.float32, delimiter = ',', comments = None, ndmin = 2)
+
+def is_binary(parts: List) -> bool:
+    '''check whether a multipart message uses the binary frame protocol'''
+
+    return bytes(parts[0].buffer[:len(HEADER_MAGIC)]) == HEADER_MAGIC
+
+def unpack_header(header: bytes) -> FrameHeader:
+    '''decode the binary frame header'''
+
+    if len(header) <= len(HEADER_MAGIC) or header[:len(HEADER_MAGIC)] != HEADER_MAGIC:
+        raise ValueError('not a frame header')
+
+    version = header[len(HEADER_MAGIC)]
+    if version not in HEADERS:
+        raise ValueError(f'unsupported frame protocol version {version}')
+    if len(header) != HEADERS[version].size:
+        raise ValueError(f'frame header of {len(header)} bytes, expected {HEADERS[version].size}')
+
+    if version == 1:
+        _, _, dtype_code, channel, height, width, frame_index, timestamp = HEADERS[1].unpack(header)
+        plane, roi = 0, 0
+    else:
+        _, _, dtype_code, channel, plane, roi, height, width, frame_index, timestamp = HEADERS[2].unpack(header)
+    
+    if dtype_code not in DTYPES:
+        raise ValueError(f'unknown dtype code {dtype_code}')
+
+    return FrameHeader(frame_index, channel, timestamp, (height, width), DTYPES[dtype_code], plane, roi)
+
+def decode_binary(parts: List) -> List[Tuple[FrameHeader, NDArray]]:
+    '''
+    decode a batch of binary frames without copying the pixel buffers.
+    Raises ValueError if a header is malformed or a buffer does not match
+    its header
+    '''
+
+    if len(parts) % 2:
+        raise ValueError(f'{len(parts)} parts, expected header and data pairs')
+
+    frames = []
+    for header_part, data_part in zip(parts[0::2], parts[1::2]):
+        header = unpack_header(header_part.bytes)
+        expected = int(np.prod(header.shape)) * header.dtype.itemsize
+        if len(data_part.buffer) != expected:
+            raise ValueError(
+                f'frame {header.frame_index}: {len(data_part.buffer)} bytes, '
+                f'expected {expected} for {header.shape} {header.dtype}'
+            )
+        image = np.frombuffer(data_part.buffer, dtype=header.dtype)
+        frames.append((header, image.reshape(header.shape)))
+    return frames
+
+class FrameStream(QObject):
+    '''
+    Frames of a single channel, plane and ROI, demultiplexed from the 
+    ScanImage messages (see ScanImage.subscribe). Frames are optionally 
+    copied into a ring buffer, in which case the emitted arrays are views 
+    on the ring buffer. Frames that do not fit the ring buffer are 
+    dropped and counted.
+    '''
+
+    image_ready = pyqtSignal(np.ndarray)
+
+    def __init__(self, key: StreamKey, ring_buffer: Optional[RingBuffer] = None, *args, **kwargs):
+
+        super().__init__(*args, **kwargs)
+        self.key = key
+        self.ring_buffer = ring_buffer
+        self.ring_error = False
+        self.num_frames = 0
+        self.num_dropped = 0
+
+    def push(self, header: FrameHeader, image: NDArray) -> None:
+
+        if self.ring_buffer is not None:
+            try:
+                image = self.ring_buffer.write(image, header.frame_index, header.timestamp)
+            except (ValueError, TypeError) as error:
+                # runs in the receiver thread, a malformed frame must not stop it
+                if not self.ring_error:
+                    print(f'{self.key}: frame not written to ring buffer: {error}')
+                self.ring_error = True
+                self.num_dropped += 1
+                return
+        self.num_frames += 1
+        self.image_ready.emit(image)
+
 class ScanImage(QObject):
 
     image_ready = pyqtSignal(np.ndarray)
+    # frame index, timestamp at the source, timestamp at reception 
+    frame_delivered = pyqtSignal(int, float, float)
 
-    def __init__(self, protocol: str, host: str, port: int, *args, **kwargs) -> None:
+    def __init__(
+            self, 
+            protocol: str, 
+            host: str, 
+            port: int, 
+            rcvhwm: int = 1000, 
+            latency_history: int = 1000,
+            *args, **kwargs
+        ) -> None:
 
         super().__init__(*args, **kwargs)
 
         self.context = zmq.Context()
 
-        # get images from scanimage
+        # statistics
+        self.num_received = 0
+        self.num_dropped = 0
+        self.num_malformed = 0
+        self.num_displayed = 0
+        self.latency = deque(maxlen=latency_history)
+
+        # demultiplexed streams with subscribers
+        self.streams = {}
+
+        # set when no frame is waiting to be processed by the GUI
+        self.display_ready = threading.Event()
+        self.display_ready.set()
+        self.frame_delivered.connect(self.on_frame_delivered)
+
+        # get images from scanimage. The high-water mark bounds the
+        # number of frames queued on this side of the socket
         address_image = protocol + host + ":" + str(port)
         self.socket_image = self.context.socket(zmq.PULL)
+        self.socket_image.setsockopt(zmq.RCVHWM, rcvhwm)
         self.socket_image.connect(address_image)
     
-    def get_image(self) -> np.ndarray:
-        message = self.socket_image.recv()
-        image = deserialize(message.decode())
+    def decode(self, parts: List) -> List[Tuple[FrameHeader, NDArray]]:
+        '''
+        Decode one message into a list of frames. The format is detected 
+        for each message, so ScanImage can send either binary or text frames.
+        Raises ValueError for malformed messages
+        '''
+
+        if is_binary(parts):
+            return decode_binary(parts)
+        
+        # legacy text format: single frame, no metadata, use local frame 
+        # count and clock
+        image = deserialize_fast(parts[0].bytes)
         image = np.clip(image,0,1)
+        header = FrameHeader(self.num_received, 0, time.time(), image.shape, image.dtype)
+        return [(header, image)]
+
+    def recv_frames(self, timeout_ms: Optional[int] = None) -> List[Tuple[FrameHeader, NDArray]]:
+        '''
+        Receive all the frames (channels, planes, ROIs) of the next message. 
+        Blocks until a message arrives, or returns [] after timeout_ms if set
+        '''
+
+        if timeout_ms is not None and not self.socket_image.poll(timeout_ms):
+            return []
+
+        parts = self.socket_image.recv_multipart(copy=False)
+        self.num_received += 1
+        return self.decode(parts)
+
+    def recv_frame(self, timeout_ms: Optional[int] = None) -> Tuple[Optional[FrameHeader], Optional[NDArray]]:
+        '''Receive the first frame of the next message with its metadata'''
+
+        frames = self.recv_frames(timeout_ms)
+        if not frames:
+            return None, None
+        return frames[0]
+
+    def recv_latest(self, timeout_ms: int = 100) -> List[Tuple[FrameHeader, NDArray]]:
+        '''
+        Drain the socket and decode only the newest message, older messages
+        are counted as dropped. Returns [] on timeout
+        '''
+
+        if not self.socket_image.poll(timeout_ms):
+            return []
+
+        parts = self.socket_image.recv_multipart(copy=False)
+        self.num_received += 1
+        while True:
+            try:
+                parts = self.socket_image.recv_multipart(zmq.NOBLOCK, copy=False)
+            except zmq.Again:
+                break
+            self.num_received += 1
+            self.num_dropped += 1
+
+        return self.decode(parts)
+
+    def get_image(self) -> np.ndarray:
+        _, image = self.recv_frame()
         return image
 
+    def subscribe(
+            self, 
+            channel: int, 
+            plane: int = 0, 
+            roi: int = 0, 
+            ring_buffer: Optional[RingBuffer] = None
+        ) -> FrameStream:
+        '''
+        Get the stream of frames of one channel, plane and ROI. Frames of 
+        streams without subscribers are skipped by the receiver
+        '''
+
+        key = StreamKey(channel, plane, roi)
+        if key not in self.streams:
+            stream = FrameStream(key, ring_buffer)
+            self.streams[key] = stream
+        return self.streams[key]
+
+    def unsubscribe(self, channel: int, plane: int = 0, roi: int = 0) -> None:
+        self.streams.pop(StreamKey(channel, plane, roi), None)
+
+    def demultiplex(self, frames: List[Tuple[FrameHeader, NDArray]]) -> None:
+        '''send frames to the streams they belong to'''
+
+        for header, image in frames:
+            stream = self.streams.get(header.stream)
+            if stream is not None:
+                stream.push(header, image)
+
+    @pyqtSlot(int, float, float)
+    def on_frame_delivered(self, frame_index: int, sent: float, received: float):
+        # queued behind image_ready: runs once every slot connected to
+        # image_ready has processed the frame
+        displayed = time.time()
+        self.latency.append((frame_index, received - sent, displayed - sent))
+        self.num_displayed += 1
+        self.display_ready.set()
+
+    def get_statistics(self) -> Dict:
+        '''
+        Frame counters and end-to-end latencies (in seconds, from the 
+        timestamp set by ScanImage) to reception and to display
+        '''
+
+        latency = np.array(self.latency, dtype=np.float64).reshape(-1,3)
+        return {
+            'received': self.num_received,
+            'dropped': self.num_dropped,
+            'malformed': self.num_malformed,
+            'displayed': self.num_displayed,
+            'frame_index': latency[:,0].astype(np.int64),
+            'receive_latency': latency[:,1],
+            'display_latency': latency[:,2]
+        }
+
 class ImageSender(QRunnable):
+    '''
+    Receive frames in a worker thread and emit them to the GUI. 
+    
+    With conflate, frames are not queued behind a slow GUI: only the 
+    newest frame is emitted once the previous one was processed (latest
+    frame wins). 
+    
+    With a ring buffer, every frame is copied into shared memory and the 
+    emitted arrays are views on the ring buffer. Consumers that keep a 
+    frame longer than the ring buffer length should copy it.
+    Frames that do not fit the ring buffer are emitted as they are.
+
+    With a recorder, every frame is queued for writing to disk.
+
+    Conflation, ring buffer, recorder and image_ready apply to the main 
+    stream: one channel, plane and ROI, or the first frame of each 
+    message if stream is None. Every frame is also dispatched to the 
+    streams subscribed with ScanImage.subscribe.
+    '''
 
-    def __init__(self, scan_image: ScanImage, *args, **kwargs):
+    TIMEOUT_MS = 100
+
+    def __init__(
+            self, 
+            scan_image: ScanImage, 
+            conflate: bool = False, 
+            ring_buffer: Optional[RingBuffer] = None, 
+            recorder: Optional[FrameRecorder] = None,
+            stream: Optional[StreamKey] = None,
+            *args, **kwargs
+        ):
 
         super().__init__(*args, **kwargs)
         
         self.scan_image = scan_image
+        self.conflate = conflate
+        self.ring_buffer = ring_buffer
+        self.ring_error = False
+        self.recorder = recorder
+        self.record_error = False
+        self.stream = stream
         self.keepgoing = True
     
     def stop(self):
         self.keepgoing = False
 
+    def receive(self) -> List[Tuple[FrameHeader, NDArray]]:
+
+        display_only = self.ring_buffer is None and self.recorder is None and not self.scan_image.streams
+        if self.conflate and display_only:
+            # frames are only needed for display: wait for the GUI and 
+            # skip decoding of older frames
+            if not self.scan_image.display_ready.wait(self.TIMEOUT_MS/1000):
+                return []
+            return self.scan_image.recv_latest(self.TIMEOUT_MS)
+
+        return self.scan_image.recv_frames(self.TIMEOUT_MS)
+
+    def select(self, frames: List[Tuple[FrameHeader, NDArray]]) -> Tuple[Optional[FrameHeader], Optional[NDArray]]:
+        '''get the frame of the main stream'''
+
+        if self.stream is None:
+            return frames[0]
+        
+        for header, image in frames:
+            if header.stream == self.stream:
+                return header, image
+        
+        return None, None
+
+    def store(self, header: FrameHeader, image: NDArray) -> NDArray:
+        '''
+        Queue the frame for recording and copy it into the ring buffer.
+        Returns the view on the ring buffer, or the frame itself if it 
+        could not be stored. Failures are reported once: they must not 
+        stop the receiver thread.
+        '''
+
+        if self.recorder is not None:
+            try:
+                self.recorder.put(image, header.frame_index, header.timestamp)
+            except (ValueError, TypeError) as error:
+                if not self.record_error:
+                    print(f'frame not recorded: {error}')
+                self.record_error = True
+
+        if self.ring_buffer is not None:
+            try:
+                image = self.ring_buffer.write(image, header.frame_index, header.timestamp)
+            except (ValueError, TypeError) as error:
+                if not self.ring_error:
+                    print(f'frame not written to ring buffer: {error}')
+                self.ring_error = True
+
+        return image
+
     def run(self):
         while self.keepgoing:
-            image = self.scan_image.get_image()
+
+            try:
+                frames = self.receive()
+            except ValueError as error:
+                # a malformed message must not stop the receiver, it is 
+                # reported once and counted 
+                if self.scan_image.num_malformed == 0:
+                    print(f'malformed message dropped: {error}')
+                self.scan_image.num_malformed += 1
+                continue
+            if not frames:
+                continue
+            received = time.time()
+
+            self.scan_image.demultiplex(frames)
+            header, image = self.select(frames)
+            if image is None:
+                continue
+
+            image = self.store(header, image)
+
+            if self.conflate and not self.scan_image.display_ready.is_set():
+                # GUI still busy with the previous frame
+                self.scan_image.num_dropped += 1
+                continue
+
+            self.scan_image.display_ready.clear()
             self.scan_image.image_ready.emit(image)
+            self.scan_image.frame_delivered.emit(header.frame_index, header.timestamp, received)
 
 class TwoPhoton(QWidget):
+    '''
+    Display 2P frames. Frames arriving faster than max_refresh_rate are 
+    skipped, the latest skipped frame is displayed once the refresh 
+    interval has passed so that the last frame of a burst is shown. 
+    Frames are downsampled to the widget size before conversion to uint8,
+    into a preallocated buffer wrapped by a QImage that is painted 
+    directly, so nothing is allocated per frame.
+    '''
 
-    def __init__(self, sender: ImageSender, *args, **kwargs):
+    def __init__(
+            self, 
+            sender: ImageSender, 
+            max_refresh_rate: float = 30, 
+            size: int = 512, 
+            timing_history: int = 1000,
+            *args, **kwargs
+        ):
 
         super().__init__(*args, **kwargs)
 
@@ -61,15 +470,116 @@ class TwoPhoton(QWidget):
         self.thread_pool = QThreadPool()
         self.thread_pool.start(sender)
 
-        self.twop_image = QLabel(self)
-        self.twop_image.setFixedWidth(512)
-        self.twop_image.setFixedHeight(512)
+        self.setFixedWidth(size)
+        self.setFixedHeight(size)
+
+        self.max_refresh_rate = max_refresh_rate
+        self.last_display = -np.inf
+        self.num_displayed = 0
+        self.num_skipped = 0
+        self.gui_time = deque(maxlen=timing_history)
+
+        # latest skipped frame, displayed when the timer fires
+        self.pending = None
+        self.pending_timer = QTimer(self)
+        self.pending_timer.setSingleShot(True)
+        self.pending_timer.setTimerType(Qt.PreciseTimer)
+        self.pending_timer.timeout.connect(self.display_pending)
+
+        # display buffers, allocated for the first frame and when the 
+        # frame shape changes
+        self.input_shape = None
+        self.scaled = None
+        self.display_buffer = None
+        self.qimage = None
+        self.convert_time = 0
+        self.new_frame = False
+
+    def allocate(self, shape: Tuple[int, int]) -> None:
+
+        # fit frame in widget, keep aspect ratio
+        scale = min(self.width()/shape[1], self.height()/shape[0])
+        height = max(1, int(shape[0]*scale))
+        width = max(1, int(shape[1]*scale))
+
+        self.input_shape = shape
+        self.scaled = np.zeros((height, width), np.float32)
+        self.display_buffer = np.zeros((height, width), np.uint8)
+        self.qimage = QImage(
+            self.display_buffer.data, 
+            width, 
+            height, 
+            self.display_buffer.strides[0], 
+            QImage.Format_Grayscale8
+        )
 
     @pyqtSlot(np.ndarray)
     def display(self, image: NDArray):
-        image = im2uint8(image)
-        self.twop_image.setPixmap(NDarray_to_QPixmap(image))
+
+        start = time.perf_counter()
+        wait = self.last_display + 1/self.max_refresh_rate - start
+        if wait > 0:
+            if self.pending is not None:
+                self.num_skipped += 1
+            self.pending = image
+            if not self.pending_timer.isActive():
+                self.pending_timer.start(int(np.ceil(1000*wait)))
+            return
+        self.last_display = start
+        if self.pending is not None:
+            # superseded by this frame
+            self.num_skipped += 1
+            self.pending = None
+            self.pending_timer.stop()
+
+        if image.shape != self.input_shape:
+            self.allocate(image.shape)
+
+        height, width = self.display_buffer.shape
+        if image.dtype == np.float32:
+            cv2.resize(image, (width, height), dst=self.scaled, interpolation=cv2.INTER_AREA)
+            np.multiply(self.scaled, 255, out=self.scaled)
+            np.clip(self.scaled, 0, 255, out=self.scaled)
+            np.copyto(self.display_buffer, self.scaled, casting='unsafe')
+        else:
+            # other dtypes are rare, use the generic conversion 
+            cv2.resize(im2uint8(image), (width, height), dst=self.display_buffer, interpolation=cv2.INTER_AREA)
+
+        self.convert_time = time.perf_counter() - start
+        self.new_frame = True
         self.update()
 
+    def display_pending(self):
+        image, self.pending = self.pending, None
+        if image is not None:
+            self.display(image)
+
+    def paintEvent(self, event):
+
+        if self.qimage is None:
+            return
+
+        start = time.perf_counter()
+        painter = QPainter(self)
+        painter.drawImage(0, 0, self.qimage)
+        painter.end()
+
+        # repaints (resize, expose) that do not show a new frame are not counted
+        if self.new_frame:
+            self.new_frame = False
+            self.gui_time.append(self.convert_time + time.perf_counter() - start)
+            self.num_displayed += 1
+
+    def get_statistics(self) -> Dict:
+        '''displayed and skipped frames, GUI time (s) per displayed frame'''
+
+        gui_time = np.array(self.gui_time)
+        return {
+            'displayed': self.num_displayed,
+            'skipped': self.num_skipped,
+            'gui_time_mean': gui_time.mean() if gui_time.size else np.nan,
+            'gui_time_max': gui_time.max() if gui_time.size else np.nan
+        }
+
     def closeEvent(self, event):
         self.sender.stop()
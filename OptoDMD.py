@@ -1,4 +1,7 @@
 from Microscope import ImageSender, ScanImage
+from RingBuffer import RingBuffer
+from Recorder import FrameRecorder, new_session
+from Latency import latency_probe, Photodiode
 from DrawMasks import  MaskManager, DrawPolyMaskOpto, DrawPolyMaskOptoDMD
 from daq import LabJackU3LV
 from LED import LEDD1B, LEDWidget
@@ -19,6 +22,11 @@ if __name__ == "__main__":
     PROTOCOL = "tcp://"
     HOST = "o1-317"
     PORT = 5555
+    RCVHWM = 10 # max number of 2P frames queued on the receiving side
+    TWOP_HEIGHT = 512
+    TWOP_WIDTH = 512
+    RING_SLOTS = 64 # 2P frames kept in shared memory
+    RING_NAME = 'OptoDMD_twop'
     
     # dmd settings
     SCREEN_DMD = 1
@@ -27,6 +35,17 @@ if __name__ == "__main__":
 
     # labjack settingss
     PWM_CHANNEL = 6
+    LED_SERIAL = None # serial number of the LED LabJack, None for the first found
+
+    # latency instrumentation, photodiode on the analog input of a second 
+    # LabJack: analogRead disables the timers of the LabJack driving the LED
+    MEASURE_LATENCY = False
+    PHOTODIODE_SERIAL = None # serial number of the photodiode LabJack 
+    PHOTODIODE_CHANNEL = 0
+
+    # recording settings
+    RECORD = False
+    RECORD_DIRECTORY = 'recording' # each run records to a new timestamped subdirectory
 
     # calibration file
     transformations = np.tile(np.eye(3), (3,3,1,1))
@@ -47,8 +66,15 @@ if __name__ == "__main__":
     app = QApplication(sys.argv)
 
     # Communication with ScanImage
-    scan_image = ScanImage(PROTOCOL, HOST, PORT)
-    twop_sender = ImageSender(scan_image)
+    scan_image = ScanImage(PROTOCOL, HOST, PORT, rcvhwm=RCVHWM)
+    # replace: the segment of a previous run that crashed is still there on POSIX 
+    twop_ring = RingBuffer(RING_SLOTS, (TWOP_HEIGHT, TWOP_WIDTH), np.float32, name=RING_NAME, replace=True)
+    twop_recorder = None
+    if RECORD:
+        session_directory = new_session(RECORD_DIRECTORY)
+        twop_recorder = FrameRecorder(session_directory, name='twop')
+        twop_recorder.start()
+    twop_sender = ImageSender(scan_image, conflate=True, ring_buffer=twop_ring, recorder=twop_recorder)
     thread_pool = QThreadPool()
     thread_pool.start(twop_sender)
 
@@ -56,20 +82,32 @@ if __name__ == "__main__":
     cam = XimeaCamera(1)
     camera_controls = CameraControl(cam)
     camera_controls.show()
+    if RECORD:
+        cam_recorder = FrameRecorder(session_directory, name='camera')
+        cam_recorder.start()
+        camera_controls.image_ready.connect(cam_recorder.put)
 
     # Control LEDs
-    daio = LabJackU3LV()
+    daio = LabJackU3LV(serial_number=LED_SERIAL)
     led = LEDD1B(daio, pwm_channel=PWM_CHANNEL, name = "465 nm") 
     led_widget = LEDWidget(led_drivers=[led])
     led_widget.show()
 
+    if MEASURE_LATENCY:
+        latency_probe.enabled = True
+        if PHOTODIODE_SERIAL is None or PHOTODIODE_SERIAL == LED_SERIAL:
+            print('the photodiode needs its own LabJack (PHOTODIODE_SERIAL), latency measured without light detection')
+        else:
+            photodiode_daio = LabJackU3LV(serial_number=PHOTODIODE_SERIAL)
+            latency_probe.set_photodiode(Photodiode(photodiode_daio, channel=PHOTODIODE_CHANNEL))
+
     # Control DMD
     dmd_widget = DMD(screen_num=SCREEN_DMD)
 
     # Masks
     cam_drawer = DrawPolyMask(np.zeros((512,512)))
     dmd_drawer = DrawPolyMask(np.zeros((DMD_HEIGHT,DMD_WIDTH)))
-    twop_drawer = DrawPolyMask(np.zeros((512,512)))
+    twop_drawer = DrawPolyMask(np.zeros((TWOP_HEIGHT,TWOP_WIDTH)))
 
     cam_mask = DrawPolyMaskOpto(cam_drawer)
     dmd_mask = DrawPolyMaskOptoDMD(dmd_drawer)
@@ -82,9 +120,22 @@ if __name__ == "__main__":
     dmd_mask.DMD_update.connect(dmd_widget.update_image)
     masks.mask_expose.connect(dmd_mask.expose)
     masks.clear_dmd.connect(dmd_mask.clear)
+    masks.masks_expose.connect(dmd_mask.expose_weighted)
+    masks.visible_expose.connect(dmd_mask.expose_visible)
+    masks.bitplane_expose.connect(dmd_mask.expose_visible_bitplanes)
+    dmd_mask.DMD_sequence.connect(dmd_widget.play_sequence)
     camera_controls.image_ready.connect(cam_mask.set_image)
-    twop_sender.scan_image.image_ready.connect(twop_mask.set_image)
+    # frames are views on ring buffer slots, overwritten RING_SLOTS frames 
+    # later. The drawer keeps its image, give it a copy
+    twop_sender.scan_image.image_ready.connect(lambda image: twop_mask.set_image(image.copy()))
 
     app.exec()
 
     twop_sender.stop()
+    if MEASURE_LATENCY:
+        print(latency_probe.report())
+    thread_pool.waitForDone()
+    if RECORD:
+        twop_recorder.stop()
+        cam_recorder.stop()
+    twop_ring.close()
\ No newline at end of file
@@ -0,0 +1,194 @@
+import numpy as np
+from numpy.typing import NDArray
+from collections import OrderedDict
+from typing import Tuple, Dict, Callable, Iterable
+
+# patterns are built from an open grid (a column and a row) and broadcast,
+# a full meshgrid is never allocated
+
+def checkerboard(shape: Tuple[int, int], cell_size: int, phase: int = 0) -> NDArray:
+    '''checkerboard, phase 1 swaps black and white cells'''
+
+    y, x = np.ogrid[0:shape[0], 0:shape[1]]
+    rows = (y // cell_size + phase) % 2
+    cols = (x // cell_size) % 2
+    return (rows != cols).astype(np.float32)
+
+def grating(
+        shape: Tuple[int, int],
+        period: float,
+        angle: float = 0,
+        phase: float = 0,
+        square: bool = False
+    ) -> NDArray:
+    '''
+    Sinusoidal grating with values in [0, 1], or a square-wave grating.
+    angle (degrees) is the direction of motion, phase is in cycles.
+    '''
+
+    y, x = np.ogrid[0:shape[0], 0:shape[1]]
+    theta = np.deg2rad(angle)
+    cycles = (x * np.cos(theta) + y * np.sin(theta)) / period + phase
+    if square:
+        return (np.mod(cycles, 1) < 0.5).astype(np.float32)
+    return (0.5 + 0.5 * np.cos(2 * np.pi * cycles)).astype(np.float32)
+
+def spot_grid(
+        shape: Tuple[int, int],
+        spacing: int,
+        radius: float,
+        density: float = 1,
+        seed: int = 0
+    ) -> NDArray:
+    '''
+    Discs centered on a square grid. With density < 1 a random subset of
+    grid positions is lit (sparse noise), reproducible through the seed.
+    '''
+
+    y, x = np.ogrid[0:shape[0], 0:shape[1]]
+    rows, cols = -(-shape[0] // spacing), -(-shape[1] // spacing)
+    lit = np.random.default_rng(seed).random((rows, cols)) < density
+
+    center = (spacing - 1) / 2
+    dy, dx = (y % spacing) - center, (x % spacing) - center
+    inside = dy * dy + dx * dx <= radius * radius
+    return (inside & lit[y // spacing, x // spacing]).astype(np.float32)
+
+def tile(shape: Tuple[int, int], grid: Tuple[int, int], index: int) -> NDArray:
+    '''one tile of a rows x cols tiling of the frame, for receptive-field mapping'''
+
+    rows, cols = grid
+    row, col = divmod(index, cols)
+    top, bottom = row * shape[0] // rows, (row + 1) * shape[0] // rows
+    left, right = col * shape[1] // cols, (col + 1) * shape[1] // cols
+    pattern = np.zeros(shape, np.float32)
+    pattern[top:bottom, left:right] = 1
+    return pattern
+
+def whole_field(shape: Tuple[int, int]) -> NDArray:
+    return np.ones(shape, np.float32)
+
+# sequences, stacked (num_frames, height, width) as uint8 frames for the DMD.
+# The player only converts them all to 32-bit pixmaps when they fit its 
+# pixmap budget, longer sequences stay uint8: sequences are limited in 
+# frames and in uint8 bytes
+MAX_SEQUENCE_FRAMES = 256
+MAX_SEQUENCE_BYTES = 512*1024**2
+
+def check_sequence_size(num_frames: int, shape: Tuple[int, int]) -> None:
+
+    num_bytes = num_frames * shape[0] * shape[1]
+    if num_frames > MAX_SEQUENCE_FRAMES or num_bytes > MAX_SEQUENCE_BYTES:
+        raise ValueError(
+            f'sequence of {num_frames} frames ({num_bytes / 1024**2:.0f} MB) exceeds '
+            f'{MAX_SEQUENCE_FRAMES} frames or {MAX_SEQUENCE_BYTES / 1024**2:.0f} MB'
+        )
+
+def stack_frames(patterns: Iterable[NDArray], num_frames: int, shape: Tuple[int, int]) -> NDArray:
+    '''patterns are generated one at a time, straight into the stack'''
+
+    check_sequence_size(num_frames, shape)
+    frames = np.empty((num_frames,) + tuple(shape), np.uint8)
+    for frame, pattern in zip(frames, patterns):
+        np.rint(255 * pattern, out=frame, casting='unsafe')
+    return frames
+
+def checkerboard_sequence(shape: Tuple[int, int], cell_size: int) -> NDArray:
+    '''alternating checkerboard'''
+    return stack_frames((checkerboard(shape, cell_size, phase) for phase in (0, 1)), 2, shape)
+
+def grating_sequence(
+        shape: Tuple[int, int],
+        period: float,
+        angle: float = 0,
+        num_frames: int = 16,
+        square: bool = False
+    ) -> NDArray:
+    '''one cycle of a drifting grating'''
+    return stack_frames((grating(shape, period, angle, n / num_frames, square) for n in range(num_frames)), num_frames, shape)
+
+def spot_sequence(
+        shape: Tuple[int, int],
+        spacing: int,
+        radius: float,
+        density: float = 0.1,
+        num_frames: int = 16,
+        seed: int = 0
+    ) -> NDArray:
+    '''sparse random spots, a different subset on each frame'''
+    return stack_frames((spot_grid(shape, spacing, radius, density, seed + n) for n in range(num_frames)), num_frames, shape)
+
+def tile_sequence(shape: Tuple[int, int], grid: Tuple[int, int]) -> NDArray:
+    '''each tile of the grid in turn'''
+    
+    num_frames = grid[0] * grid[1]
+    return stack_frames((tile(shape, grid, index) for index in range(num_frames)), num_frames, shape)
+
+PATTERNS = {
+    'checkerboard': checkerboard,
+    'grating': grating,
+    'spot grid': spot_grid,
+    'tile': tile,
+    'whole field': whole_field
+}
+
+SEQUENCES = {
+    'checkerboard': checkerboard_sequence,
+    'drifting grating': grating_sequence,
+    'sparse spots': spot_sequence,
+    'tiles': tile_sequence
+}
+
+class PatternBank:
+    '''
+    Generated patterns and sequences, memoized by name and parameters.
+    The least recently used entries are dropped once the cache exceeds
+    max_bytes. Returned arrays are read-only since they are shared, which
+    also keeps their identity stable for the DMD pixmap cache.
+    '''
+
+    def __init__(self, max_bytes: int = 256*1024**2) -> None:
+        self.max_bytes = max_bytes
+        self.cache = OrderedDict()
+        self.num_bytes = 0
+        self.num_hits = 0
+        self.num_misses = 0
+
+    def get(self, generator: Callable[..., NDArray], *args, **kwargs) -> NDArray:
+
+        key = (generator.__name__, args, tuple(sorted(kwargs.items())))
+        if key in self.cache:
+            self.num_hits += 1
+            self.cache.move_to_end(key)
+            return self.cache[key]
+
+        self.num_misses += 1
+        pattern = generator(*args, **kwargs)
+        pattern.flags.writeable = False
+        if pattern.nbytes <= self.max_bytes:
+            self.cache[key] = pattern
+            self.num_bytes += pattern.nbytes
+            while self.num_bytes > self.max_bytes:
+                _, evicted = self.cache.popitem(last=False)
+                self.num_bytes -= evicted.nbytes
+        return pattern
+
+    def pattern(self, name: str, shape: Tuple[int, int], *args, **kwargs) -> NDArray:
+        return self.get(PATTERNS[name], tuple(shape), *args, **kwargs)
+
+    def sequence(self, name: str, shape: Tuple[int, int], *args, **kwargs) -> NDArray:
+        return self.get(SEQUENCES[name], tuple(shape), *args, **kwargs)
+
+    def clear(self) -> None:
+        self.cache.clear()
+        self.num_bytes = 0
+
+    def get_statistics(self) -> Dict:
+        return {
+            'entries': len(self.cache),
+            'bytes': self.num_bytes,
+            'hits': self.num_hits,
+            'misses': self.num_misses
+        }
+
+pattern_bank = PatternBank()
\ No newline at end of file
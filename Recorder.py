@@ -0,0 +1,238 @@
+import os
+import json
+import time
+import queue
+import threading
+import numpy as np
+from numpy.typing import NDArray
+from typing import Optional, List, Tuple, Dict
+
+# per-frame metadata stored next to each segment
+METADATA_DTYPE = np.dtype([('frame_index', np.int64), ('timestamp', np.float64)])
+
+class FrameRecorder:
+    '''
+    Record frames to disk from a background thread, in a directory of
+    its own (see new_session): a recording never overwrites another one.
+
+    put() copies the frame into a bounded queue and returns immediately, 
+    so it can be called from the receiver thread or the Qt event loop.
+    When the queue is full the frame is dropped and counted.
+    The writer thread takes frames in batches and appends them to 
+    memory-mapped npy segments of frames_per_segment frames:
+
+        {name}_{segment:05d}.npy        frames
+        {name}_{segment:05d}_meta.npy   frame index and timestamp 
+        {name}.json                     manifest, list of segments
+
+    Shape and dtype are taken from the first frame, frames that do not
+    match are dropped. Unused rows of the last segment have frame 
+    index -1 (see load_recording).
+    '''
+
+    def __init__(
+            self,
+            directory: str,
+            name: str = 'frames',
+            frames_per_segment: int = 1000,
+            queue_size: int = 256,
+            batch_size: int = 16
+        ) -> None:
+
+        self.directory = directory
+        self.name = name
+        self.frames_per_segment = frames_per_segment
+        self.batch_size = batch_size
+        self.queue = queue.Queue(maxsize=queue_size)
+
+        self.shape = None
+        self.dtype = None
+        self.segment = None
+        self.metadata = None
+        self.segment_index = -1
+        self.position = 0
+        
+        self.num_received = 0
+        self.num_written = 0
+        self.num_dropped = 0
+        
+        self.keepgoing = False
+        self.thread = None
+
+    @property
+    def manifest_path(self) -> str:
+        return os.path.join(self.directory, f'{self.name}.json')
+
+    def start(self) -> None:
+        os.makedirs(self.directory, exist_ok=True)
+        if os.path.exists(self.manifest_path):
+            raise FileExistsError(f'{self.manifest_path} exists, record to a new session directory')
+        self.keepgoing = True
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self) -> None:
+        '''write remaining frames and close the files'''
+        self.keepgoing = False
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def put(self, image: NDArray, frame_index: Optional[int] = None, timestamp: Optional[float] = None) -> bool:
+        '''queue a copy of the frame, returns False if it was dropped'''
+
+        if frame_index is None:
+            frame_index = self.num_received
+        if timestamp is None:
+            timestamp = time.time()
+        self.num_received += 1
+        
+        if self.shape is None:
+            self.shape, self.dtype = image.shape, image.dtype
+
+        if image.shape != self.shape or image.dtype != self.dtype:
+            self.num_dropped += 1
+            return False
+
+        try:
+            self.queue.put_nowait((np.array(image, copy=True), frame_index, timestamp))
+        except queue.Full:
+            self.num_dropped += 1
+            return False
+        
+        return True
+
+    def get_statistics(self) -> Dict:
+        return {
+            'received': self.num_received,
+            'written': self.num_written,
+            'dropped': self.num_dropped,
+            'backlog': self.queue.qsize()
+        }
+
+    def next_segment(self) -> None:
+
+        self.close_segment()
+        self.segment_index += 1
+        self.position = 0
+
+        prefix = os.path.join(self.directory, f'{self.name}_{self.segment_index:05d}')
+        self.segment = np.lib.format.open_memmap(
+            prefix + '.npy', 
+            mode='w+', 
+            dtype=self.dtype, 
+            shape=(self.frames_per_segment,) + self.shape
+        )
+        self.metadata = np.lib.format.open_memmap(
+            prefix + '_meta.npy', 
+            mode='w+', 
+            dtype=METADATA_DTYPE, 
+            shape=(self.frames_per_segment,)
+        )
+        self.metadata['frame_index'] = -1
+        self.metadata['timestamp'] = np.nan
+        self.write_manifest(complete=False)
+
+    def write_manifest(self, complete: bool) -> None:
+        '''
+        Segments are listed as soon as they are created, so that the
+        recording can be read after a crash
+        '''
+
+        manifest = {
+            'name': self.name,
+            'shape': list(self.shape),
+            'dtype': np.dtype(self.dtype).str,
+            'frames_per_segment': self.frames_per_segment,
+            'segments': [f'{self.name}_{index:05d}' for index in range(self.segment_index + 1)],
+            'complete': complete
+        }
+        with open(self.manifest_path, 'w') as f:
+            json.dump(manifest, f, indent=2)
+
+    def close_segment(self) -> None:
+        if self.segment is not None:
+            self.segment.flush()
+            self.metadata.flush()
+            self.segment = None
+            self.metadata = None
+
+    def write(self, batch: List[Tuple[NDArray, int, float]]) -> None:
+
+        while batch:
+            if self.segment is None or self.position == self.frames_per_segment:
+                self.next_segment()
+
+            # frames that fit in the current segment
+            n = min(len(batch), self.frames_per_segment - self.position)
+            rows = slice(self.position, self.position + n)
+            for dst, (image, _, _) in zip(self.segment[rows], batch[:n]):
+                dst[...] = image
+            self.metadata[rows] = [(index, timestamp) for _, index, timestamp in batch[:n]]
+            
+            self.position += n
+            self.num_written += n
+            batch = batch[n:]
+
+    def run(self) -> None:
+
+        while self.keepgoing or not self.queue.empty():
+
+            try:
+                batch = [self.queue.get(timeout=0.1)]
+            except queue.Empty:
+                continue
+
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            self.write(batch)
+
+        self.close_segment()
+        if self.segment_index >= 0:
+            self.write_manifest(complete=True)
+
+def new_session(root: str) -> str:
+    '''create a new, timestamped, recording directory in root'''
+
+    stamp = time.strftime('%Y%m%d_%H%M%S')
+    suffix = 0
+    while True:
+        directory = os.path.join(root, stamp if suffix == 0 else f'{stamp}_{suffix}')
+        try:
+            os.makedirs(directory, exist_ok=False)
+            return directory
+        except FileExistsError:
+            suffix += 1
+
+def load_recording(directory: str, name: str = 'frames') -> Tuple[List[NDArray], NDArray]:
+    '''
+    Open a recording without loading it in memory: returns the list of 
+    memory-mapped segments (trimmed to recorded frames) and the 
+    concatenated metadata. Only the segments listed in the manifest 
+    are read
+    '''
+
+    manifest_path = os.path.join(directory, f'{name}.json')
+    if not os.path.exists(manifest_path):
+        return [], np.zeros((0,), METADATA_DTYPE)
+
+    with open(manifest_path, 'r') as f:
+        manifest = json.load(f)
+
+    segments = []
+    metadata = []
+    for segment in manifest['segments']:
+        prefix = os.path.join(directory, segment)
+        meta = np.load(prefix + '_meta.npy')
+        num_frames = np.count_nonzero(meta['frame_index'] >= 0)
+        segments.append(np.load(prefix + '.npy', mmap_mode='r')[:num_frames])
+        metadata.append(meta[:num_frames])
+
+    if not metadata:
+        return [], np.zeros((0,), METADATA_DTYPE)
+
+    return segments, np.concatenate(metadata)
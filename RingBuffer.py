@@ -0,0 +1,195 @@
+from multiprocessing import shared_memory, resource_tracker
+import os
+import numpy as np
+from numpy.typing import NDArray, DTypeLike
+from typing import Optional, Tuple
+
+class RingBuffer:
+    '''
+    Fixed-size ring buffer of frames in shared memory, with one writer and
+    any number of readers, possibly in other processes (see attach). 
+    
+    Each write gets a sequence number (0, 1, 2, ...). Readers get views 
+    on the shared memory: no copy, no allocation, but a slot is 
+    overwritten num_slots writes later. The writer never waits for 
+    readers, use is_valid to check whether a view was overwritten and 
+    copy frames that must be kept longer.
+
+    Layout: header (int64), dtype string, then per-slot sequence number, 
+    frame index and timestamp, then frame data.
+    '''
+
+    MAGIC = 0x52494E47 # 'RING'
+    MAX_DIMS = 4
+    HEADER_SIZE = 64
+    DTYPE_SIZE = 16
+    ALIGN = 64
+
+    # header fields
+    H_MAGIC = 0
+    H_SLOTS = 1
+    H_NDIM = 2
+    H_SHAPE = 3
+    H_COUNT = H_SHAPE + MAX_DIMS
+
+    def __init__(
+            self, 
+            num_slots: int, 
+            shape: Tuple[int, ...], 
+            dtype: DTypeLike = np.float32, 
+            name: Optional[str] = None,
+            replace: bool = False
+        ) -> None:
+
+        if len(shape) > self.MAX_DIMS:
+            raise ValueError(f'frames can have at most {self.MAX_DIMS} dimensions')
+
+        if num_slots < 1:
+            raise ValueError('num_slots should be at least 1')
+
+        dtype = np.dtype(dtype)
+        size = self.get_size(num_slots, shape, dtype)
+        try:
+            self.shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+        except FileExistsError:
+            # on POSIX, a segment left behind by a crashed process is 
+            # still there. With replace, it is unlinked and created again
+            if not replace:
+                raise
+            self.unlink(name)
+            self.shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+        self.owner = True
+
+        header = np.ndarray((self.HEADER_SIZE//8,), np.int64, self.shm.buf)
+        header[:] = 0
+        header[self.H_MAGIC] = self.MAGIC
+        header[self.H_SLOTS] = num_slots
+        header[self.H_NDIM] = len(shape)
+        header[self.H_SHAPE:self.H_SHAPE+len(shape)] = shape
+        dtype_str = dtype.str.encode().ljust(self.DTYPE_SIZE, b'\x00')
+        self.shm.buf[self.HEADER_SIZE:self.HEADER_SIZE+self.DTYPE_SIZE] = dtype_str
+
+        self.map(num_slots, shape, dtype)
+        self.sequence[:] = -1
+
+    @classmethod
+    def attach(cls, name: str) -> 'RingBuffer':
+        '''attach to a ring buffer created by another process'''
+
+        ring = cls.__new__(cls)
+        ring.shm = shared_memory.SharedMemory(name=name, create=False)
+        ring.owner = False
+
+        # the creator is responsible for unlinking the shared memory
+        if os.name == 'posix':
+            resource_tracker.unregister(ring.shm._name, 'shared_memory')
+
+        header = np.ndarray((cls.HEADER_SIZE//8,), np.int64, ring.shm.buf)
+        if header[cls.H_MAGIC] != cls.MAGIC:
+            ring.shm.close()
+            raise ValueError(f'{name} is not a ring buffer')
+        
+        num_slots = int(header[cls.H_SLOTS])
+        ndim = int(header[cls.H_NDIM])
+        shape = tuple(int(x) for x in header[cls.H_SHAPE:cls.H_SHAPE+ndim])
+        dtype_str = bytes(ring.shm.buf[cls.HEADER_SIZE:cls.HEADER_SIZE+cls.DTYPE_SIZE])
+        dtype = np.dtype(dtype_str.rstrip(b'\x00').decode())
+        
+        ring.map(num_slots, shape, dtype)
+        return ring
+
+    @staticmethod
+    def unlink(name: str) -> None:
+        '''remove a shared memory segment, readers attached to it keep their mapping'''
+
+        try:
+            shm = shared_memory.SharedMemory(name=name, create=False)
+        except FileNotFoundError:
+            return
+        shm.close()
+        shm.unlink()
+
+    @classmethod
+    def get_offsets(cls, num_slots: int) -> Tuple[int, int]:
+        '''offsets of the per-slot metadata and of the frame data'''
+
+        meta_offset = cls.HEADER_SIZE + cls.DTYPE_SIZE
+        meta_size = 3 * 8 * num_slots
+        data_offset = cls.ALIGN * (-(-(meta_offset + meta_size) // cls.ALIGN))
+        return meta_offset, data_offset
+
+    @classmethod
+    def get_size(cls, num_slots: int, shape: Tuple[int, ...], dtype: np.dtype) -> int:
+        _, data_offset = cls.get_offsets(num_slots)
+        return data_offset + num_slots * int(np.prod(shape)) * dtype.itemsize
+
+    def map(self, num_slots: int, shape: Tuple[int, ...], dtype: np.dtype) -> None:
+        '''create numpy views on the shared memory'''
+
+        meta_offset, data_offset = self.get_offsets(num_slots)
+        buf = self.shm.buf
+        self.num_slots = num_slots
+        self.shape = shape
+        self.dtype = dtype
+        self.header = np.ndarray((self.HEADER_SIZE//8,), np.int64, buf)
+        self.sequence = np.ndarray((num_slots,), np.int64, buf, meta_offset)
+        self.frame_index = np.ndarray((num_slots,), np.int64, buf, meta_offset + 8*num_slots)
+        self.timestamp = np.ndarray((num_slots,), np.float64, buf, meta_offset + 16*num_slots)
+        self.data = np.ndarray((num_slots,) + shape, dtype, buf, data_offset)
+
+    @property
+    def name(self) -> str:
+        return self.shm.name
+
+    @property
+    def write_count(self) -> int:
+        '''number of frames written so far'''
+        return int(self.header[self.H_COUNT])
+
+    def write(self, image: NDArray, frame_index: int, timestamp: float) -> NDArray:
+        '''copy a frame into the next slot and return a view on that slot'''
+
+        if image.shape != self.shape:
+            raise ValueError(f'expected frame of shape {self.shape}, got {image.shape}')
+        if not np.can_cast(image.dtype, self.dtype, casting='same_kind'):
+            raise ValueError(f'cannot store {image.dtype} frames in a {self.dtype} ring buffer')
+
+        seq = self.write_count
+        slot = seq % self.num_slots
+
+        # invalidate slot while it is being written
+        self.sequence[slot] = -1 
+        np.copyto(self.data[slot], image, casting='same_kind')
+        self.frame_index[slot] = frame_index
+        self.timestamp[slot] = timestamp
+        self.sequence[slot] = seq
+        self.header[self.H_COUNT] = seq + 1
+
+        return self.data[slot]
+
+    def is_valid(self, seq: int) -> bool:
+        '''check that frame seq is still in the buffer'''
+        slot = seq % self.num_slots
+        return seq >= 0 and self.sequence[slot] == seq
+
+    def get(self, seq: int) -> Tuple[Optional[NDArray], int, float]:
+        '''
+        zero-copy view on frame seq with its frame index and timestamp, 
+        or (None, -1, nan) if it was overwritten or not written yet
+        '''
+
+        slot = seq % self.num_slots
+        if not self.is_valid(seq):
+            return None, -1, np.nan
+        return self.data[slot], int(self.frame_index[slot]), float(self.timestamp[slot])
+
+    def latest(self) -> Tuple[Optional[NDArray], int, float]:
+        '''zero-copy view on the newest frame with its frame index and timestamp'''
+        return self.get(self.write_count - 1)
+
+    def close(self) -> None:
+        # release numpy views before closing the shared memory
+        del self.header, self.sequence, self.frame_index, self.timestamp, self.data
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
@@ -0,0 +1,63 @@
+import cv2
+import numpy as np
+from numpy.typing import NDArray
+from typing import List, Optional
+from MaskStorage import CompactMask
+
+def local_contrast(image: NDArray, cell_diameter: float) -> NDArray:
+    '''
+    Image minus its local background, in units of local standard deviation.
+    Cells stand out at the same level in dim and bright parts of the field.
+    '''
+
+    image = np.asarray(image, np.float32)
+    if image.ndim == 3:
+        image = image.mean(axis=2)
+
+    sigma_background = 2 * cell_diameter
+    sigma_noise = max(cell_diameter / 8, 0.5)
+
+    detail = cv2.GaussianBlur(image, (0, 0), sigma_noise)
+    background = cv2.GaussianBlur(image, (0, 0), sigma_background)
+    detail -= background
+    variance = cv2.GaussianBlur(detail * detail, (0, 0), sigma_background)
+    return detail / (np.sqrt(variance) + 1e-6)
+
+def detect_rois(
+        image: NDArray,
+        cell_diameter: float = 12,
+        threshold: float = 1.5,
+        min_area: Optional[int] = None,
+        max_area: Optional[int] = None
+    ) -> List[CompactMask]:
+    '''
+    Find cell-like blobs in a mean 2P image or a camera frame:
+    local contrast, threshold, opening, then connected components.
+    Components far from the expected cell area are dropped.
+    '''
+
+    cell_area = np.pi * (cell_diameter / 2) ** 2
+    if min_area is None:
+        min_area = int(0.25 * cell_area)
+    if max_area is None:
+        max_area = int(4 * cell_area)
+
+    binary = (local_contrast(image, cell_diameter) > threshold).view(np.uint8)
+
+    # remove thin bridges and specks smaller than a fraction of a cell
+    radius = max(int(cell_diameter) // 6, 1)
+    kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (2*radius+1, 2*radius+1))
+    binary = cv2.morphologyEx(binary, cv2.MORPH_OPEN, kernel)
+
+    num_labels, labels, stats, centroids = cv2.connectedComponentsWithStats(binary, connectivity=4)
+    area = stats[:, cv2.CC_STAT_AREA]
+    keep = np.flatnonzero((area >= min_area) & (area <= max_area))
+    keep = keep[keep > 0] # 0 is the background
+
+    shape = labels.shape
+    rois = []
+    for label in keep:
+        x, y, w, h = stats[label, :4]
+        crop = labels[y:y+h, x:x+w] == label
+        rois.append(CompactMask.from_crop(shape, y, x, crop))
+    return rois
\ No newline at end of file
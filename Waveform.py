@@ -0,0 +1,261 @@
+import time
+import threading
+import numpy as np
+from typing import List, Dict, NamedTuple, Iterable, Tuple, Optional, TYPE_CHECKING
+
+# daq needs the device drivers, only for annotations here
+if TYPE_CHECKING:
+    from daq import DigitalAnalogIO
+
+# the last SPIN_MS before a deadline are busy-waited, sleep is too coarse
+SPIN_MS = 2
+
+class Edge(NamedTuple):
+    time: float # seconds from the start of the waveform
+    intensity: float # PWM duty cycle, 0 is off
+    frequency: Optional[float] = None # PWM frequency, None for the player's default
+
+def pulse_train(
+        frequency: float,
+        pulse_ms: float,
+        duration_s: float,
+        intensity: float = 1,
+        delay_s: float = 0
+    ) -> List[Edge]:
+    '''on/off edges of a regular pulse train'''
+
+    period = 1 / frequency
+    if pulse_ms / 1000 >= period:
+        raise ValueError(f'{pulse_ms} ms pulses do not fit in a {1000*period:.3f} ms period')
+
+    onsets = delay_s + period * np.arange(int(round(duration_s * frequency)))
+    edges = []
+    for onset in onsets:
+        edges.append(Edge(float(onset), intensity))
+        edges.append(Edge(float(onset + pulse_ms / 1000), 0))
+    return edges
+
+def schedule(events: Iterable[Tuple[float, float]]) -> List[Edge]:
+    '''arbitrary (time_s, intensity) schedule, e.g. ramps or on/off sequences'''
+
+    edges = sorted(Edge(float(t), float(intensity)) for t, intensity in events)
+    for edge in edges:
+        if not (0 <= edge.intensity <= 1):
+            raise ValueError('intensity should be between 0 and 1')
+    return edges
+
+class DeadlineClock:
+    '''
+    Wait for absolute deadlines on the monotonic perf_counter clock.
+    Sleeps until spin_ms before the deadline, then busy-waits. Deadlines
+    are absolute so that errors do not accumulate over a train.
+    '''
+
+    def __init__(self, spin_ms: float = SPIN_MS, stop_event: Optional[threading.Event] = None) -> None:
+        self.spin = spin_ms / 1000
+        self.stop_event = stop_event or threading.Event()
+
+    def now(self) -> float:
+        return time.perf_counter()
+
+    def wait_until(self, deadline: float) -> bool:
+        '''returns False if stopped before the deadline'''
+
+        remaining = deadline - time.perf_counter()
+        if remaining > self.spin:
+            if self.stop_event.wait(remaining - self.spin):
+                return False
+
+        while time.perf_counter() < deadline:
+            if self.stop_event.is_set():
+                return False
+            # release the GIL, the GUI and receiver threads keep running
+            time.sleep(0)
+        return True
+
+class WaveformPlayer:
+    '''
+    Play pulse trains and intensity schedules on a PWM channel from a
+    dedicated thread, with edges on absolute deadlines.
+
+    Regular trains at full intensity are handed to the hardware timer
+    (PWM at the train frequency, duty cycle set by the pulse width) when
+    the DAIO can produce the frequency within hardware_tolerance (relative),
+    so that only the start and end of the train are timed in software. 
+    The pulses are then free of jitter, but their period may differ from
+    the requested one by up to hardware_tolerance (0 to always time edges 
+    in software).
+
+    Edges timed in software must be further apart than the DAIO takes to
+    switch the output.
+
+    For each edge the commanded time, the time the command was issued
+    and the time it returned are logged.
+    '''
+
+    def __init__(
+            self,
+            DAIO: 'DigitalAnalogIO',
+            channel: int,
+            pwm_frequency: float,
+            spin_ms: float = SPIN_MS,
+            hardware_tolerance: float = 0.005
+        ) -> None:
+
+        self.DAIO = DAIO
+        self.channel = channel
+        self.pwm_frequency = pwm_frequency
+        self.hardware_tolerance = hardware_tolerance
+        self.stop_event = threading.Event()
+        self.clock = DeadlineClock(spin_ms, self.stop_event)
+        self.thread = None
+
+        self.edges = []
+        self.commanded = np.zeros((0,))
+        self.issued = np.zeros((0,))
+        self.completed = np.zeros((0,))
+
+    def is_running(self) -> bool:
+        return self.thread is not None and self.thread.is_alive()
+
+    def hardware_frequency(self, frequency: float) -> Optional[float]:
+        '''frequency the DAIO timer would produce, None if it has no usable timer'''
+
+        if not hasattr(self.DAIO, 'actual_frequency'):
+            return None
+        try:
+            actual = self.DAIO.actual_frequency(frequency)
+        except ValueError:
+            return None
+        if abs(actual - frequency) > self.hardware_tolerance * frequency:
+            return None
+        return actual
+
+    def play_train(
+            self,
+            frequency: float,
+            pulse_ms: float,
+            duration_s: float,
+            intensity: float = 1
+        ) -> bool:
+        '''
+        Start a pulse train. Returns True if it runs on the hardware
+        timer, False if edges are timed in software.
+        '''
+
+        actual = self.hardware_frequency(frequency) if intensity == 1 else None
+        if actual is None:
+            self.play(pulse_train(frequency, pulse_ms, duration_s, intensity))
+            return False
+
+        num_pulses = int(round(duration_s * frequency))
+        duty_cycle = pulse_ms / 1000 * actual
+        self.play([
+            Edge(0, duty_cycle, actual),
+            Edge(num_pulses / actual, 0, actual)
+        ])
+        return True
+
+    def call_latency(self) -> Optional[float]:
+        '''median time (s) the DAIO takes to switch the output, None if unknown'''
+
+        if not hasattr(self.DAIO, 'get_statistics'):
+            return None
+        latency = self.DAIO.get_statistics().get('call_latency_median_ms', np.nan)
+        return None if np.isnan(latency) else latency / 1000
+
+    def check_spacing(self, edges: List[Edge]) -> None:
+
+        if len(edges) < 2:
+            return
+        spacing = float(np.min(np.diff([edge.time for edge in edges])))
+        latency = self.call_latency()
+        if latency is not None and spacing < latency:
+            raise ValueError(
+                f'edges {1000*spacing:.3f} ms apart, the DAIO needs {1000*latency:.3f} ms per edge'
+            )
+
+    def play(self, edges: List[Edge]) -> None:
+
+        if self.is_running():
+            raise RuntimeError('a waveform is already playing')
+
+        edges = list(edges)
+        self.check_spacing(edges)
+        self.edges = edges
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self) -> None:
+
+        num_edges = len(self.edges)
+        self.commanded = np.full((num_edges,), np.nan)
+        self.issued = np.full((num_edges,), np.nan)
+        self.completed = np.full((num_edges,), np.nan)
+
+        # leave time to reach the first deadline
+        start = self.clock.now() + self.clock.spin
+        finished = False
+        try:
+            for n, edge in enumerate(self.edges):
+
+                deadline = start + edge.time
+                self.commanded[n] = deadline
+                if not self.clock.wait_until(deadline):
+                    break
+
+                self.issued[n] = self.clock.now()
+                self.DAIO.pwm(
+                    channel=self.channel,
+                    duty_cycle=edge.intensity,
+                    frequency=edge.frequency or self.pwm_frequency
+                )
+                self.completed[n] = self.clock.now()
+            else:
+                finished = True
+        finally:
+            # never leave the LED on
+            if not finished or (self.edges and self.edges[-1].intensity != 0):
+                self.DAIO.pwm(channel=self.channel, duty_cycle=0, frequency=self.pwm_frequency)
+
+    def stop(self) -> None:
+        self.stop_event.set()
+        self.wait()
+
+    def wait(self, timeout: Optional[float] = None) -> None:
+        if self.thread is not None:
+            self.thread.join(timeout)
+
+    def get_log(self) -> Dict:
+        '''edge times relative to the first commanded edge, in s'''
+
+        t0 = self.commanded[0] if self.commanded.size else 0
+        return {
+            'commanded': self.commanded - t0,
+            'issued': self.issued - t0,
+            'completed': self.completed - t0,
+            'intensity': np.array([edge.intensity for edge in self.edges])
+        }
+
+    def get_statistics(self) -> Dict:
+        '''
+        jitter: edge issued after its deadline,
+        latency: time for the DAIO call to return
+        '''
+
+        done = ~np.isnan(self.issued)
+        jitter = 1000 * (self.issued[done] - self.commanded[done])
+        latency = 1000 * (self.completed[done] - self.issued[done])
+        if not np.any(done):
+            return {'edges': 0}
+
+        return {
+            'edges': int(np.sum(done)),
+            'jitter_mean_ms': float(np.mean(jitter)),
+            'jitter_std_ms': float(np.std(jitter)),
+            'jitter_max_ms': float(np.max(jitter)),
+            'latency_median_ms': float(np.median(latency)),
+            'latency_max_ms': float(np.max(latency)),
+            'edge_error_p99_ms': float(np.percentile(jitter + latency, 99))
+        }
\ No newline at end of file
@@ -0,0 +1,58 @@
+'''
+Check that deserialize_fast gives exactly the same arrays as deserialize
+on messages formatted like serialize.m, and report parsing throughput for 
+the legacy text protocol at the frame sizes we use.
+'''
+
+import time
+import numpy as np
+from numpy.typing import NDArray
+from Microscope import deserialize, deserialize_fast
+
+FRAME_RATE = 30
+SHAPES = [(512,512), (1024,1024)]
+REPEATS = 10
+
+def serialize(image: NDArray) -> bytes:
+    '''mimic MATLAB string(): short format, NaN and Inf spelled out'''
+
+    rows = [','.join(f'{v:.5g}'.replace('nan', 'NaN').replace('inf', 'Inf') for v in row) for row in image]
+    return ';'.join(rows).encode()
+
+def check(message: bytes) -> None:
+
+    reference = deserialize(message.decode())
+    fast = deserialize_fast(message)
+    if not (reference.shape == fast.shape and reference.dtype == fast.dtype):
+        raise AssertionError('shape or dtype mismatch')
+    if not np.array_equal(reference, fast, equal_nan=True):
+        raise AssertionError('values mismatch')
+
+def throughput(parser, message, repeats: int = REPEATS):
+
+    start = time.perf_counter()
+    for i in range(repeats):
+        parser(message)
+    elapsed = (time.perf_counter() - start) / repeats
+    return len(message) / elapsed / 1e6, 1 / elapsed
+
+if __name__ == "__main__":
+
+    # edge cases
+    special = np.array([[0, 1, np.nan], [np.inf, -np.inf, 1e-7]], dtype=np.float32)
+    check(serialize(special))
+    check(b'0.5')
+
+    for shape in SHAPES:
+
+        image = np.random.rand(*shape).astype(np.float32)
+        message = serialize(image)
+        check(message)
+
+        legacy_mbps, legacy_fps = throughput(lambda m: deserialize(m.decode()), message, 2)
+        fast_mbps, fast_fps = throughput(deserialize_fast, message)
+        status = 'OK' if fast_fps >= FRAME_RATE else 'TOO SLOW'
+
+        print(f'{shape[0]}x{shape[1]}, {len(message)/1e6:.1f} MB per frame')
+        print(f'    deserialize:      {legacy_mbps:8.1f} MB/s {legacy_fps:8.1f} frames/s')
+        print(f'    deserialize_fast: {fast_mbps:8.1f} MB/s {fast_fps:8.1f} frames/s [{status} at {FRAME_RATE} Hz]')
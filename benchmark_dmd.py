@@ -0,0 +1,193 @@
+'''
+Benchmark DMD.update_image with realistic masks at several resolutions.
+Reports achieved frames/s for new masks (converted and painted every 
+frame) and for masks shown again (pixmap cache hits), time spent 
+converting masks to pixmaps versus painting them, and memory growth.
+
+Frame rates and paint times are only meaningful when the window is 
+actually shown on a screen. With the offscreen Qt platform nothing is 
+painted: only conversion times and memory are reported.
+
+    python benchmark_dmd.py --duration 5
+    python benchmark_dmd.py --offscreen
+'''
+
+import os
+import sys
+import time
+import argparse
+import tracemalloc
+import numpy as np
+import cv2
+from numpy.typing import NDArray
+from typing import List, Tuple, Dict
+from Latency import latency_probe
+
+RESOLUTIONS = [(1140, 912), (1080, 1920), (512, 512)]
+MASK_KINDS = ['binary', 'float', 'sparse']
+NUM_MASKS = 20
+
+def rss_mb() -> float:
+    '''resident memory of the process, in MB (Linux only)'''
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2**20
+    except (OSError, ValueError):
+        return np.nan
+
+def create_masks(kind: str, height: int, width: int, num_masks: int = NUM_MASKS) -> List[NDArray]:
+    '''
+    binary: large random polygons, float: smooth graded blobs, 
+    sparse: a few small cell-sized disks
+    '''
+
+    rng = np.random.default_rng(0)
+    masks = []
+    for i in range(num_masks):
+        mask = np.zeros((height, width), np.float32)
+        if kind == 'binary':
+            points = rng.integers(0, [width, height], size=(8,2)).astype(np.int32)
+            cv2.fillPoly(mask, [cv2.convexHull(points)], 1)
+        elif kind == 'float':
+            y, x = np.ogrid[:height, :width]
+            for cx, cy, s in zip(rng.uniform(0, width, 5), rng.uniform(0, height, 5), rng.uniform(20, 200, 5)):
+                mask += np.exp(-((x-cx)**2 + (y-cy)**2)/(2*s**2)).astype(np.float32)
+            np.clip(mask, 0, 1, out=mask)
+        elif kind == 'sparse':
+            for cx, cy in rng.integers(0, [width, height], size=(10,2)):
+                cv2.circle(mask, (int(cx), int(cy)), 6, 1, -1)
+        else:
+            raise ValueError(f'unknown mask kind {kind}')
+        masks.append(mask)
+    return masks
+
+def wait_exposed(app, widget, timeout: float = 5.0) -> bool:
+    '''process events until the window is shown on screen'''
+
+    start = time.perf_counter()
+    while time.perf_counter() - start < timeout:
+        app.processEvents()
+        window = widget.windowHandle()
+        if window is not None and window.isExposed():
+            return True
+        time.sleep(0.01)
+    return False
+
+def run(app, dmd_widget, masks: List[NDArray], duration: float, cached: bool = False) -> Dict:
+    '''
+    Show masks for duration seconds with DMD.update_image, processing 
+    events between frames like the GUI does. Without cached, the pixmap
+    cache is cleared before each frame, so every frame pays for 
+    conversion and paint: this is the sustainable rate of new patterns. 
+    With cached, masks are cycled through a warm cache (patterns shown 
+    again). The latency probe is enabled so that update_image paints each 
+    frame immediately and marks conversion and painting.
+    '''
+
+    dmd_widget.cache.clear()
+    if cached:
+        for mask in masks:
+            dmd_widget.get_pixmap(mask)
+    hits_start = dmd_widget.cache.hits
+    latency_probe.clear()
+    previous = latency_probe.enabled
+    latency_probe.enabled = True
+    num_frames = 0
+
+    start = time.perf_counter()
+    while time.perf_counter() - start < duration:
+        if not cached:
+            dmd_widget.cache.clear()
+        latency_probe.start()
+        dmd_widget.update_image(masks[num_frames % len(masks)])
+        app.processEvents()
+        num_frames += 1
+    elapsed = time.perf_counter() - start
+
+    latencies = latency_probe.get_latencies()
+    latency_probe.enabled = previous
+    latency_probe.clear()
+
+    return {
+        'fps': num_frames / elapsed,
+        'convert_ms': 1000 * latencies['start -> convert'].mean(),
+        'paint_ms': 1000 * latencies['set_pixmap -> painted'].mean(),
+        'hit_rate': (dmd_widget.cache.hits - hits_start) / num_frames
+    }
+
+def memory(app, dmd_widget, masks: List[NDArray], repeats: int = 2) -> Dict:
+    '''memory used by update_image, measured apart from the timed run since tracing slows it down'''
+
+    dmd_widget.cache.clear()
+    tracemalloc.start()
+    rss_start = rss_mb()
+    for i in range(repeats):
+        for mask in masks:
+            dmd_widget.update_image(mask)
+            dmd_widget.img_label.repaint()
+            app.processEvents()
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        'python_mem_mb': current / 2**20,
+        'python_peak_mb': peak / 2**20,
+        'rss_growth_mb': rss_mb() - rss_start
+    }
+
+def convert_only(dmd_widget, masks: List[NDArray], repeats: int = 3) -> float:
+    '''conversion time (ms) without cache'''
+
+    start = time.perf_counter()
+    for i in range(repeats):
+        for mask in masks:
+            dmd_widget.convert(mask)
+    return 1000 * (time.perf_counter() - start) / (repeats * len(masks))
+
+def parse_resolution(text: str) -> Tuple[int, int]:
+    height, width = text.lower().split('x')
+    return int(height), int(width)
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--duration', type=float, default=2.0, help='seconds per mask kind and resolution')
+    parser.add_argument('--resolutions', type=parse_resolution, nargs='+', default=RESOLUTIONS, help='HEIGHTxWIDTH')
+    parser.add_argument('--kinds', nargs='+', default=MASK_KINDS, choices=MASK_KINDS)
+    parser.add_argument('--screen', type=int, default=0, help='screen of the DMD')
+    parser.add_argument('--offscreen', action='store_true', help='use the Qt offscreen platform')
+    args = parser.parse_args()
+
+    if args.offscreen:
+        os.environ['QT_QPA_PLATFORM'] = 'offscreen'
+
+    from PyQt5.QtWidgets import QApplication
+    from DMD import DMD
+
+    app = QApplication(sys.argv)
+    dmd_widget = DMD(screen_num=args.screen)
+    on_screen = app.platformName() != 'offscreen' and wait_exposed(app, dmd_widget)
+    if not on_screen:
+        print('window not shown on a screen: nothing is painted, frame rates are not reported')
+
+    print(f"{'kind':<8} {'resolution':<11} {'fps new':>8} {'fps seen':>8} {'convert':>9} {'uncached':>9} {'paint':>8} {'py mem':>8} {'py peak':>8} {'rss':>8}")
+    for height, width in args.resolutions:
+        for kind in args.kinds:
+            masks = create_masks(kind, height, width)
+            uncached_ms = convert_only(dmd_widget, masks)
+            r = memory(app, dmd_widget, masks)
+            if on_screen:
+                new = run(app, dmd_widget, masks, args.duration)
+                seen = run(app, dmd_widget, masks, args.duration, cached=True)
+                rates = (
+                    f"{new['fps']:8.1f} {seen['fps']:8.1f} "
+                    f"{new['convert_ms']:6.2f} ms {uncached_ms:6.2f} ms {new['paint_ms']:5.2f} ms "
+                )
+            else:
+                rates = f"{'-':>8} {'-':>8} {'-':>9} {uncached_ms:6.2f} ms {'-':>8} "
+            print(
+                f"{kind:<8} {f'{height}x{width}':<11} {rates}"
+                f"{r['python_mem_mb']:5.1f} MB {r['python_peak_mb']:5.1f} MB {r['rss_growth_mb']:5.1f} MB"
+            )
+
+    dmd_widget.close()
\ No newline at end of file
@@ -0,0 +1,122 @@
+'''
+Benchmark bulk mask operations on the headless MaskEngine, without a
+display: adding ROIs (with transfer to the other spaces), visibility
+changes, weighted expose, flatten, save/load and re-transfer after a
+calibration change.
+
+    python benchmark_masks.py --num-masks 100 1000 5000
+'''
+
+import os
+import time
+import argparse
+import tempfile
+import numpy as np
+import cv2
+from typing import List, Tuple, Dict, Callable
+from MaskEngine import MaskEngine
+from MaskStorage import CompactMask
+
+SPACES = ['Camera', 'DMD', 'Two Photon']
+SHAPES = [(2048, 2048), (768, 1024), (512, 512)]
+NUM_MASKS = [100, 1000]
+
+def create_transformations() -> np.ndarray:
+    '''plausible calibration between the three spaces (similarity transforms)'''
+
+    to_cam = [
+        np.eye(3),
+        np.array([[2.0, 0.02, 10], [-0.02, 2.0, 250], [0, 0, 1]]),
+        np.array([[3.9, 0.1, 30], [-0.1, 3.9, 20], [0, 0, 1]])
+    ]
+    N = len(to_cam)
+    transformations = np.zeros((N, N, 3, 3))
+    for i in range(N):
+        for j in range(N):
+            transformations[i, j] = np.linalg.inv(to_cam[j]) @ to_cam[i]
+    return transformations
+
+def create_rois(shape: Tuple[int, int], num_masks: int, graded_fraction: float = 0.2) -> List[CompactMask]:
+    '''cell-sized disks in two-photon space, some of them graded'''
+
+    rng = np.random.default_rng(0)
+    rois = []
+    for i in range(num_masks):
+        radius = int(rng.integers(4, 9))
+        crop = np.zeros((2*radius+1, 2*radius+1), np.float32)
+        cv2.circle(crop, (radius, radius), radius, 1, -1)
+        if rng.random() < graded_fraction:
+            crop *= rng.uniform(0.2, 0.9)
+        top, left = rng.integers(0, [shape[0]-crop.shape[0], shape[1]-crop.shape[1]])
+        rois.append(CompactMask.from_crop(shape, int(top), int(left), crop))
+    return rois
+
+def timed(function: Callable, *args, **kwargs) -> float:
+    '''duration of a call, in ms'''
+    start = time.perf_counter()
+    function(*args, **kwargs)
+    return 1000 * (time.perf_counter() - start)
+
+def run(num_masks: int) -> Dict:
+
+    engine = MaskEngine.from_shapes(SHAPES, SPACES, create_transformations())
+    source = SPACES.index('Two Photon')
+    dmd = SPACES.index('DMD')
+
+    rois = create_rois(SHAPES[source], num_masks)
+    keys = list(range(1, num_masks + 1))
+    weights = list(np.linspace(0.1, 1, num_masks))
+    half = keys[::2]
+
+    results = {}
+    results['add'] = timed(engine.add, source, keys, rois)
+    results['hide half'] = timed(engine.set_visible, half, False)
+    results['show half'] = timed(engine.set_visible, half, True)
+    results['expose all'] = timed(engine.expose, dmd, keys, weights)
+
+    out = np.zeros(SHAPES[dmd], np.float32)
+    engine.expose(dmd, keys, weights, out)
+    results['expose again'] = timed(engine.expose, dmd, keys, weights, out)
+    results['composite'] = timed(engine.composite, dmd)
+
+    with tempfile.TemporaryDirectory() as directory:
+        filename = os.path.join(directory, 'masks.masks')
+        results['save'] = timed(engine.save, filename)
+        other = MaskEngine.from_shapes(SHAPES, SPACES, engine.transformations)
+        results['load'] = timed(other.load, filename)
+        # masks are read and transferred when first needed
+        results['expose loaded'] = timed(other.expose, dmd, keys, weights)
+        results['composites'] = timed(lambda: [store.composite() for store in other.stores])
+        # the library is closed before it is replaced: works on Windows too
+        results['save again'] = timed(other.save, filename)
+
+    # new calibration: masks are transferred again, composites included
+    transformations = engine.transformations.copy()
+    transformations[source, dmd, :2, 2] += 3
+    engine.set_transformations(transformations)
+    masks = [engine.stores[source].masks[key] for key in keys]
+    def transfer_again():
+        engine.transfer(source, keys, masks)
+        for store in engine.stores:
+            store.composite()
+    results['re-transfer'] = timed(transfer_again)
+
+    results['consistent'] = engine.check_consistency()
+    results['delete half'] = timed(engine.delete, half)
+    results['flatten'] = timed(engine.flatten)
+    return results
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--num-masks', type=int, nargs='+', default=NUM_MASKS)
+    args = parser.parse_args()
+
+    for num_masks in args.num_masks:
+        results = run(num_masks)
+        print(f'{num_masks} masks')
+        for name, value in results.items():
+            if isinstance(value, bool):
+                print(f'  {name:<14} {value}')
+            else:
+                print(f'  {name:<14} {value:9.2f} ms')
\ No newline at end of file
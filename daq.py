@@ -9,8 +9,12 @@
 # TODO National Instruments ?
 
 import u3
+import time
+import threading
+import numpy as np
+from collections import deque
 from pyfirmata import Arduino
-from typing import Protocol
+from typing import Protocol, List, Dict, Tuple, Optional
 
 class DigitalAnalogIO(Protocol):
 
@@ -78,6 +82,10 @@ class LabJackU3LV:
     Supports Analog input (FIOs) and output (DACs), digital
     input and output (FIOs), as well as PWM (FIOs). 
 
+    Registers written to the device are mirrored so that only changes 
+    are sent. Updating the duty cycle of a running PWM is a single USB 
+    transfer. 
+
     The U3 has 2 timers (Timer0-Timer1) and 2 counters (Counter0-Counter1). 
     When any of these timers or counters are enabled, they take over an
     FIO/EIO line in sequence (Timer0, Timer1, Counter0, then Counter1), 
@@ -131,77 +139,214 @@ class LabJackU3LV:
     TIMER_MODE_16BIT = 0
     TIMER_MODE_8BIT = 1
 
-    CLOCK: int = 48 # I'm only using the 48MHz clock with divisors enabled 
+    # timer configuration that the device resets when timers are enabled 
+    # or disabled
+    TIMER_REGISTERS = (TIMER_CLOCK_BASE, TIMER_CLOCK_DIVISOR, TIMER_CONFIG, TIMER_CONFIG + 1)
+
+    # timer clock bases with divisor (register value: clock in MHz), 
+    # U3 hardware 1.21+
+    CLOCK_BASES = {3: 1, 4: 4, 5: 12, 6: 48}
+    TIMER_RESOLUTION = {TIMER_MODE_16BIT: 2**16, TIMER_MODE_8BIT: 2**8}
+        
+    def __init__(self, latency_history: int = 1000, serial_number: Optional[int] = None) -> None:
+        
+        # first device found, or a given one when several are plugged in
+        if serial_number is None:
+            self.device = u3.U3()
+        else:
+            self.device = u3.U3(firstFound=False, serial=serial_number)
+
+        # shadow copy of the registers written to the device: writes that 
+        # would not change anything are skipped. The lock protects the 
+        # cache from concurrent calls (e.g. PulseSender threads) 
+        self.registers = {}
+        self.lock = threading.RLock()
+
+        self.num_transfers = 0
+        self.num_skipped = 0
+        self.transfer_time = 0.0
+        self.call_latency = deque(maxlen=latency_history)
+        self.timer_cache = {} # frequency -> timer settings
+
+    def transfer(self, address: int, value) -> None:
         
-    def __init__(self) -> None:
+        if address <= self.NUM_TIMER_ENABLED < address + np.size(value):
+            # whatever happens, the timer configuration has to be written again
+            self.invalidate(*self.TIMER_REGISTERS)
+
+        start = time.perf_counter()
+        try:
+            self.device.writeRegister(address, value)
+        except Exception:
+            # the device state is unknown
+            self.invalidate()
+            raise
+        self.transfer_time += time.perf_counter() - start
+        self.num_transfers += 1
+
+    def write(self, address: int, value) -> None:
+        '''write a register, unless it already holds value'''
+
+        with self.lock:
+            if self.registers.get(address) == value:
+                self.num_skipped += 1
+                return
+            self.transfer(address, value)
+            self.registers[address] = value
+
+    def write_consecutive(self, address: int, values: List[int]) -> None:
+        '''
+        write consecutive 16-bit registers in a single transaction, 
+        unless they all hold their values already
+        '''
+
+        with self.lock:
+            addresses = range(address, address + len(values))
+            if all(self.registers.get(a) == v for a, v in zip(addresses, values)):
+                self.num_skipped += 1
+                return
+            self.transfer(address, list(values))
+            self.registers.update(zip(addresses, values))
+
+    def invalidate(self, *addresses: int) -> None:
+        '''forget cached register values (all of them by default)'''
+
+        with self.lock:
+            if not addresses:
+                self.registers = {}
+            for address in addresses:
+                self.registers.pop(address, None)
+
+    def disable_timers(self) -> None:
         
-        self.device = u3.U3()
+        with self.lock:
+            if self.registers.get(self.NUM_TIMER_ENABLED) != 0:
+                self.write(self.NUM_TIMER_ENABLED, 0)
+                # the timer owned its pin, digital states are unknown
+                self.invalidate(*self.channels['DigitalInputOutput'])
 
     def analogWrite(self, channel: int, val: float) -> None:
-        self.device.writeRegister(self.NUM_TIMER_ENABLED, 0)
-        self.device.writeRegister(self.channels['AnalogOutput'][channel], val)
+        start = time.perf_counter()
+        with self.lock:
+            self.disable_timers()
+            self.write(self.channels['AnalogOutput'][channel], val)
+        self.call_latency.append(time.perf_counter() - start)
 
     def analogRead(self, channel: int) -> float:
-        self.device.writeRegister(self.NUM_TIMER_ENABLED, 0)
-        self.device.writeRegister(self.FIO_ANALOG, channel**2) # set channel as analog
-        return self.device.readRegister(self.channels['AnalogInput'][channel])
+        with self.lock:
+            self.disable_timers()
+            self.write(self.FIO_ANALOG, channel**2) # set channel as analog
+            return self.device.readRegister(self.channels['AnalogInput'][channel])
     
     def digitalWrite(self, channel: int, val: bool):
-        self.device.writeRegister(self.NUM_TIMER_ENABLED, 0)
-        self.device.writeRegister(self.FIO_ANALOG, 0) # set channel as digital
-        self.device.writeRegister(self.channels['DigitalInputOutput'][channel], val)
+        start = time.perf_counter()
+        with self.lock:
+            self.disable_timers()
+            self.write(self.FIO_ANALOG, 0) # set channel as digital
+            self.write(self.channels['DigitalInputOutput'][channel], int(val))
+        self.call_latency.append(time.perf_counter() - start)
 
     def digitalRead(self, channel: int) -> float:
-        self.device.writeRegister(self.NUM_TIMER_ENABLED, 0)
-        self.device.writeRegister(self.FIO_ANALOG, 0) # set channel as digital
-        return self.device.readRegister(self.channels['DigitalInputOutput'][channel])
+        with self.lock:
+            self.disable_timers()
+            self.write(self.FIO_ANALOG, 0) # set channel as digital
+            # reading turns the line into an input
+            self.invalidate(self.channels['DigitalInputOutput'][channel])
+            return self.device.readRegister(self.channels['DigitalInputOutput'][channel])
    
     def pwm(self, channel: int = 4, duty_cycle: float = 0.5, frequency: float = 732.42) -> None:
 
         if not (0 <= duty_cycle <= 1):
             raise ValueError('duty_cycle should be between 0 and 1')
 
-        if frequency > 187_500:
-            raise ValueError('max frequency at 48MHz is 187_500 Hz')
-        elif frequency < 2.861:
-            raise ValueError('min frequency at 48MHz is 2.861 Hz')
-         
-        if frequency > 732.42:
-            timer_mode = self.TIMER_MODE_8BIT
-            div = 2**8
-        else:
-            timer_mode = self.TIMER_MODE_16BIT
-            div = 2**16
+        timer_mode, clock_base, timer_clock_divisor = self.timer_settings(frequency)
 
-        # make sure digital value is 0
-        self.digitalWrite(channel,0)
+        start = time.perf_counter()
+        with self.lock:
 
-        if duty_cycle == 0:
-            # PWM can't fully turn off. Use digital write instead
-            # and return
-            return
-        
-        # divisor should be in the range 0-255, 0 corresponds to a divisor of 256
-        timer_clock_divisor = int( (self.CLOCK * 1e6)/(frequency * div) )
-        if timer_clock_divisor == 256: timer_clock_divisor = 0 
-        
-        # enable Timer0 
-        self.device.writeRegister(self.NUM_TIMER_ENABLED, 1)
+            timer_running = (
+                self.registers.get(self.NUM_TIMER_ENABLED) == 1 
+                and self.registers.get(self.TIMER_PIN_OFFSET) == channel
+            )
 
-        # set the timer clock to 48 MHz with divisor (correspond to register value of 6)
-        self.device.writeRegister(self.TIMER_CLOCK_BASE, 6)
+            if duty_cycle == 0 or not timer_running:
+                # make sure digital value is 0
+                self.digitalWrite(channel, 0)
 
-        # set divisor
-        self.device.writeRegister(self.TIMER_CLOCK_DIVISOR, timer_clock_divisor)
+            if duty_cycle == 0:
+                # PWM can't fully turn off. Use digital write instead
+                # and return
+                self.call_latency.append(time.perf_counter() - start)
+                return
+            
+            # Pin offset (FIO) and enable Timer0, consecutive registers.
+            # Enabling the timer resets its configuration, which is then 
+            # written again below
+            self.write_consecutive(self.TIMER_PIN_OFFSET, [channel, 1])
 
-        # Pin offset (FIO) 
-        self.device.writeRegister(self.TIMER_PIN_OFFSET, channel) 
+            # set the timer clock base and divisor. Only written when the 
+            # frequency changes
+            self.write(self.TIMER_CLOCK_BASE, clock_base)
+            self.write(self.TIMER_CLOCK_DIVISOR, timer_clock_divisor)
 
-        # 16 bit value for duty cycle
-        value = int(65535*(1-duty_cycle))
+            # 16 bit value for duty cycle
+            value = int(65535*(1-duty_cycle))
 
-        # Configure the timer for 16-bit PWM
-        self.device.writeRegister(self.TIMER_CONFIG, [timer_mode, value]) 
+            # Configure the timer for 16-bit PWM. When only the duty cycle
+            # changes, this is the only transfer
+            self.write_consecutive(self.TIMER_CONFIG, [timer_mode, value]) 
+
+        self.call_latency.append(time.perf_counter() - start)
+
+    def timer_settings(self, frequency: float) -> Tuple[int, int, int]:
+        '''
+        Timer mode, clock base and clock divisor producing the PWM frequency 
+        closest to frequency. PWM frequency = clock / (divisor * resolution).
+        16-bit mode (finer duty cycle) is preferred when it is as close.
+        '''
+
+        if frequency in self.timer_cache:
+            return self.timer_cache[frequency]
+
+        if frequency > 187_500:
+            raise ValueError('max PWM frequency is 187_500 Hz')
+        elif frequency < 0.0597:
+            raise ValueError('min PWM frequency is 0.0597 Hz')
+
+        divisors = np.arange(1, 257)
+        candidates = []
+        for timer_mode, resolution in self.TIMER_RESOLUTION.items():
+            for clock_base, clock_mhz in self.CLOCK_BASES.items():
+                error = np.abs(clock_mhz * 1e6 / (divisors * resolution) - frequency) / frequency
+                best = int(np.argmin(error))
+                candidates.append((float(error[best]), timer_mode, clock_base, int(divisors[best])))
+        
+        min_error = min(c[0] for c in candidates)
+        _, timer_mode, clock_base, divisor = min(
+            c for c in candidates if c[0] <= min_error + 1e-4
+        )
+
+        # divisor register is in the range 0-255, 0 corresponds to a divisor of 256
+        self.timer_cache[frequency] = (timer_mode, clock_base, divisor % 256)
+        return self.timer_cache[frequency]
+
+    def actual_frequency(self, frequency: float) -> float:
+        '''PWM frequency produced by the timer when asking for frequency'''
+
+        timer_mode, clock_base, timer_clock_divisor = self.timer_settings(frequency)
+        resolution = self.TIMER_RESOLUTION[timer_mode]
+        return (self.CLOCK_BASES[clock_base] * 1e6) / (resolution * (timer_clock_divisor or 256))
+
+    def get_statistics(self) -> Dict:
+        
+        latency = np.array(self.call_latency)
+        return {
+            'transfers': self.num_transfers,
+            'skipped': self.num_skipped,
+            'mean_transfer_ms': 1000 * self.transfer_time / max(self.num_transfers, 1),
+            'call_latency_median_ms': 1000 * np.median(latency) if latency.size else np.nan,
+            'call_latency_max_ms': 1000 * np.max(latency) if latency.size else np.nan
+        }
 
     def close(self) -> None:
         self.device.close()
@@ -8,16 +8,36 @@ classdef frameDoneIPC
         channel
         flags
         future
+        format
     end 
 
+    properties (Constant)
+        % binary frame protocol, must match Microscope.py
+        HEADER_MAGIC = uint8('SIFR')
+        HEADER_VERSION = uint8(2)
+        DTYPE_FLOAT32 = uint8(0)
+        DTYPE_INT16 = uint8(1)
+    end
+
     methods
 
-        function obj = frameDoneIPC(zeromq_jar_path, zeromq_protocol, zeromq_host, zeromq_port, channel)
+        function obj = frameDoneIPC(zeromq_jar_path, zeromq_protocol, zeromq_host, zeromq_port, channel, format)
             % initalize zeromq for IPC: send images to other processes
+            % format: "text" (legacy), "float32" or "int16" (binary)
+            % channel: channel number, or vector of channel numbers for 
+            % the binary formats
             javaclasspath(zeromq_jar_path)
             import org.zeromq.*
             obj.context = ZContext();
 
+            if nargin < 6
+                format = "text";
+            end
+            if ~ismember(format, ["text", "float32", "int16"])
+                error('format should be "text", "float32" or "int16"')
+            end
+            obj.format = format;
+
             % Pull in ScanImage API handle
             scanimageObjectName='hSI';
             W = evalin('base','whos');
@@ -48,20 +68,84 @@ classdef frameDoneIPC
 
         function fAcq(obj,source,event,varargin)
 
-            % get image data
             buffer = obj.hSI.hDisplay.stripeDataBuffer{1};
-            frame = buffer.roiData{1}.imageData{obj.channel}{1};
 
-            % rescale image
-            im_min = obj.hSI.hChannels.channelLUT{obj.channel}(1);
-            im_max = obj.hSI.hChannels.channelLUT{obj.channel}(2);
+            if obj.format == "text"
+                % legacy: first channel of the first ROI only
+                frame = buffer.roiData{1}.imageData{obj.channel(1)}{1};
+                frame = obj.rescale(frame, obj.channel(1));
+                obj.publisher.send(serialize(frame'), obj.flags); 
+                return
+            end
+
+            % send every selected channel of every ROI in a single message
+            plane = obj.current_plane(buffer.frameNumberAcq);
+            parts = {};
+            for roi = 1:numel(buffer.roiData)
+                roi_data = buffer.roiData{roi};
+                for c = 1:numel(roi_data.channels)
+                    channel = roi_data.channels(c);
+                    if ~ismember(channel, obj.channel)
+                        continue
+                    end
+                    frame = roi_data.imageData{c}{1};
+                    if obj.format == "int16"
+                        % send raw data, no rescaling 
+                        frame = int16(frame);
+                        dtype_code = obj.DTYPE_INT16;
+                    else
+                        frame = min(max(obj.rescale(frame, channel), 0), 1);
+                        dtype_code = obj.DTYPE_FLOAT32;
+                    end
+                    header = obj.pack_header(frame, dtype_code, channel, plane, roi-1, buffer.frameNumberAcq);
+                    parts(end+1:end+2) = {header, typecast(frame(:), 'int8')};
+                end
+            end
+
+            obj.send_multipart(parts);
+
+        end 
+
+        function frame = rescale(obj, frame, channel)
+            im_min = obj.hSI.hChannels.channelLUT{channel}(1);
+            im_max = obj.hSI.hChannels.channelLUT{channel}(2);
             frame = (single(frame) - single(im_min))./(single(im_max)-single(im_min));
+        end
+
+        function plane = current_plane(obj, frame_index)
+            % 0-based plane index during fast-z volumes, 0 otherwise
+            plane = 0;
+            if obj.hSI.hFastZ.enable
+                num_planes = obj.hSI.hStackManager.numSlices;
+                plane = mod(frame_index - 1, num_planes);
+            end
+        end
+
+        function header = pack_header(obj, frame, dtype_code, channel, plane, roi, frame_index)
+            % Numpy reads the column-major buffer row-major, which gives 
+            % frame', the same orientation as the text format, without 
+            % transposing here. Java byte[] is signed.
             
-            % send image via ZMQ 
-            obj.publisher.send(serialize(frame'), obj.flags); 
+            timestamp = double(java.lang.System.currentTimeMillis())/1000;
+            header = [ ...
+                obj.HEADER_MAGIC, obj.HEADER_VERSION, dtype_code, ...
+                typecast(uint16([channel, plane, roi]), 'uint8'), ...
+                typecast(uint32([size(frame,2), size(frame,1), frame_index]), 'uint8'), ...
+                typecast(timestamp, 'uint8') ...
+            ];
+            header = typecast(header, 'int8');
+        end
 
-        end 
+        function send_multipart(obj, parts)
+            % header and data pairs, all parts but the last use SNDMORE
+            for k = 1:numel(parts)-1
+                obj.publisher.send(parts{k}, bitor(obj.flags, org.zeromq.ZMQ.SNDMORE));
+            end
+            if ~isempty(parts)
+                obj.publisher.send(parts{end}, obj.flags);
+            end
+        end
 
     end 
 
-end 
\ No newline at end of file
+end 
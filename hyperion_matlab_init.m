@@ -4,7 +4,8 @@ zeromq_jar_path = 'C:\Users\martin.privat\Documents\OptoDMD\jeromq-0.6.0.jar';
 zeromq_protocol = "tcp://";
 zeromq_host = "*";
 zeromq_port = 5555;
-channel = 1;
+channel = 1; % vector of channels, e.g. [1 2], with the binary formats
+frame_format = "float32"; % "text" for the legacy string protocol
 
 % add scanimage path
 %addpath(genpath(scanimage_folder));
@@ -15,4 +16,4 @@ cd(optoDMD_folder)
 
 % run scanimage
 scanimage
-ipc = frameDoneIPC(zeromq_jar_path, zeromq_protocol, zeromq_host, zeromq_port, channel);
+ipc = frameDoneIPC(zeromq_jar_path, zeromq_protocol, zeromq_host, zeromq_port, channel, frame_format);
@@ -0,0 +1,89 @@
+import numpy as np
+from MaskStorage import MaskStore
+from MaskEngine import MaskEngine
+
+def square(shape, top, left, size, value=1):
+    mask = np.zeros(shape, np.float32)
+    mask[top:top+size, left:left+size] = value
+    return mask
+
+def identity_engine(num_spaces=2, shape=(64, 64)):
+    transformations = np.tile(np.eye(3), (num_spaces, num_spaces, 1, 1))
+    names = [f'space {n}' for n in range(num_spaces)]
+    return MaskEngine.from_shapes([shape] * num_spaces, names, transformations)
+
+def test_create_allocates_new_keys_in_every_space():
+    engine = identity_engine(3)
+    assert engine.create(0, [square((64, 64), 0, 0, 8), square((64, 64), 20, 20, 8)]) == [1, 2]
+    assert engine.create(2, [square((64, 64), 40, 40, 8)]) == [3]
+
+    engine.delete([3])
+    assert engine.create(1, [square((64, 64), 10, 40, 8)]) == [3]
+    engine.delete([1])
+    assert engine.create(0, [square((64, 64), 50, 0, 8)]) == [4]
+
+    assert sorted(engine.keys()) == [2, 3, 4]
+    assert engine.sources == {2: 0, 3: 1, 4: 0}
+    assert engine.check_consistency()
+
+def test_expose_is_weighted_and_clipped():
+    engine = identity_engine()
+    a = square((64, 64), 10, 10, 20)
+    b = square((64, 64), 20, 20, 20, 0.5)
+    keys = engine.create(0, [a, b])
+
+    for space in range(2):
+        np.testing.assert_allclose(engine.expose(space, keys, [0.5, 1.0]), np.clip(0.5*a + b, 0, 1), atol=1e-6)
+        np.testing.assert_allclose(engine.expose(space, keys, [2.0, 2.0]), np.clip(2*a + 2*b, 0, 1), atol=1e-6)
+        np.testing.assert_allclose(engine.expose(space, keys[1:]), b, atol=1e-6)
+
+def test_save_load_round_trip(tmp_path):
+    filename = str(tmp_path / 'masks.msk')
+    binary = square((64, 64), 4, 6, 12)
+    graded = square((64, 64), 30, 30, 16, 0.25)
+    drawn = square((64, 64), 40, 4, 10)
+
+    engine = identity_engine()
+    keys = engine.create(0, [binary, graded])
+    keys += engine.create(1, [drawn])
+    engine.set_visible([keys[1]], False)
+    assert engine.save(filename, {keys[0]: 'soma'}) == 3
+
+    other = identity_engine()
+    other.create(0, [square((64, 64), 0, 0, 4)])
+    loaded = other.load(filename)
+    assert other.get_statistics()['open_libraries'] == 1
+    assert [key for key, entry in loaded] == [2, 3, 4]
+    assert [entry.name for key, entry in loaded] == ['soma', str(keys[1]), str(keys[2])]
+    assert [entry.space for key, entry in loaded] == ['space 0', 'space 0', 'space 1']
+    assert [entry.visible for key, entry in loaded] == [True, False, True]
+
+    for space, store in enumerate(other.stores):
+        np.testing.assert_array_equal(store.dense(2), binary)
+        np.testing.assert_array_equal(store.dense(3), graded)
+        np.testing.assert_array_equal(store.dense(4), drawn)
+        assert not store.visible[3]
+    np.testing.assert_array_equal(other.composite(1), other.stores[1].accumulate([1, 2, 4]))
+    assert other.check_consistency()
+
+    # saving over an open library reads its masks first
+    other.save(filename)
+    other.close()
+    assert other.get_statistics()['open_libraries'] == 0
+    np.testing.assert_array_equal(other.stores[1].dense(3), graded)
+
+def test_store_composite_follows_changes():
+    rng = np.random.default_rng(0)
+    store = MaskStore((32, 32))
+    for key in range(1, 30):
+        top, left = rng.integers(0, 24, 2)
+        store.add(key, square((32, 32), top, left, 8, rng.choice([1, 0.5])), visible=bool(key % 3))
+    for key in range(1, 30, 4):
+        store.delete(key)
+    for key in range(2, 30, 5):
+        if key in store:
+            store.set_visible(key, not store.visible[key])
+
+    visible = [key for key in store.keys() if store.visible[key]]
+    np.testing.assert_allclose(store.composite(), np.clip(store.accumulate(visible), 0, 1), atol=1e-5)
+    assert store.check_consistency()
\ No newline at end of file
@@ -0,0 +1,51 @@
+import cv2
+import numpy as np
+from MaskTransform import MaskTransformer, mask_to_polygons, transfer_masks
+
+def square(shape, top, left, size):
+    mask = np.zeros(shape, np.float32)
+    mask[top:top+size, left:left+size] = 1
+    return mask
+
+def disk(shape, center, radius):
+    mask = np.zeros(shape, np.float32)
+    cv2.circle(mask, center, radius, 1, -1)
+    return mask
+
+def ellipse(shape, center, axes, angle):
+    mask = np.zeros(shape, np.float32)
+    cv2.ellipse(mask, center, axes, angle, 0, 360, 1, -1)
+    return mask
+
+def test_identity_is_exact():
+    masks = [
+        square((64, 64), 10, 12, 10),
+        disk((64, 64), (20, 20), 4),
+        disk((64, 64), (40, 30), 11),
+        ellipse((64, 64), (30, 30), (20, 12), 30)
+    ]
+    transformations = np.tile(np.eye(3), (2, 2, 1, 1))
+    transferred = transfer_masks(masks, 0, 1, (64, 64), MaskTransformer(transformations))
+    for mask, moved in zip(masks, transferred):
+        np.testing.assert_array_equal(moved.to_dense(), mask)
+
+def test_round_rois_are_recovered_as_polygons():
+    for radius in range(1, 20):
+        assert mask_to_polygons(disk((64, 64), (32, 32), radius)) is not None
+    assert mask_to_polygons(ellipse((64, 64), (30, 30), (20, 12), 30)) is not None
+
+def test_square_keeps_its_area_under_scaling():
+    mask = square((64, 64), 10, 10, 10)
+    transformations = np.tile(np.eye(3), (2, 2, 1, 1))
+    transformations[0, 1] = np.diag([4.0, 4.0, 1.0])
+    transferred = transfer_masks([mask], 0, 1, (256, 256), MaskTransformer(transformations))[0]
+    dense = transferred.to_dense()
+    assert dense.sum() == 1600
+    rows, cols = np.nonzero(dense)
+    assert rows.max() - rows.min() + 1 == 40
+    assert cols.max() - cols.min() + 1 == 40
+
+def test_polygons_follow_pixel_edges():
+    polygons = mask_to_polygons(square((64, 64), 10, 10, 10))
+    assert len(polygons) == 1
+    np.testing.assert_allclose(np.sort(polygons[0], axis=0)[[0, -1]], [[9.5, 9.5], [19.5, 19.5]])
\ No newline at end of file